@@ -0,0 +1,65 @@
+import gzip
+import json
+import os
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+
+def archive_dir(db_path: Path) -> Path:
+    # planner_db.json -> planner_db.archive/
+    return db_path.with_name(db_path.stem + '.archive')
+
+
+def _fsync_path(path: Path):
+    # Файл или каталог (чтобы переименование тоже пережило сбой)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Архив выполненных задач на диске: у каждого пользователя свой каталог со
+# сжатыми сегментами, по сегменту на проход архивации. Сегмент пишется до того,
+# как задачи уходят из базы, и под заранее известным номером, поэтому после
+# сбоя посреди прохода он просто перезаписывается следующим проходом
+class TaskArchive:
+    def __init__(self, directory: Path):
+        self.directory = directory
+
+    def _segment_path(self, user_id_str: str, seq: int) -> Path:
+        return self.directory / user_id_str / f"{seq:06d}.jsonl.gz"
+
+    def write_segment(self, user_id_str: str, seq: int, tasks: List[Dict], fsync: bool = False):
+        path = self._segment_path(user_id_str, seq)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            for task in tasks:
+                f.write(json.dumps(task, ensure_ascii=False) + '\n')
+        # fsync — только после закрытия: концовку gzip пишет close()
+        if fsync:
+            _fsync_path(tmp_path)
+        os.replace(tmp_path, path)
+        if fsync:
+            _fsync_path(path.parent)
+
+    def write_segments(self, segments: List[Tuple[str, int, List[Dict]]], fsync: bool = False):
+        for user_id_str, seq, tasks in segments:
+            self.write_segment(user_id_str, seq, tasks, fsync)
+
+    def read_segment(self, user_id_str: str, seq: int) -> List[Dict]:
+        path = self._segment_path(user_id_str, seq)
+        if not path.exists():
+            return []
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    def iter_newest(self, user_id_str: str, segments: int) -> Iterator[Dict]:
+        # Сегменты читаются по одному и только по мере надобности
+        for seq in range(segments - 1, -1, -1):
+            yield from reversed(self.read_segment(user_id_str, seq))
+
+    def page(self, user_id_str: str, segments: int, start: int, stop: int) -> List[Dict]:
+        return list(islice(self.iter_newest(user_id_str, segments), start, stop))
@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Резервная копия — сжатый JSON Lines: первая строка — заголовок, дальше по
+# строке на пользователя {"u": id, "user": {...}}. Пользователь ищется
+# потоковым чтением, без разбора остальных строк
+FORMAT_VERSION = 1
+
+
+def backup_dir(db_path: Path) -> Path:
+    # planner_db.json -> planner_db.backups/
+    return db_path.with_name(db_path.stem + '.backups')
+
+
+def write_backup(path: Path, records: Iterator[Tuple[str, str]], header: Dict) -> Tuple[int, int]:
+    # Выполняется в потоке: записи пользователей сериализуются и сжимаются
+    # по мере чтения. Файл появляется под своим именем только целиком
+    tmp_path = path.with_name(path.name + '.tmp')
+    users = 0
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        f.write(json.dumps({'version': FORMAT_VERSION, **header}, ensure_ascii=False) + '\n')
+        for user_id_str, record in records:
+            f.write(f'{{"u":{json.dumps(user_id_str)},"user":{record}}}\n')
+            users += 1
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return users, path.stat().st_size
+
+
+def read_header(path: Path) -> Dict:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.loads(f.readline())
+
+
+def iter_users(path: Path) -> Iterator[Tuple[str, Dict]]:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        f.readline()
+        for line in f:
+            record = json.loads(line)
+            yield record['u'], record['user']
+
+
+def read_user(path: Path, user_id_str: str) -> Optional[Dict]:
+    # Разбираем только строку нужного пользователя
+    prefix = f'{{"u":{json.dumps(user_id_str)},'
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        f.readline()
+        for line in f:
+            if line.startswith(prefix):
+                return json.loads(line)['user']
+    return None
+
+
+# Резервное копирование работающей базы. Раз в interval секунд (0 — только по
+# команде) база отдаёт согласованный срез, а сериализация и сжатие идут в
+# потоке, не останавливая обработку апдейтов. Хранятся keep последних копий
+class BackupJob:
+    def __init__(self, db, directory: Path, interval: float = 0.0, keep: int = 7):
+        self.db = db
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self._runner: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+        self._backups = 0
+        self._restored = 0
+        self._last_time = 0.0
+        self._last_size = 0
+        self._last_users = 0
+
+    async def start(self):
+        if self.interval > 0 and self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.backup()
+            except Exception:
+                logger.exception("Ошибка резервного копирования базы")
+
+    def backups(self) -> List[Path]:
+        # Новые первыми: имя начинается с времени создания
+        return sorted(self.directory.glob('*.jsonl.gz'), reverse=True)
+
+    async def backup(self) -> Path:
+        async with self._lock:
+            started = time.perf_counter()
+            self.directory.mkdir(parents=True, exist_ok=True)
+            now = datetime.now()
+            path = self.directory / f"{now:%Y%m%d-%H%M%S}.jsonl.gz"
+            header = {'created': now.isoformat(timespec='seconds'), 'source': self.db.path.name}
+            records = self.db.backup_snapshot()
+            try:
+                users, size = await asyncio.to_thread(write_backup, path, records, header)
+            finally:
+                self.db.end_backup()
+            for old in self.backups()[self.keep:]:
+                old.unlink()
+
+            self._backups += 1
+            self._last_time = time.perf_counter() - started
+            self._last_size = size
+            self._last_users = users
+            logger.info("Резервная копия %s: пользователей %d, %d байт за %.3f с",
+                        path.name, users, size, self._last_time)
+            return path
+
+    def find(self, name: Optional[str] = None) -> Optional[Path]:
+        if name is None:
+            backups = self.backups()
+            return backups[0] if backups else None
+        name = Path(name).name
+        path = self.directory / (name if name.endswith('.jsonl.gz') else name + '.jsonl.gz')
+        return path if path.exists() else None
+
+    async def restore_user(self, user_id: int, path: Path) -> bool:
+        # Остальные пользователи и сама база не перечитываются
+        user = await asyncio.to_thread(read_user, path, str(user_id))
+        if user is None:
+            return False
+        self.db.restore_user(user_id, user)
+        self._restored += 1
+        logger.info("Пользователь %s восстановлен из %s", user_id, path.name)
+        return True
+
+    async def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    def stats(self) -> Dict:
+        return {
+            'backups': self._backups,
+            'restored_users': self._restored,
+            'copied_on_write': self.db.backup_stats()['copied_on_write'],
+            'last_seconds': self._last_time,
+            'last_bytes': self._last_size,
+            'last_users': self._last_users,
+        }
+
+
+def restore_json(backup_path: Path, json_path: Path) -> int:
+    # Полное восстановление в файл JSON-базы (бот должен быть остановлен).
+    # Журнал относится к заменяемому снимку и воспроизвёлся бы поверх копии
+    journal_path = json_path.with_name(json_path.name + '.journal')
+    if journal_path.exists():
+        raise SystemExit(f"Есть журнал {journal_path}: удалите его или перенесите перед восстановлением")
+    data = dict(iter_users(backup_path))
+    tmp_path = json_path.with_name(json_path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, json_path)
+    return len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Резервные копии базы планировщика")
+    commands = parser.add_subparsers(dest='command', required=True)
+    show = commands.add_parser('list', help="список копий")
+    show.add_argument('directory', type=Path, nargs='?', default=backup_dir(Path('planner_db.json')))
+    restore = commands.add_parser('restore', help="восстановить копию в planner_db.json")
+    restore.add_argument('backup_path', type=Path)
+    restore.add_argument('json_path', type=Path, nargs='?', default=Path('planner_db.json'))
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        for path in sorted(args.directory.glob('*.jsonl.gz'), reverse=True):
+            header = read_header(path)
+            print(f"{path.name}  {header['created']}  {path.stat().st_size} байт")
+    else:
+        count = restore_json(args.backup_path, args.json_path)
+        print(f"Восстановлено пользователей: {count}")
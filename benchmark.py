@@ -0,0 +1,402 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# Нагрузочный тест: синтетические апдейты проходят через настоящие dp и router
+# бота, а вместо Telegram отвечает заглушка сессии. Пишет отчёт в JSON, чтобы
+# сравнивать версии между собой (--baseline — сравнить с прошлым отчётом)
+
+CATEGORIES = ['Работа', 'Личное', 'Учёба', 'Здоровье', 'Покупки']
+
+
+def percentile(values: List[float], q: float) -> float:
+    # values уже отсортированы
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def latency_summary(values: List[float]) -> Dict:
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p95_ms': percentile(values, 0.95) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': (values[-1] if values else 0.0) * 1000,
+    }
+
+
+def configure_env(args: argparse.Namespace, workdir: Path):
+    # bot.py читает настройки при импорте, поэтому окружение готовим заранее
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+    os.environ['DB_BACKEND'] = args.backend
+    # Без --db-mode режим выбирает бот: для снимка — journal, иначе sync
+    os.environ['DB_MODE'] = args.db_mode or ''
+    os.environ['FSM_STORAGE'] = args.fsm
+    os.environ['SHARD_COUNT'] = '1'
+    # Сценарий жмёт кнопки быстрее человека: ограничение частоты нажатий снимаем
+    os.environ['FLOOD_RATE'] = '1000000'
+    os.environ['FLOOD_BURST'] = '1000000'
+    if not args.telegram_limits:
+        # Меряем бота, а не лимиты Telegram
+        for name in ('OUTBOX_GLOBAL_RATE', 'OUTBOX_CHAT_RATE', 'OUTBOX_CHAT_BURST'):
+            os.environ[name] = '1000000'
+    os.chdir(workdir)
+
+
+class Timed:
+    # Обёртка метода экземпляра: число вызовов и суммарное время
+    def __init__(self, obj: Any, name: str):
+        self.calls = 0
+        self.total = 0.0
+        original = getattr(obj, name)
+
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.calls += 1
+                self.total += time.perf_counter() - started
+
+        setattr(obj, name, wrapper)
+
+    def report(self) -> Dict:
+        return {'calls': self.calls, 'total_s': self.total,
+                'avg_ms': self.total / self.calls * 1000 if self.calls else 0.0}
+
+
+class Harness:
+    def __init__(self, bot_module, api_latency: float):
+        from aiogram.client.session.base import BaseSession
+        from aiogram.methods import EditMessageText, SendDocument, SendMessage
+        from aiogram.types import Chat, Message
+
+        self.B = bot_module
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.api_calls: Dict[str, int] = {}
+        self._update_ids = itertools.count(1)
+        # Последнее сообщение бота в каждом чате: к нему «нажимаются» кнопки
+        self.last_message: Dict[int, Any] = {}
+        harness = self
+
+        class FakeSession(BaseSession):
+            def __init__(self):
+                super().__init__()
+                self._message_ids = itertools.count(1)
+
+            async def make_request(self, bot, method, timeout=None):
+                name = type(method).__name__
+                harness.api_calls[name] = harness.api_calls.get(name, 0) + 1
+                if api_latency:
+                    await asyncio.sleep(api_latency)
+                if isinstance(method, (SendMessage, SendDocument)):
+                    message = Message(
+                        message_id=next(self._message_ids), date=datetime.now(),
+                        chat=Chat(id=method.chat_id, type='private'),
+                        text=getattr(method, 'text', None), reply_markup=method.reply_markup
+                    )
+                    harness.last_message[method.chat_id] = message
+                    return message
+                if isinstance(method, EditMessageText):
+                    message = Message(
+                        message_id=method.message_id, date=datetime.now(),
+                        chat=Chat(id=method.chat_id, type='private'),
+                        text=method.text, reply_markup=method.reply_markup
+                    )
+                    harness.last_message[method.chat_id] = message
+                    return message
+                return True
+
+            async def stream_content(self, *args, **kwargs):
+                if False:
+                    yield b''
+
+            async def close(self):
+                pass
+
+        self.B.bot.session = FakeSession()
+
+    async def _feed(self, action: str, update):
+        started = time.perf_counter()
+        try:
+            await self.B.dp.feed_update(self.B.bot, update)
+        except Exception:
+            self.errors[action] = self.errors.get(action, 0) + 1
+            logging.exception("Ошибка в сценарии %s", action)
+        self.latencies.setdefault(action, []).append(time.perf_counter() - started)
+
+    async def send(self, user_id: int, text: str, action: str):
+        from aiogram.types import Chat, Message, Update, User
+        message = Message(
+            message_id=next(self._update_ids), date=datetime.now(),
+            chat=Chat(id=user_id, type='private'),
+            from_user=User(id=user_id, is_bot=False, first_name='Bench'), text=text
+        )
+        await self._feed(action, Update(update_id=next(self._update_ids), message=message))
+
+    async def press(self, user_id: int, data: str, action: str):
+        from aiogram.types import CallbackQuery, Chat, Message, Update, User
+        message = self.last_message.get(user_id) or Message(
+            message_id=1, date=datetime.now(), chat=Chat(id=user_id, type='private'), text='.'
+        )
+        callback = CallbackQuery(
+            id=str(next(self._update_ids)), chat_instance=str(user_id), data=data, message=message,
+            from_user=User(id=user_id, is_bot=False, first_name='Bench')
+        )
+        await self._feed(action, Update(update_id=next(self._update_ids), callback_query=callback))
+
+
+async def user_session(h: Harness, user_id: int, tasks_per_user: int, notes_per_user: int):
+    # Типичный путь пользователя по меню
+    await h.send(user_id, '/start', 'start')
+    for i in range(tasks_per_user):
+        await h.press(user_id, 'add_task', 'add_task')
+        await h.send(user_id, f"Задача {i} пользователя {user_id}", 'add_task_title')
+        await h.press(user_id, f"newcat_{CATEGORIES[i % len(CATEGORIES)]}", 'add_task_category')
+    await h.press(user_id, 'view_tasks', 'view_tasks')
+    if tasks_per_user > h.B.PAGE_SIZE:
+        await h.press(user_id, 'tasks_page_1', 'view_tasks_page')
+    await h.press(user_id, 'task_1', 'task_detail')
+    await h.press(user_id, 'statistics', 'statistics')
+
+    for i in range(notes_per_user):
+        await h.press(user_id, 'add_note', 'add_note')
+        await h.send(user_id, f"Заметка {i}", 'add_note_text')
+    await h.press(user_id, 'notes_menu', 'notes_menu')
+
+    await h.press(user_id, 'categories', 'categories')
+    await h.press(user_id, f"filter_{CATEGORIES[0]}", 'filter_category')
+    await h.send(user_id, '/search задача', 'search')
+
+    for task_id in range(1, tasks_per_user + 1, 3):
+        await h.press(user_id, f"complete_{task_id}", 'complete_task')
+    await h.press(user_id, 'statistics', 'statistics')
+
+
+async def stress_double_taps(h: Harness, users: List[int], taps: int) -> Dict:
+    # Много пользователей одновременно, и каждый жмёт одну кнопку несколько раз подряд:
+    # задача должна выполниться ровно один раз, счётчики — сойтись. Окно повторов
+    # выключено, чтобы все нажатия доходили до обработчика и проверялись блокировки
+    B = h.B
+    for user_id in users:
+        B.db.add_task(user_id, {
+            'title': 'Двойное нажатие', 'created': datetime.now().isoformat(),
+            'completed': False, 'time': None, 'category': None
+        })
+    targets = {user_id: B.db.active_tasks(user_id)[-1]['id'] for user_id in users}
+    before = {user_id: B.db.completed_count(user_id) for user_id in users}
+    contended = B.user_locks.stats()['contended']
+    dropped = B.flood.stats()['dropped']
+
+    # Сколько обработчиков одного пользователя выполняется внутри блокировки
+    # одновременно: при исправной блокировке — не больше одного
+    active: Dict[int, int] = {}
+    max_active = 0
+    hold = B.user_locks.hold
+
+    @asynccontextmanager
+    async def probed_hold(user_id: int):
+        nonlocal max_active
+        async with hold(user_id):
+            active[user_id] = active.get(user_id, 0) + 1
+            max_active = max(max_active, active[user_id])
+            try:
+                yield
+            finally:
+                active[user_id] -= 1
+
+    B.user_locks.hold = probed_hold
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(
+            h.press(user_id, f"complete_{targets[user_id]}", 'stress_complete')
+            for user_id in users for _ in range(taps)
+        ))
+    finally:
+        del B.user_locks.hold
+    elapsed = time.perf_counter() - started
+
+    wrong = [user_id for user_id in users if B.db.completed_count(user_id) != before[user_id] + 1]
+    inconsistent = [user_id for user_id in users if not B.db.verify_stats(user_id, fix=False)]
+    return {
+        'users': len(users),
+        'taps_per_user': taps,
+        'elapsed_s': elapsed,
+        'updates_per_s': len(users) * taps / elapsed if elapsed else 0.0,
+        'contended_locks': B.user_locks.stats()['contended'] - contended,
+        'dropped_taps': B.flood.stats()['dropped'] - dropped,
+        'max_handlers_per_user': max_active,
+        'wrong_completions': len(wrong),
+        'inconsistent_stats': len(inconsistent),
+        'ok': not wrong and not inconsistent and max_active == 1,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    import bot as B
+
+    B.init_app()
+    h = Harness(B, args.api_latency / 1000)
+    persist_timer = Timed(B.db, '_persist')
+    B.setup_dispatcher()
+    await B.on_startup()
+
+    users = list(range(1_000_001, 1_000_001 + args.users))
+    # Одна кнопка нажимается подряд намеренно (add_task), а в стресс-сценарии
+    # повторы должна разводить блокировка пользователя, а не окно повторов
+    B.flood.duplicate_window = 0
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id: int):
+        async with slots:
+            await user_session(h, user_id, args.tasks, args.notes)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(user_id) for user_id in users))
+    elapsed = time.perf_counter() - started
+    updates = sum(len(values) for values in h.latencies.values())
+
+    stress = None
+    if args.stress_taps > 1:
+        stress = await stress_double_taps(h, users[:args.stress_users or len(users)], args.stress_taps)
+
+    await B.on_shutdown()
+    await B.dp.storage.close()
+
+    all_latencies = [value for action, values in h.latencies.items()
+                     if action != 'stress_complete' for value in values]
+    return {
+        'revision': git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'config': {
+            'users': args.users,
+            'tasks_per_user': args.tasks,
+            'notes_per_user': args.notes,
+            'concurrency': args.concurrency,
+            'backend': args.backend,
+            'db_mode': B.db.mode if args.backend != 'sqlite' else None,
+            'fsm': args.fsm,
+            'api_latency_ms': args.api_latency,
+            'telegram_limits': args.telegram_limits,
+        },
+        'elapsed_s': elapsed,
+        'updates': updates,
+        'throughput_updates_per_s': updates / elapsed if elapsed else 0.0,
+        'latency': latency_summary(all_latencies),
+        'actions': {action: latency_summary(values) for action, values in sorted(h.latencies.items())},
+        'errors': h.errors,
+        'api_calls': h.api_calls,
+        'db': {
+            # Перезаписи файла считает сама база: в write_behind и journal
+            # они идут из flush и compact в потоке, мимо _save
+            'io': B.db.io_stats(),
+            'persist': persist_timer.report(),
+            'flush': B.db.flush_stats(),
+        },
+        'outbox': B.outbox.stats(),
+        'render_cache': B.render_cache.stats(),
+        'skipped_edits': B.skipped_edits,
+        'user_locks': B.user_locks.stats(),
+        'flood': B.flood.stats(),
+        'stress': stress,
+    }
+
+
+def compare(report: Dict, baseline: Dict):
+    # Краткое сравнение с прошлым отчётом: + — стало больше
+    rows = [
+        ('throughput_updates_per_s', report['throughput_updates_per_s'], baseline['throughput_updates_per_s']),
+        ('latency p50_ms', report['latency']['p50_ms'], baseline['latency']['p50_ms']),
+        ('latency p95_ms', report['latency']['p95_ms'], baseline['latency']['p95_ms']),
+        ('latency p99_ms', report['latency']['p99_ms'], baseline['latency']['p99_ms']),
+        ('db write_seconds', report['db']['io']['write_seconds'],
+         baseline['db'].get('io', {}).get('write_seconds', 0.0)),
+    ]
+    print(f"\nСравнение с {baseline.get('revision') or 'baseline'}:")
+    for name, new, old in rows:
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"  {name:28} {old:12.3f} -> {new:12.3f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушкой Telegram Bot API")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--tasks', type=int, default=10, help="задач на пользователя")
+    parser.add_argument('--notes', type=int, default=3, help="заметок на пользователя")
+    parser.add_argument('--concurrency', type=int, default=20, help="сколько пользователей действуют одновременно")
+    parser.add_argument('--backend', choices=('json', 'snapshot', 'sqlite'), default='json')
+    parser.add_argument('--db-mode', choices=('sync', 'write_behind', 'journal'), default=None)
+    parser.add_argument('--fsm', choices=('sqlite', 'memory'), default='sqlite')
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа заглушки, мс")
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="не снимать лимиты очереди исходящих (OUTBOX_*)")
+    parser.add_argument('--stress-taps', type=int, default=2,
+                        help="нажатий одной кнопки на пользователя в стресс-сценарии (1 — без него)")
+    parser.add_argument('--stress-users', type=int, default=0, help="пользователей в стресс-сценарии (0 — все)")
+    parser.add_argument('--output', type=Path, default=Path('benchmark_results.json'))
+    parser.add_argument('--baseline', type=Path, help="прошлый отчёт для сравнения")
+    parser.add_argument('--keep-data', action='store_true', help="не удалять каталог с базой")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    output = args.output.resolve()
+    baseline = json.loads(args.baseline.read_text(encoding='utf-8')) if args.baseline else None
+
+    workdir = Path(tempfile.mkdtemp(prefix='planner_bench_'))
+    configure_env(args, workdir)
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    report = asyncio.run(run(args))
+
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(f"Апдейтов: {report['updates']} за {report['elapsed_s']:.2f} с "
+          f"({report['throughput_updates_per_s']:.0f}/с)")
+    latency = report['latency']
+    print(f"Задержка обработки: p50 {latency['p50_ms']:.2f} мс, p95 {latency['p95_ms']:.2f} мс, "
+          f"p99 {latency['p99_ms']:.2f} мс")
+    io = report['db']['io']
+    print(f"Запись базы: {io['writes']} перезаписей файла, {io['write_bytes']} байт, "
+          f"{io['write_seconds']:.3f} с; журнал {io['journal_bytes']} байт")
+    if report['stress'] is not None:
+        print(f"Двойные нажатия: {'ок' if report['stress']['ok'] else 'РАСХОЖДЕНИЯ'} {report['stress']}")
+    if report['errors']:
+        print(f"Ошибки: {report['errors']}")
+    print(f"Отчёт: {output}")
+    if baseline is not None:
+        compare(report, baseline)
+
+    if args.keep_data:
+        print(f"Данные: {workdir}")
+    else:
+        shutil.rmtree(workdir)
+    if report['errors'] or (report['stress'] is not None and not report['stress']['ok']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,173 @@
 import asyncio
-import json
+import csv
+import logging
 import os
+import tempfile
+import time
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.methods import SendDocument
+from aiogram.types import Message, CallbackQuery, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
 
+from backup import BackupJob, backup_dir
+from database import Database, MODE_JOURNAL, MODE_SYNC, user_today
+from digest import DigestJob, format_digest
+from flood_control import FloodControl, FloodControlMiddleware
+from fsm_storage import SqliteStorage
+from metrics import (
+    HandlerMetricsMiddleware, Metrics, SamplingProfiler, UpdateMetricsMiddleware, start_metrics_server
+)
+from recurrence import current_due, describe as describe_repeat, first_due, next_due, parse_rule
+from reminders import ReminderScheduler, parse_time, task_remind_at
+from outbound import OutboundQueue, PRIORITY_BULK
+from render_cache import RenderCache
+from user_locks import UserLockMiddleware, UserLocks
+from shards import WORKER_PATH, shard_path
+from transfer import FORMATS as EXPORT_FORMATS, export_records, import_file, write_export
+from webhook import run_webhook, serve_updates
+from snapshot_database import SnapshotDatabase
+from sqlite_database import SqliteDatabase
+
 load_dotenv()
 
-# Инициализация бота
-bot = Bot(token=os.getenv('BOT_TOKEN'))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# Получение обновлений: polling или webhook (worker — процесс, запущенный shards.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Многопроцессный режим (процессы запускает shards.py): номер шарда этого
+# процесса, число шардов, порт и секрет для приёма апдейтов от фронтального процесса.
+# Номер и число шардов shards.py передаёт только воркерам: обычный запуск
+# всегда работает с несегментированными файлами
+IS_WORKER = BOT_MODE == 'worker'
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0')) if IS_WORKER else 0
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1')) if IS_WORKER else 1
+WORKER_PORT = int(os.getenv('WORKER_PORT', '8100'))
+SHARD_SECRET = os.getenv('SHARD_SECRET') or None
+
+
+def shard_file(path: Path) -> Path:
+    # У каждого воркера свои файлы базы и состояний диалогов
+    return shard_path(path, SHARD_INDEX) if SHARD_COUNT > 1 else path
+
+
+# Хранилище состояний диалогов: sqlite (переживает перезапуск) или memory
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_PATH = shard_file(Path(os.getenv('FSM_PATH', 'planner_fsm.sqlite3')))
+
+# Через сколько секунд брошенный диалог сбрасывается, как часто писать
+# изменения на диск и сколько записей держать в кэше
+FSM_TTL = int(os.getenv('FSM_TTL', '86400'))
+FSM_FLUSH_INTERVAL_MS = int(os.getenv('FSM_FLUSH_INTERVAL_MS', '500'))
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))
+
+# Бот, диспетчер, хранилища и очередь исходящих создаются в init_app(), а не
+# при импорте: импорт модуля не открывает файлы и не читает базу
+bot: Optional[Bot] = None
+storage = None
+dp: Optional[Dispatcher] = None
+db: Optional[Database] = None
+outbox: Optional[OutboundQueue] = None
+backups: Optional[BackupJob] = None
 router = Router()
 
+# Сбрасывать ли накопившиеся за время остановки апдейты при запуске
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', '1') == '1'
+
+# Вебхук: публичный адрес (без пути), путь, адрес для прослушивания, секрет,
+# предел одновременно обрабатываемых апдейтов и время на их завершение при остановке
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100'))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', '10'))
+
+# Хранилище: json (planner_db.json), snapshot (бинарный снимок с индексом,
+# пользователи читаются с диска по мере обращения) или sqlite
+DB_BACKEND = os.getenv('DB_BACKEND', 'json')
+
 # Путь к базе данных
-DB_PATH = Path('planner_db.json')
+DB_PATH = shard_file(Path('planner_db.json'))
+DB_SQLITE_PATH = shard_file(Path(os.getenv('DB_SQLITE_PATH', 'planner_db.sqlite3')))
+DB_SNAPSHOT_PATH = shard_file(Path(os.getenv('DB_SNAPSHOT_PATH', 'planner_db.snap')))
+
+# Сколько задач и заметок показывать на одной странице списка
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '10'))
+
+# Больше Telegram не даёт скачать боту
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+
+# Сколько результатов поиска показывать
+SEARCH_RESULTS = int(os.getenv('SEARCH_RESULTS', '20'))
+
+# Сколько пользователей (и суммарно задач и заметок) держать в памяти; 0 — без ограничения.
+# Только для sqlite и snapshot: JSON-база всегда загружается в память целиком
+DB_CACHE_USERS = int(os.getenv('DB_CACHE_USERS', '0'))
+DB_CACHE_ITEMS = int(os.getenv('DB_CACHE_ITEMS', '0'))
+
+# Режим хранения: sync, write_behind или journal (снимок — только последние два)
+DB_MODE = os.getenv('DB_MODE') or (MODE_JOURNAL if DB_BACKEND == 'snapshot' else MODE_SYNC)
+
+# Отложенная запись базы: максимальное окно потери данных и порог изменений
+DB_FLUSH_INTERVAL_MS = int(os.getenv('DB_FLUSH_INTERVAL_MS', '1000'))
+DB_FLUSH_MAX_CHANGES = int(os.getenv('DB_FLUSH_MAX_CHANGES', '100'))
+
+# Журнал: как часто сворачивать его в снимок и нужен ли fsync каждой записи
+DB_COMPACT_INTERVAL = int(os.getenv('DB_COMPACT_INTERVAL', '300'))
+DB_COMPACT_RECORDS = int(os.getenv('DB_COMPACT_RECORDS', '10000'))
+DB_JOURNAL_FSYNC = os.getenv('DB_JOURNAL_FSYNC', '0') == '1'
+
+# Через сколько дней выполненные задачи уходят в архив (0 — не архивировать)
+# и как часто проверять (в секундах)
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', '0'))
+ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', '3600'))
+
+# Резервные копии базы: как часто (в секундах, 0 — только командой /backup),
+# сколько последних хранить и где (по умолчанию planner_db.backups/ рядом с базой)
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL', '0'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_DIR = os.getenv('BACKUP_DIR') or None
+
+# Пользователи, которым доступны /backup и /restore
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+# Утренняя сводка задач: в котором часу по местному времени пользователя
+# её отправлять и по сколько сводок передавать в очередь исходящих за раз
+DIGEST_HOUR = int(os.getenv('DIGEST_HOUR', '8'))
+DIGEST_BATCH = int(os.getenv('DIGEST_BATCH', '100'))
+
+# Защита от частых нажатий: повтор той же кнопки в течение DUPLICATE_WINDOW_MS мс
+# отбрасывается, остальные нажатия — не более FLOOD_BURST подряд и FLOOD_RATE в секунду
+DUPLICATE_WINDOW_MS = int(os.getenv('DUPLICATE_WINDOW_MS', '1000'))
+FLOOD_RATE = float(os.getenv('FLOOD_RATE', '2'))
+FLOOD_BURST = int(os.getenv('FLOOD_BURST', '5'))
+
+# Исходящие сообщения: общий лимит и лимит на чат (сообщений в секунду),
+# допустимая серия сообщений в один чат и число воркеров
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30'))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))
+OUTBOX_CHAT_BURST = float(os.getenv('OUTBOX_CHAT_BURST', '3'))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+
+# Сколько отрисованных экранов держать в кэше
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '10000'))
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics
+# (0 — не запускать; воркер шарда N слушает METRICS_PORT + N) и порог, после
+# которого апдейт попадает в лог как медленный
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+SLOW_UPDATE_MS = int(os.getenv('SLOW_UPDATE_MS', '500'))
 
 
 # FSM состояния
@@ -34,52 +179,130 @@ class TaskStates(StatesGroup):
     waiting_time = State()
     waiting_note = State()
     waiting_new_category = State()
+    waiting_search = State()
+    waiting_import = State()
+    waiting_repeat = State()
+
+
+def open_database() -> Database:
+    if DB_BACKEND == 'sqlite':
+        return SqliteDatabase(
+            DB_SQLITE_PATH,
+            cache_users=DB_CACHE_USERS,
+            cache_items=DB_CACHE_ITEMS,
+            archive_after=ARCHIVE_AFTER_DAYS * 86400,
+            archive_interval=ARCHIVE_INTERVAL
+        )
+    if DB_BACKEND == 'snapshot':
+        db_class, path = SnapshotDatabase, DB_SNAPSHOT_PATH
+        options = {'cache_users': DB_CACHE_USERS, 'cache_items': DB_CACHE_ITEMS}
+    else:
+        db_class, path, options = Database, DB_PATH, {}
+        if DB_CACHE_USERS or DB_CACHE_ITEMS:
+            logging.warning("DB_CACHE_USERS и DB_CACHE_ITEMS не действуют при DB_BACKEND=json: "
+                            "база целиком держится в памяти (ограничение есть у sqlite и snapshot)")
+    return db_class(
+        path,
+        mode=DB_MODE,
+        **options,
+        flush_interval=DB_FLUSH_INTERVAL_MS / 1000,
+        flush_max_changes=DB_FLUSH_MAX_CHANGES,
+        compact_interval=DB_COMPACT_INTERVAL,
+        compact_records=DB_COMPACT_RECORDS,
+        journal_fsync=DB_JOURNAL_FSYNC,
+        archive_after=ARCHIVE_AFTER_DAYS * 86400,
+        archive_interval=ARCHIVE_INTERVAL
+    )
 
 
-# Класс для работы с базой данных
-class Database:
-    def __init__(self, path: Path):
-        self.path = path
-        self.data = self._load()
+def init_app():
+    global bot, storage, dp, db, outbox, backups
+    bot = Bot(token=os.getenv('BOT_TOKEN'))
+    if FSM_STORAGE == 'sqlite':
+        storage = SqliteStorage(
+            FSM_PATH,
+            ttl=FSM_TTL,
+            flush_interval=FSM_FLUSH_INTERVAL_MS / 1000,
+            cache_size=FSM_CACHE_SIZE
+        )
+    else:
+        storage = MemoryStorage()
+    dp = Dispatcher(storage=storage)
+    db = open_database()
+    backups = BackupJob(
+        db,
+        shard_file(Path(BACKUP_DIR)) if BACKUP_DIR else backup_dir(db.path),
+        interval=BACKUP_INTERVAL,
+        keep=BACKUP_KEEP
+    )
+    outbox = OutboundQueue(
+        bot,
+        # Общий лимит Telegram делится между воркерами
+        global_rate=OUTBOX_GLOBAL_RATE / SHARD_COUNT,
+        chat_rate=OUTBOX_CHAT_RATE,
+        chat_burst=OUTBOX_CHAT_BURST,
+        workers=OUTBOX_WORKERS
+    )
 
-    def _load(self) -> Dict:
-        if self.path.exists():
-            with open(self.path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return {}
 
-    def _save(self):
-        with open(self.path, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+user_locks = UserLocks()
+flood = FloodControl(FLOOD_RATE, FLOOD_BURST, DUPLICATE_WINDOW_MS / 1000)
+skipped_edits = 0
 
-    def get_user(self, user_id: int) -> Dict:
-        user_id_str = str(user_id)
-        if user_id_str not in self.data:
-            self.data[user_id_str] = {
-                'tasks': [],
-                'notes': [],
-                'categories': ['Работа', 'Личное', 'Учёба', 'Здоровье', 'Покупки'],
-                'settings': {
-                    'notifications': True,
-                    'timezone': 0
-                }
-            }
-            self._save()
-        return self.data[user_id_str]
 
-    def save(self):
-        self._save()
+def user_size(user_id: int) -> int:
+    # Для журнала медленных апдейтов: пользователя не создаём
+    user = db.find_user(user_id)
+    return len(user['tasks']) + len(user['notes']) if user is not None else 0
 
 
-db = Database(DB_PATH)
+metrics = Metrics(slow_threshold=SLOW_UPDATE_MS / 1000, user_size=user_size)
+profiler = SamplingProfiler()
+metrics_runner = None
 
 
 # Вспомогательные функции
+def render_cached(user_id: int, key, render):
+    # Экран пересобирается, только если данные пользователя изменились
+    return render_cache.get_or_render(user_id, key, db.version(user_id), render)
+
+
+def same_markup(current: Optional[InlineKeyboardMarkup], new: Optional[InlineKeyboardMarkup]) -> bool:
+    # Разметка из апдейта приходит с лишними пустыми полями, сравниваем только заданные
+    if current is None or new is None:
+        return current is new
+    return current.model_dump(exclude_none=True) == new.model_dump(exclude_none=True)
+
+
+async def safe_edit(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    # Не отправляем запрос, если сообщение уже показывает то же самое.
+    # Telegram хранит текст без пробелов и переводов строк по краям
+    global skipped_edits
+    if message.text == text.strip() and same_markup(message.reply_markup, reply_markup):
+        skipped_edits += 1
+        return
+    try:
+        await outbox.edit_message_text(message.chat.id, message.message_id, text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if 'message is not modified' not in str(e):
+            raise
+        skipped_edits += 1
+
+
+async def answer(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> Message:
+    # Ответы пользователю идут через общую очередь исходящих с высшим приоритетом
+    return await outbox.send_message(message.chat.id, text, reply_markup=reply_markup)
+
+
+# Статичные клавиатуры собираются один раз и переиспользуются
+@lru_cache(maxsize=None)
 def get_main_keyboard() -> InlineKeyboardMarkup:
     buttons = [
         [InlineKeyboardButton(text="➕ Добавить задачу", callback_data="add_task")],
         [InlineKeyboardButton(text="📋 Мои задачи", callback_data="view_tasks")],
         [InlineKeyboardButton(text="📝 Заметки", callback_data="notes_menu")],
+        [InlineKeyboardButton(text="🔍 Поиск", callback_data="search")],
         [InlineKeyboardButton(text="📊 Статистика", callback_data="statistics")],
         [InlineKeyboardButton(text="🗂 Категории", callback_data="categories")],
         [InlineKeyboardButton(text="⚙️ Настройки", callback_data="settings")]
@@ -87,26 +310,45 @@ def get_main_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+@lru_cache(maxsize=None)
 def get_back_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="◀️ Назад", callback_data="main_menu")]
     ])
 
 
-def get_tasks_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    user = db.get_user(user_id)
+def page_count(total: int) -> int:
+    return max(1, -(-total // PAGE_SIZE))
+
+
+def clamp_page(page: int, total: int) -> int:
+    return min(max(page, 0), page_count(total) - 1)
+
+
+def get_page_nav(prefix: str, page: int, total: int) -> List[InlineKeyboardButton]:
+    # Кнопки листания; номер страницы передаётся в callback_data
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton(text="◀️", callback_data=f"{prefix}{page - 1}"))
+    if page < page_count(total) - 1:
+        row.append(InlineKeyboardButton(text="▶️", callback_data=f"{prefix}{page + 1}"))
+    return row
+
+
+def get_tasks_keyboard(user_id: int, tasks: List[Dict], page: int, total: int) -> InlineKeyboardMarkup:
     buttons = []
     
-    today_tasks = [t for t in user['tasks'] if not t.get('completed', False)]
-    
-    for idx, task in enumerate(today_tasks[:10]):
-        status = "🔴"  # Красный кружок для активных задач
+    for task in tasks:
+        status = "🔁" if task.get('repeat') else "🔴"  # Красный кружок для активных задач
         time_str = f"{task['time']} - " if task.get('time') else ""
         buttons.append([InlineKeyboardButton(
             text=f"{status} {time_str}{task['title'][:30]}",
-            callback_data=f"task_{idx}"
+            callback_data=f"task_{task['id']}"
         )])
     
+    nav = get_page_nav("tasks_page_", page, total)
+    if nav:
+        buttons.append(nav)
     buttons.append([
         InlineKeyboardButton(text="🗑 Очистить выполненные", callback_data="clear_completed")
     ])
@@ -115,21 +357,35 @@ def get_tasks_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def get_task_detail_keyboard(task_idx: int) -> InlineKeyboardMarkup:
+def get_task_detail_keyboard(task_id: int) -> InlineKeyboardMarkup:
     buttons = [
-        [InlineKeyboardButton(text="✅ Выполнить", callback_data=f"complete_{task_idx}")],
-        [InlineKeyboardButton(text="✏️ Изменить", callback_data=f"edit_{task_idx}")],
-        [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_{task_idx}")],
+        [InlineKeyboardButton(text="✅ Выполнить", callback_data=f"complete_{task_id}")],
+        [InlineKeyboardButton(text="✏️ Изменить", callback_data=f"edit_{task_id}")],
+        [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_{task_id}")],
         [InlineKeyboardButton(text="◀️ К задачам", callback_data="view_tasks")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def get_edit_keyboard(task_idx: int) -> InlineKeyboardMarkup:
+def get_edit_keyboard(task_id: int) -> InlineKeyboardMarkup:
     buttons = [
-        [InlineKeyboardButton(text="📝 Изменить название", callback_data=f"edit_title_{task_idx}")],
-        [InlineKeyboardButton(text="🏷 Изменить категорию", callback_data=f"edit_cat_{task_idx}")],
-        [InlineKeyboardButton(text="◀️ Назад к задаче", callback_data=f"task_{task_idx}")]
+        [InlineKeyboardButton(text="📝 Изменить название", callback_data=f"edit_title_{task_id}")],
+        [InlineKeyboardButton(text="🏷 Изменить категорию", callback_data=f"edit_cat_{task_id}")],
+        [InlineKeyboardButton(text="⏰ Изменить время", callback_data=f"edit_time_{task_id}")],
+        [InlineKeyboardButton(text="🔁 Повтор", callback_data=f"edit_repeat_{task_id}")],
+        [InlineKeyboardButton(text="◀️ Назад к задаче", callback_data=f"task_{task_id}")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def get_repeat_keyboard(task_id: int) -> InlineKeyboardMarkup:
+    buttons = [
+        [InlineKeyboardButton(text="Каждый день", callback_data="repeat_day"),
+         InlineKeyboardButton(text="По будням", callback_data="repeat_weekdays")],
+        [InlineKeyboardButton(text="Каждую неделю", callback_data="repeat_week"),
+         InlineKeyboardButton(text="Каждый месяц", callback_data="repeat_month")],
+        [InlineKeyboardButton(text="🚫 Не повторять", callback_data="repeat_none")],
+        [InlineKeyboardButton(text="◀️ Отмена", callback_data=f"task_{task_id}")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
@@ -151,10 +407,11 @@ def get_category_selection_keyboard(user_id: int, action_prefix: str) -> InlineK
 
 def get_categories_keyboard(user_id: int) -> InlineKeyboardMarkup:
     user = db.get_user(user_id)
+    counts = db.category_counts(user_id)
     buttons = []
     
     for cat in user['categories']:
-        count = sum(1 for t in user['tasks'] if t.get('category') == cat and not t.get('completed'))
+        count = counts.get(cat, 0)
         buttons.append([
             InlineKeyboardButton(text=f"{cat} ({count})", callback_data=f"filter_{cat}"),
             InlineKeyboardButton(text="🗑", callback_data=f"delcat_{cat}")
@@ -165,17 +422,22 @@ def get_categories_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def get_notes_keyboard(user_id: int) -> InlineKeyboardMarkup:
-    user = db.get_user(user_id)
+def get_notes_keyboard(user_id: int, page: int = 0) -> InlineKeyboardMarkup:
+    notes = db.get_user(user_id)['notes']
+    page = clamp_page(page, len(notes))
+    start = page * PAGE_SIZE
     buttons = []
     
-    for idx, note in enumerate(user['notes'][:10]):
+    for idx, note in enumerate(notes[start:start + PAGE_SIZE], start):
         preview = note['text'][:40] + "..." if len(note['text']) > 40 else note['text']
         buttons.append([InlineKeyboardButton(
             text=f"📄 {preview}",
             callback_data=f"note_{idx}"
         )])
     
+    nav = get_page_nav("notes_page_", page, len(notes))
+    if nav:
+        buttons.append(nav)
     buttons.append([InlineKeyboardButton(text="➕ Добавить заметку", callback_data="add_note")])
     buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="main_menu")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -184,10 +446,30 @@ def get_notes_keyboard(user_id: int) -> InlineKeyboardMarkup:
 def get_note_detail_keyboard(note_idx: int) -> InlineKeyboardMarkup:
     buttons = [
         [InlineKeyboardButton(text="🗑 Удалить заметку", callback_data=f"delnote_{note_idx}")],
-        [InlineKeyboardButton(text="◀️ К заметкам", callback_data="notes_menu")]
+        [InlineKeyboardButton(text="◀️ К заметкам", callback_data=f"notes_page_{note_idx // PAGE_SIZE}")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+
+def get_search_keyboard(user_id: int, task_ids: List[int], note_positions: List[int]) -> InlineKeyboardMarkup:
+    buttons = []
+    notes = db.get_user(user_id)['notes']
+    
+    for task_id in task_ids[:SEARCH_RESULTS]:
+        task = db.get_active_task(user_id, task_id)
+        buttons.append([InlineKeyboardButton(text=f"🔴 {task['title'][:30]}", callback_data=f"task_{task_id}")])
+    
+    for idx in note_positions[:max(0, SEARCH_RESULTS - len(task_ids))]:
+        text = notes[idx]['text']
+        preview = text[:40] + "..." if len(text) > 40 else text
+        buttons.append([InlineKeyboardButton(text=f"📄 {preview}", callback_data=f"note_{idx}")])
+    
+    buttons.append([InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search")])
+    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@lru_cache(maxsize=None)
 def get_timezone_keyboard() -> InlineKeyboardMarkup:
     buttons = []
     timezones = [
@@ -215,72 +497,267 @@ def get_timezone_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def format_tasks_list(tasks: List[Dict], title: str = "Ваши задачи") -> str:
-    if not tasks:
+def format_tasks_list(active_tasks: List[Dict], completed_count: int, title: str = "Ваши задачи",
+                      page: int = 0, total: int = 0, today: Optional[str] = None) -> str:
+    # active_tasks — только задачи видимой страницы, total — число активных задач всего;
+    # today (дата пользователя) нужна для сроков повторяющихся задач
+    if not active_tasks and not completed_count:
         return f"📋 {title}\n\nЗадач пока нет."
     
-    text = f"📋 {title}\n\n"
-    active_tasks = [t for t in tasks if not t.get('completed')]
+    lines = [f"📋 {title}\n"]
     
     for task in active_tasks:
         time_str = f"⏰ {task['time']} | " if task.get('time') else ""
         cat_str = f"🏷 {task['category']} | " if task.get('category') else ""
         created = datetime.fromisoformat(task['created']).strftime('%d.%m')
         
-        text += f"▪️ {task['title']}\n"
-        text += f"   {time_str}{cat_str}создано: {created}\n\n"
+        lines.append(f"▪️ {task['title']}")
+        if task.get('repeat'):
+            lines.append(f"   🔁 {describe_repeat(task['repeat'])} | {format_due(task, today)}")
+        lines.append(f"   {time_str}{cat_str}создано: {created}\n")
     
-    completed_tasks = [t for t in tasks if t.get('completed')]
-    if completed_tasks:
-        text += f"\n✅ Выполнено: {len(completed_tasks)}"
+    pages = page_count(total)
+    if pages > 1:
+        lines.append(f"📄 Страница {page + 1} из {pages}")
     
-    return text
+    if completed_count:
+        lines.append(f"\n✅ Выполнено: {completed_count}")
+    
+    return "\n".join(lines)
+
+
+def format_due(task: Dict, today: str) -> str:
+    due = current_due(task['repeat'], task['due'], today)
+    if due == today:
+        return "сегодня"
+    return f"{'просрочено' if due < today else 'следующий'}: {datetime.fromisoformat(due).strftime('%d.%m')}"
 
 
 def get_statistics(user_id: int) -> str:
-    user = db.get_user(user_id)
-    tasks = user['tasks']
+    stats = db.task_stats(user_id)
     
-    total = len(tasks)
-    completed = sum(1 for t in tasks if t.get('completed'))
+    total = stats['total']
+    completed = stats['completed']
     active = total - completed
-    
-    today = datetime.now().date()
-    today_tasks = [t for t in tasks 
-                   if datetime.fromisoformat(t['created']).date() == today]
-    today_completed = sum(1 for t in today_tasks if t.get('completed'))
-    
-    categories_stats = {}
-    for task in tasks:
-        cat = task.get('category', 'Без категории')
-        if cat not in categories_stats:
-            categories_stats[cat] = {'total': 0, 'completed': 0}
-        categories_stats[cat]['total'] += 1
-        if task.get('completed'):
-            categories_stats[cat]['completed'] += 1
+    categories_stats = stats['categories']
     
     text = "📊 **Статистика**\n\n"
     text += f"📌 Всего задач: {total}\n"
     text += f"✅ Выполнено: {completed}\n"
     text += f"🔴 Активных: {active}\n\n"
     
+    if stats['recurring'] or stats['repeats']:
+        text += f"🔁 Повторяющихся: {stats['recurring']}, выполнено повторов: {stats['repeats']}\n\n"
+    
     if total > 0:
         completion_rate = (completed / total) * 100
         text += f"📈 Процент выполнения: {completion_rate:.1f}%\n\n"
     
     text += f"📅 Сегодня:\n"
-    text += f"   Создано: {len(today_tasks)}\n"
-    text += f"   Выполнено: {today_completed}\n\n"
+    text += f"   Создано: {stats['day_created']}\n"
+    text += f"   Выполнено: {stats['day_completed']}\n\n"
     
     if categories_stats:
         text += "📊 По категориям:\n"
-        for cat, stats in categories_stats.items():
-            text += f"   • {cat}: {stats['completed']}/{stats['total']}\n"
+        for cat, cat_stats in categories_stats.items():
+            text += f"   • {cat}: {cat_stats['completed']}/{cat_stats['total']}\n"
+    
+    archived = db.archived_count(user_id)
+    if archived:
+        text += f"\n🗄 В архиве: {archived}\n"
     
     return text
 
 
+def get_statistics_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    buttons = []
+    if db.archived_count(user_id):
+        buttons.append([InlineKeyboardButton(text="🗄 Архив выполненных", callback_data="archive")])
+    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def get_archive_screen(user_id: int, page: int):
+    total = db.archived_count(user_id)
+    page = clamp_page(page, total)
+    start = page * PAGE_SIZE
+    # Из архива читаются только сегменты, нужные для этой страницы
+    tasks = db.archived_tasks(user_id, start, start + PAGE_SIZE)
+    
+    lines = [f"🗄 **Архив выполненных задач** ({total})", ""]
+    for task in tasks:
+        done = task.get('completed_at') or task['created']
+        lines.append(f"✅ {datetime.fromisoformat(done).strftime('%d.%m.%Y')} — {task['title']}")
+    if page_count(total) > 1:
+        lines.append(f"\nСтраница {page + 1} из {page_count(total)}")
+    
+    buttons = []
+    nav = get_page_nav("archive_page_", page, total)
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text="◀️ К статистике", callback_data="statistics")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+async def send_reminder(user_id_str: str, task_id: int, remind_at: str):
+    user_id = int(user_id_str)
+    task = db.get_active_task(user_id, task_id)
+    # Задачу могли выполнить, удалить или перенести, пока напоминание ждало в очереди
+    if task is None or task.get('remind_at') != remind_at:
+        return
+    if task.get('repeat'):
+        # Следующий повтор напомнит о себе сам, даже если этот не выполнен
+        next_remind_at = task_remind_at(task, db.get_user(user_id))
+        db.update_task(user_id, task_id, remind_at=next_remind_at)
+        reminders.schedule(user_id, task_id, next_remind_at)
+    else:
+        db.update_task(user_id, task_id, remind_at=None)
+    if not db.get_user(user_id)['settings']['notifications']:
+        return
+    # Не ждём отправки: напоминания уходят в порядке очереди после ответов пользователям
+    outbox.send_message(
+        user_id,
+        f"⏰ Напоминание: {task['title']}",
+        priority=PRIORITY_BULK,
+        reply_markup=get_task_detail_keyboard(task_id)
+    )
+
+
+reminders = ReminderScheduler(send_reminder)
+
+
+def render_digest(user_id_str: str) -> Optional[str]:
+    # Невыполненные задачи; повторяющиеся — только если срок повтора уже наступил
+    user_id = int(user_id_str)
+    today = user_today(db.get_user(user_id))
+    tasks = [
+        task for task in db.active_tasks(user_id)
+        if not task.get('repeat') or current_due(task['repeat'], task['due'], today) <= today
+    ]
+    return format_digest(tasks, today)
+
+
+async def send_digests(batch: List[Tuple[int, str]]):
+    # Ждём, пока пачка уйдёт: следующая собирается после неё
+    futures = [
+        outbox.send_message(user_id, text, priority=PRIORITY_BULK, reply_markup=get_main_keyboard())
+        for user_id, text in batch
+    ]
+    await asyncio.gather(*futures, return_exceptions=True)
+
+
+digest = DigestJob(
+    lambda tz: db.digest_users(tz),
+    render_digest,
+    send_digests,
+    hour=DIGEST_HOUR,
+    batch_size=DIGEST_BATCH
+)
+
+
+def reschedule_reminders(user_id: int):
+    # После смены часового пояса напоминания переносятся на то же местное время
+    user = db.get_user(user_id)
+    for task in db.active_tasks(user_id):
+        if task.get('remind_at') and task.get('time'):
+            remind_at = task_remind_at(task, user)
+            db.update_task(user_id, task['id'], remind_at=remind_at)
+            reminders.schedule(user_id, task['id'], remind_at)
+
+
+def complete_repeat(user_id: int, task: Dict):
+    # Выполненный повтор сохраняется отдельной выполненной задачей, а сама
+    # повторяющаяся задача переходит на срок следующего повтора
+    user = db.get_user(user_id)
+    now = datetime.now().isoformat()
+    due = current_due(task['repeat'], task['due'], user_today(user))
+    done = {
+        'title': task['title'],
+        'created': now,
+        'completed': True,
+        'completed_at': now,
+        'time': task.get('time'),
+        'category': task.get('category'),
+        'repeat_of': task['id'],
+        'due': due
+    }
+    fields = {'due': next_due(task['repeat'], due)}
+    if task.get('time'):
+        fields['remind_at'] = task_remind_at({**task, **fields}, user)
+    db.repeat_task(user_id, task['id'], done, **fields)
+    if task.get('time'):
+        reminders.schedule(user_id, task['id'], fields['remind_at'])
+
+
+def set_repeat(user_id: int, task_id: int, rule: Optional[Dict]) -> Optional[str]:
+    task = db.get_active_task(user_id, task_id)
+    if task is None:
+        return None
+    user = db.get_user(user_id)
+    if rule is None:
+        fields = {'repeat': None, 'due': None}
+    else:
+        fields = {'repeat': rule, 'due': first_due(rule, user_today(user))}
+    if task.get('time'):
+        fields['remind_at'] = task_remind_at({**task, **fields}, user)
+    db.update_task(user_id, task_id, **fields)
+    if task.get('time'):
+        reminders.schedule(user_id, task_id, fields['remind_at'])
+    
+    if rule is None:
+        return "✅ Задача больше не повторяется"
+    due = datetime.fromisoformat(fields['due']).strftime('%d.%m')
+    return f"✅ Повтор: {describe_repeat(rule)}\n\nБлижайший: {due}"
+
+
 # Обработчики команд
+@router.message(Command("recount"))
+async def cmd_recount(message: Message):
+    # Сверка накопленной статистики с самими задачами
+    if db.verify_stats(message.from_user.id):
+        await answer(message, "✅ Статистика в порядке")
+    else:
+        await answer(message, "🔧 Статистика пересчитана", reply_markup=get_main_keyboard())
+
+
+@router.message(Command("backup"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_backup(message: Message):
+    path = await backups.backup()
+    stats = backups.stats()
+    await answer(
+        message,
+        f"💾 Резервная копия {path.name.split('.')[0]}: пользователей {stats['last_users']}, "
+        f"{stats['last_bytes'] // 1024} КБ за {stats['last_seconds']:.1f} с"
+    )
+
+
+@router.message(Command("restore"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_restore(message: Message):
+    # /restore <id пользователя> [копия] — по умолчанию из последней копии
+    args = message.text.split()[1:]
+    if not args or not args[0].isdigit():
+        names = [path.name.split('.')[0] for path in backups.backups()]
+        text = "Использование: /restore <id пользователя> [копия]\n\n"
+        text += "Копии:\n" + "\n".join(names) if names else "Копий пока нет"
+        await answer(message, text)
+        return
+    
+    user_id = int(args[0])
+    path = backups.find(args[1] if len(args) > 1 else None)
+    if path is None:
+        await answer(message, "❌ Копия не найдена")
+        return
+    if not await backups.restore_user(user_id, path):
+        await answer(message, f"❌ В копии {path.name.split('.')[0]} нет пользователя {user_id}")
+        return
+    
+    # Напоминания восстановленных задач ставим заново; старые отбросятся сами
+    for task in db.active_tasks(user_id):
+        if task.get('remind_at'):
+            reminders.schedule(user_id, task['id'], task['remind_at'])
+    await answer(message, f"✅ Пользователь {user_id} восстановлен из копии {path.name.split('.')[0]}")
+
+
 @router.message(Command("start"))
 async def cmd_start(message: Message):
     user = db.get_user(message.from_user.id)
@@ -291,19 +768,137 @@ async def cmd_start(message: Message):
         "Выбери действие из меню ниже:"
     )
     
-    await message.answer(welcome_text, reply_markup=get_main_keyboard())
+    await answer(message, welcome_text, reply_markup=get_main_keyboard())
+
+
+async def run_search(message: Message, user_id: int, query: str):
+    started = time.perf_counter()
+    task_ids, note_positions = db.search_index(user_id).search(query)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logging.debug("Поиск %r у %s: %d задач, %d заметок за %.2f мс",
+                 query, user_id, len(task_ids), len(note_positions), elapsed_ms)
+    
+    if not task_ids and not note_positions:
+        text = f"🔍 По запросу «{query}» ничего не найдено"
+    else:
+        text = (
+            f"🔍 Результаты по запросу «{query}»\n\n"
+            f"Задач: {len(task_ids)}, заметок: {len(note_positions)}"
+        )
+        if len(task_ids) + len(note_positions) > SEARCH_RESULTS:
+            text += f"\nПоказаны первые {SEARCH_RESULTS}"
+    
+    await answer(message, text, reply_markup=get_search_keyboard(user_id, task_ids, note_positions))
+
+
+def temp_path(suffix: str) -> Path:
+    fd, name = tempfile.mkstemp(prefix='planner_', suffix=suffix)
+    os.close(fd)
+    return Path(name)
+
+
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    fmt = message.text.partition(" ")[2].strip().lower() or 'jsonl'
+    if fmt not in EXPORT_FORMATS:
+        await answer(message, "❌ Формат выгрузки: /export jsonl или /export csv")
+        return
+    
+    user_id = message.from_user.id
+    path = temp_path(f".{fmt}")
+    try:
+        count = await write_export(export_records(db, user_id), path, fmt)
+        # Файл читается с диска частями при отправке
+        await outbox.submit(SendDocument(
+            chat_id=message.chat.id,
+            document=FSInputFile(path, filename=f"planner_{user_id}.{fmt}"),
+            caption=f"📤 Выгружено записей: {count}"
+        ))
+    finally:
+        path.unlink(missing_ok=True)
+
+
+@router.message(Command("import"))
+async def cmd_import(message: Message, state: FSMContext):
+    await answer(
+        message,
+        "📥 Отправьте файл .jsonl или .csv в формате /export — задачи и заметки из него "
+        "добавятся к текущим",
+        reply_markup=get_back_keyboard()
+    )
+    await state.set_state(TaskStates.waiting_import)
+
+
+@router.message(TaskStates.waiting_import, F.document)
+async def import_finish(message: Message, state: FSMContext):
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await answer(message, "❌ Файл больше 20 МБ, разбейте его на части")
+        return
+    await state.clear()
+    
+    fmt = 'csv' if (document.file_name or '').lower().endswith('.csv') else 'jsonl'
+    path = temp_path(f".{fmt}")
+    try:
+        await bot.download(document, destination=path)
+        tasks, notes, skipped = await import_file(db, message.from_user.id, path, fmt, reminders)
+    except (UnicodeDecodeError, csv.Error) as e:
+        logging.warning("Не удалось разобрать файл импорта: %s", e)
+        await answer(message, "❌ Не удалось прочитать файл: нужен текст в UTF-8", reply_markup=get_main_keyboard())
+        return
+    finally:
+        path.unlink(missing_ok=True)
+    
+    text = f"✅ Импорт завершён\n\nЗадач: {tasks}\nЗаметок: {notes}"
+    if skipped:
+        text += f"\nПропущено строк: {skipped}"
+    await answer(message, text, reply_markup=get_main_keyboard())
+
+
+@router.message(TaskStates.waiting_import)
+async def import_no_file(message: Message):
+    await answer(message, "📎 Пришлите файл документом или нажмите «Назад»", reply_markup=get_back_keyboard())
+
+
+@router.message(Command("search"))
+async def cmd_search(message: Message, state: FSMContext):
+    query = message.text.partition(" ")[2].strip()
+    if query:
+        await state.clear()
+        await run_search(message, message.from_user.id, query)
+        return
+    
+    await answer(message, "🔍 Введите слова для поиска по задачам и заметкам:", reply_markup=get_back_keyboard())
+    await state.set_state(TaskStates.waiting_search)
+
+
+@router.callback_query(F.data == "search")
+async def search_start(callback: CallbackQuery, state: FSMContext):
+    await safe_edit(
+        callback.message,
+        "🔍 Введите слова для поиска по задачам и заметкам:",
+        reply_markup=get_back_keyboard()
+    )
+    await state.set_state(TaskStates.waiting_search)
+
+
+@router.message(TaskStates.waiting_search)
+async def search_finish(message: Message, state: FSMContext):
+    await state.clear()
+    await run_search(message, message.from_user.id, (message.text or "").strip())
 
 
 @router.callback_query(F.data == "main_menu")
 async def show_main_menu(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     text = "🏠 Главное меню\n\nВыбери действие:"
-    await callback.message.edit_text(text, reply_markup=get_main_keyboard())
+    await safe_edit(callback.message, text, reply_markup=get_main_keyboard())
 
 
 @router.callback_query(F.data == "add_task")
 async def add_task_start(callback: CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
+    await safe_edit(
+        callback.message,
         "📝 Введите название задачи:",
         reply_markup=get_back_keyboard()
     )
@@ -314,7 +909,8 @@ async def add_task_start(callback: CallbackQuery, state: FSMContext):
 async def add_task_select_category(message: Message, state: FSMContext):
     await state.update_data(task_title=message.text)
     
-    sent_msg = await message.answer(
+    sent_msg = await answer(
+        message,
         "🏷 Выберите категорию для задачи:",
         reply_markup=get_category_selection_keyboard(message.from_user.id, "newcat")
     )
@@ -331,8 +927,6 @@ async def add_task_finish(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     task_title = data.get('task_title')
     
-    user = db.get_user(callback.from_user.id)
-    
     new_task = {
         'title': task_title,
         'created': datetime.now().isoformat(),
@@ -341,11 +935,11 @@ async def add_task_finish(callback: CallbackQuery, state: FSMContext):
         'category': category
     }
     
-    user['tasks'].append(new_task)
-    db.save()
+    db.add_task(callback.from_user.id, new_task)
     
     cat_text = f" (🏷 {category})" if category else ""
-    await callback.message.edit_text(
+    await safe_edit(
+        callback.message,
         f"✅ Задача добавлена!\n\n{task_title}{cat_text}",
         reply_markup=get_main_keyboard()
     )
@@ -353,46 +947,67 @@ async def add_task_finish(callback: CallbackQuery, state: FSMContext):
 
 
 @router.callback_query(F.data == "view_tasks")
-async def view_tasks(callback: CallbackQuery):
-    user = db.get_user(callback.from_user.id)
-    text = format_tasks_list(user['tasks'])
+async def view_tasks(callback: CallbackQuery, page: int = 0):
+    user_id = callback.from_user.id
+    
+    # Сроки повторяющихся задач зависят от даты, поэтому она входит в ключ
+    today = user_today(db.get_user(user_id))
+    
+    def render():
+        total = db.active_count(user_id)
+        current = clamp_page(page, total)
+        tasks = db.active_tasks(user_id, current * PAGE_SIZE, (current + 1) * PAGE_SIZE)
+        text = format_tasks_list(tasks, db.done_count(user_id), page=current, total=total, today=today)
+        return text, get_tasks_keyboard(user_id, tasks, current, total)
     
-    await callback.message.edit_text(text, reply_markup=get_tasks_keyboard(callback.from_user.id))
+    text, markup = render_cached(user_id, ('tasks', page, today), render)
+    await safe_edit(callback.message, text, reply_markup=markup)
 
 
-@router.callback_query(F.data.startswith("task_"))
+@router.callback_query(F.data.startswith("tasks_page_"))
+async def view_tasks_page(callback: CallbackQuery):
+    await view_tasks(callback, int(callback.data.split("_")[2]))
+
+
+@router.callback_query(F.data.startswith("task_"), flags={'own_answer': True})
 async def task_detail(callback: CallbackQuery):
-    task_idx = int(callback.data.split("_")[1])
-    user = db.get_user(callback.from_user.id)
-    
-    active_tasks = [t for t in user['tasks'] if not t.get('completed')]
+    task_id = int(callback.data.split("_")[1])
+    task = db.get_active_task(callback.from_user.id, task_id)
     
-    if task_idx >= len(active_tasks):
+    if task is None:
         await callback.answer("Задача не найдена")
         return
-    
-    task = active_tasks[task_idx]
+    await callback.answer()
     
     text = f"📌 **{task['title']}**\n\n"
     text += f"⏰ Время: {task.get('time', 'не указано')}\n"
     text += f"🏷 Категория: {task.get('category', 'не указана')}\n"
+    if task.get('repeat'):
+        today = user_today(db.get_user(callback.from_user.id))
+        text += f"🔁 Повтор: {describe_repeat(task['repeat'])} ({format_due(task, today)})\n"
     text += f"📅 Создано: {datetime.fromisoformat(task['created']).strftime('%d.%m.%Y %H:%M')}\n"
     
-    await callback.message.edit_text(text, reply_markup=get_task_detail_keyboard(task_idx))
+    await safe_edit(callback.message, text, reply_markup=get_task_detail_keyboard(task_id))
 
 
-# @router.callback_query(F.data.regexp(r'^edit_\d+$'))
+@router.callback_query(F.data.regexp(r'^edit_\d+$'))
+async def edit_task_menu(callback: CallbackQuery):
+    task_id = int(callback.data.split("_")[1])
+    
+    text = "✏️ **Изменение задачи**\n\nВыберите, что хотите изменить:"
+    await safe_edit(callback.message, text, reply_markup=get_edit_keyboard(task_id))
 
 
 @router.callback_query(F.data.startswith("edit_title_"))
 async def edit_task_title_start(callback: CallbackQuery, state: FSMContext):
-    task_idx = int(callback.data.split("_")[2])
+    task_id = int(callback.data.split("_")[2])
     
-    await state.update_data(edit_task_idx=task_idx)
-    await callback.message.edit_text(
+    await state.update_data(edit_task_id=task_id)
+    await safe_edit(
+        callback.message,
         "📝 Введите новое название задачи:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="◀️ Отмена", callback_data=f"task_{task_idx}")]
+            [InlineKeyboardButton(text="◀️ Отмена", callback_data=f"task_{task_id}")]
         ])
     )
     await state.set_state(TaskStates.waiting_edit_title)
@@ -401,19 +1016,15 @@ async def edit_task_title_start(callback: CallbackQuery, state: FSMContext):
 @router.message(TaskStates.waiting_edit_title)
 async def edit_task_title_finish(message: Message, state: FSMContext):
     data = await state.get_data()
-    task_idx = data.get('edit_task_idx')
-    
-    user = db.get_user(message.from_user.id)
-    active_tasks = [i for i, t in enumerate(user['tasks']) if not t.get('completed')]
+    task_id = data.get('edit_task_id')
     
-    if task_idx < len(active_tasks):
-        real_idx = active_tasks[task_idx]
-        user['tasks'][real_idx]['title'] = message.text
-        db.save()
+    if db.get_active_task(message.from_user.id, task_id) is not None:
+        db.update_task(message.from_user.id, task_id, title=message.text)
         
-        await message.answer(
+        await answer(
+            message,
             f"✅ Название изменено!\n\n{message.text}",
-            reply_markup=get_edit_keyboard(task_idx)
+            reply_markup=get_edit_keyboard(task_id)
         )
     
     await state.clear()
@@ -421,10 +1032,11 @@ async def edit_task_title_finish(message: Message, state: FSMContext):
 
 @router.callback_query(F.data.startswith("edit_cat_"))
 async def edit_task_category_start(callback: CallbackQuery, state: FSMContext):
-    task_idx = int(callback.data.split("_")[2])
+    task_id = int(callback.data.split("_")[2])
     
-    await state.update_data(edit_task_idx=task_idx)
-    await callback.message.edit_text(
+    await state.update_data(edit_task_id=task_id)
+    await safe_edit(
+        callback.message,
         "🏷 Выберите новую категорию:",
         reply_markup=get_category_selection_keyboard(callback.from_user.id, "editcat")
     )
@@ -438,100 +1050,246 @@ async def edit_task_category_finish(callback: CallbackQuery, state: FSMContext):
         category = None
     
     data = await state.get_data()
-    task_idx = data.get('edit_task_idx')
-    
-    user = db.get_user(callback.from_user.id)
-    active_tasks = [i for i, t in enumerate(user['tasks']) if not t.get('completed')]
+    task_id = data.get('edit_task_id')
     
-    if task_idx < len(active_tasks):
-        real_idx = active_tasks[task_idx]
-        user['tasks'][real_idx]['category'] = category
-        db.save()
+    if db.get_active_task(callback.from_user.id, task_id) is not None:
+        db.update_task(callback.from_user.id, task_id, category=category)
         
         cat_text = category if category else "Без категории"
-        await callback.message.edit_text(
+        await safe_edit(
+            callback.message,
             f"✅ Категория изменена на: {cat_text}",
-            reply_markup=get_edit_keyboard(task_idx)
+            reply_markup=get_edit_keyboard(task_id)
         )
     
     await state.clear()
 
 
-@router.callback_query(F.data.startswith("complete_"))
-async def complete_task(callback: CallbackQuery):
-    task_idx = int(callback.data.split("_")[1])
-    user = db.get_user(callback.from_user.id)
+@router.callback_query(F.data.startswith("edit_time_"))
+async def edit_task_time_start(callback: CallbackQuery, state: FSMContext):
+    task_id = int(callback.data.split("_")[2])
+    
+    await state.update_data(edit_task_id=task_id)
+    await safe_edit(
+        callback.message,
+        "⏰ Введите время напоминания в формате ЧЧ:ММ (например, 09:30).\n"
+        "Отправьте «-», чтобы убрать время:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="◀️ Отмена", callback_data=f"task_{task_id}")]
+        ])
+    )
+    await state.set_state(TaskStates.waiting_time)
+
+
+@router.message(TaskStates.waiting_time)
+async def edit_task_time_finish(message: Message, state: FSMContext):
+    user_id = message.from_user.id
+    data = await state.get_data()
+    task_id = data.get('edit_task_id')
+    text = (message.text or "").strip()
+    
+    if text == "-":
+        if db.get_active_task(user_id, task_id) is not None:
+            db.update_task(user_id, task_id, time=None, remind_at=None)
+            reminders.cancel(user_id, task_id)
+            await answer(message, "✅ Время убрано", reply_markup=get_edit_keyboard(task_id))
+        await state.clear()
+        return
     
-    active_tasks = [i for i, t in enumerate(user['tasks']) if not t.get('completed')]
+    time_str = parse_time(text)
+    if time_str is None:
+        await answer(message, "❌ Укажите время в формате ЧЧ:ММ, например 09:30")
+        return
     
-    if task_idx < len(active_tasks):
-        real_idx = active_tasks[task_idx]
-        user['tasks'][real_idx]['completed'] = True
-        user['tasks'][real_idx]['completed_at'] = datetime.now().isoformat()
-        db.save()
+    task = db.get_active_task(user_id, task_id)
+    if task is not None:
+        user = db.get_user(user_id)
+        settings = user['settings']
+        remind_at = task_remind_at({**task, 'time': time_str}, user)
+        db.update_task(user_id, task_id, time=time_str, remind_at=remind_at)
+        reminders.schedule(user_id, task_id, remind_at)
         
+        reply = f"✅ Напомню в {time_str}"
+        if not settings['notifications']:
+            reply += "\n\n🔕 Уведомления выключены в настройках"
+        await answer(message, reply, reply_markup=get_edit_keyboard(task_id))
+    
+    await state.clear()
+
+
+@router.callback_query(F.data.startswith("edit_repeat_"))
+async def edit_task_repeat_start(callback: CallbackQuery, state: FSMContext):
+    task_id = int(callback.data.split("_")[2])
+    
+    await state.update_data(edit_task_id=task_id)
+    await safe_edit(
+        callback.message,
+        "🔁 Как повторять задачу?\n\n"
+        "Выберите вариант или напишите свой: «пн ср пт», «каждые 3 дня», «15 числа»",
+        reply_markup=get_repeat_keyboard(task_id)
+    )
+    await state.set_state(TaskStates.waiting_repeat)
+
+
+@router.callback_query(F.data.startswith("repeat_"), StateFilter(TaskStates.waiting_repeat))
+async def edit_task_repeat_preset(callback: CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    # «Каждую неделю» и «каждый месяц» — в тот же день недели и число, что сегодня
+    today = datetime.fromisoformat(user_today(db.get_user(user_id)))
+    presets = {
+        'day': {'every': 'day'},
+        'weekdays': {'every': 'weekdays'},
+        'week': {'every': 'week', 'days': [today.weekday()]},
+        'month': {'every': 'month', 'day': today.day},
+        'none': None
+    }
+    
+    data = await state.get_data()
+    task_id = data.get('edit_task_id')
+    text = set_repeat(user_id, task_id, presets[callback.data.split("_", 1)[1]])
+    if text:
+        await safe_edit(callback.message, text, reply_markup=get_edit_keyboard(task_id))
+    await state.clear()
+
+
+@router.message(TaskStates.waiting_repeat)
+async def edit_task_repeat_finish(message: Message, state: FSMContext):
+    user_id = message.from_user.id
+    rule = parse_rule(message.text, user_today(db.get_user(user_id)))
+    if rule is None:
+        await answer(message, "❌ Не понял правило. Примеры: «по будням», «пн ср пт», «каждые 3 дня», «15 числа»")
+        return
+    
+    data = await state.get_data()
+    task_id = data.get('edit_task_id')
+    text = set_repeat(user_id, task_id, rule)
+    if text:
+        await answer(message, text, reply_markup=get_edit_keyboard(task_id))
+    await state.clear()
+
+
+# Обработчики с флагом own_answer отвечают на нажатие сами, до основной работы
+@router.callback_query(F.data.startswith("complete_"), flags={'own_answer': True})
+async def complete_task(callback: CallbackQuery):
+    task_id = int(callback.data.split("_")[1])
+    
+    task = db.get_active_task(callback.from_user.id, task_id)
+    
+    if task is None:
+        await callback.answer("Задача не найдена")
+    elif task.get('repeat'):
+        await callback.answer("✅ Повтор выполнен!")
+        complete_repeat(callback.from_user.id, task)
+        await view_tasks(callback)
+    else:
         await callback.answer("✅ Задача выполнена!")
+        fields = {'completed': True, 'completed_at': datetime.now().isoformat()}
+        if task.get('remind_at'):
+            fields['remind_at'] = None
+        db.update_task(callback.from_user.id, task_id, **fields)
+        reminders.cancel(callback.from_user.id, task_id)
+        
         await view_tasks(callback)
 
 
-@router.callback_query(F.data.startswith("delete_"))
+@router.callback_query(F.data.startswith("delete_"), flags={'own_answer': True})
 async def delete_task(callback: CallbackQuery):
-    task_idx = int(callback.data.split("_")[1])
-    user = db.get_user(callback.from_user.id)
+    task_id = int(callback.data.split("_")[1])
+    task = db.get_active_task(callback.from_user.id, task_id)
     
-    active_tasks = [i for i, t in enumerate(user['tasks']) if not t.get('completed')]
-    
-    if task_idx < len(active_tasks):
-        real_idx = active_tasks[task_idx]
-        task_title = user['tasks'][real_idx]['title']
-        del user['tasks'][real_idx]
-        db.save()
+    if task is None:
+        await callback.answer("Задача не найдена")
+    else:
+        await callback.answer(f"🗑 Удалено: {task['title']}")
+        db.delete_task(callback.from_user.id, task_id)
+        reminders.cancel(callback.from_user.id, task_id)
         
-        await callback.answer(f"🗑 Удалено: {task_title}")
         await view_tasks(callback)
 
 
-@router.callback_query(F.data == "clear_completed")
+@router.callback_query(F.data == "clear_completed", flags={'own_answer': True})
 async def clear_completed(callback: CallbackQuery):
-    user = db.get_user(callback.from_user.id)
-    completed_count = sum(1 for t in user['tasks'] if t.get('completed'))
-    
-    user['tasks'] = [t for t in user['tasks'] if not t.get('completed')]
-    db.save()
+    completed_count = db.done_count(callback.from_user.id)
     
     await callback.answer(f"🗑 Удалено {completed_count} выполненных задач")
+    db.clear_completed(callback.from_user.id)
+    
     await view_tasks(callback)
 
 
 @router.callback_query(F.data == "statistics")
 async def show_statistics(callback: CallbackQuery):
-    text = get_statistics(callback.from_user.id)
-    await callback.message.edit_text(text, reply_markup=get_back_keyboard())
+    user_id = callback.from_user.id
+    # Счётчики «Сегодня» зависят от даты, поэтому она входит в ключ
+    today = user_today(db.get_user(user_id))
+    text = render_cached(user_id, ('statistics', today), lambda: get_statistics(user_id))
+    await safe_edit(callback.message, text, reply_markup=get_statistics_keyboard(user_id))
+
+
+@router.callback_query(F.data == "archive")
+async def show_archive(callback: CallbackQuery, page: int = 0):
+    user_id = callback.from_user.id
+    text, markup = render_cached(user_id, ('archive', page), lambda: get_archive_screen(user_id, page))
+    await safe_edit(callback.message, text, reply_markup=markup)
+
+
+@router.callback_query(F.data.startswith("archive_page_"))
+async def show_archive_page(callback: CallbackQuery):
+    await show_archive(callback, int(callback.data.split("_")[2]))
 
 
 @router.callback_query(F.data == "categories")
 async def show_categories(callback: CallbackQuery):
     text = "🗂 **Категории задач**\n\nУправляйте категориями:"
-    await callback.message.edit_text(
+    user_id = callback.from_user.id
+    await safe_edit(
+        callback.message,
         text,
-        reply_markup=get_categories_keyboard(callback.from_user.id)
+        reply_markup=render_cached(user_id, 'categories', lambda: get_categories_keyboard(user_id))
     )
 
 
 @router.callback_query(F.data.startswith("filter_"))
-async def filter_by_category(callback: CallbackQuery):
-    category = callback.data.split("_", 1)[1]
-    user = db.get_user(callback.from_user.id)
-    
-    filtered_tasks = [t for t in user['tasks'] if t.get('category') == category]
-    text = format_tasks_list(filtered_tasks, f"Категория: {category}")
+async def filter_by_category(callback: CallbackQuery, category: Optional[str] = None, page: int = 0):
+    if category is None:
+        category = callback.data.split("_", 1)[1]
+    user_id = callback.from_user.id
+    today = user_today(db.get_user(user_id))
+    
+    def render():
+        total = db.category_count(user_id, category)
+        current = clamp_page(page, total)
+        text = format_tasks_list(
+            db.category_tasks(user_id, category, current * PAGE_SIZE, (current + 1) * PAGE_SIZE),
+            db.category_done_count(user_id, category),
+            f"Категория: {category}",
+            page=current, total=total, today=today
+        )
+        
+        buttons = []
+        nav = get_page_nav("catpage_", current, total)
+        if nav:
+            # Категория идёт после номера страницы: в названии может быть «_»
+            for button in nav:
+                button.callback_data += f"_{category}"
+            buttons.append(nav)
+        buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="main_menu")])
+        return text, InlineKeyboardMarkup(inline_keyboard=buttons)
     
-    await callback.message.edit_text(text, reply_markup=get_back_keyboard())
+    text, markup = render_cached(user_id, ('filter', category, page, today), render)
+    await safe_edit(callback.message, text, reply_markup=markup)
+
+
+@router.callback_query(F.data.startswith("catpage_"))
+async def filter_by_category_page(callback: CallbackQuery):
+    _, page, category = callback.data.split("_", 2)
+    await filter_by_category(callback, category, int(page))
 
 
 @router.callback_query(F.data == "add_category")
 async def add_category_start(callback: CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
+    await safe_edit(
+        callback.message,
         "🏷 Введите название новой категории:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="◀️ Отмена", callback_data="categories")]
@@ -547,15 +1305,16 @@ async def add_category_finish(message: Message, state: FSMContext):
     new_category = message.text.strip()
     
     if new_category not in user['categories']:
-        user['categories'].append(new_category)
-        db.save()
+        db.add_category(message.from_user.id, new_category)
         
-        await message.answer(
+        await answer(
+            message,
             f"✅ Категория '{new_category}' добавлена!",
             reply_markup=get_categories_keyboard(message.from_user.id)
         )
     else:
-        await message.answer(
+        await answer(
+            message,
             "❌ Такая категория уже существует!",
             reply_markup=get_categories_keyboard(message.from_user.id)
         )
@@ -563,26 +1322,21 @@ async def add_category_finish(message: Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(F.data.startswith("delcat_"))
+@router.callback_query(F.data.startswith("delcat_"), flags={'own_answer': True})
 async def delete_category(callback: CallbackQuery):
     category = callback.data.split("_", 1)[1]
     user = db.get_user(callback.from_user.id)
     
     if category in user['categories']:
-        user['categories'].remove(category)
-        
-        # Убираем категорию у всех задач с этой категорией
-        for task in user['tasks']:
-            if task.get('category') == category:
-                task['category'] = None
-        
-        db.save()
         await callback.answer(f"🗑 Категория '{category}' удалена")
+        db.delete_category(callback.from_user.id, category)
         await show_categories(callback)
+    else:
+        await callback.answer()
 
 
 @router.callback_query(F.data == "notes_menu")
-async def notes_menu(callback: CallbackQuery):
+async def notes_menu(callback: CallbackQuery, page: int = 0):
     user = db.get_user(callback.from_user.id)
     
     text = "📝 **Заметки**\n\n"
@@ -592,10 +1346,17 @@ async def notes_menu(callback: CallbackQuery):
     else:
         text += "Заметок пока нет."
     
-    await callback.message.edit_text(text, reply_markup=get_notes_keyboard(callback.from_user.id))
+    user_id = callback.from_user.id
+    markup = render_cached(user_id, ('notes', page), lambda: get_notes_keyboard(user_id, page))
+    await safe_edit(callback.message, text, reply_markup=markup)
+
+
+@router.callback_query(F.data.startswith("notes_page_"))
+async def notes_menu_page(callback: CallbackQuery):
+    await notes_menu(callback, int(callback.data.split("_")[2]))
 
 
-@router.callback_query(F.data.startswith("note_"))
+@router.callback_query(F.data.startswith("note_"), flags={'own_answer': True})
 async def show_note_detail(callback: CallbackQuery):
     note_idx = int(callback.data.split("_")[1])
     user = db.get_user(callback.from_user.id)
@@ -603,18 +1364,20 @@ async def show_note_detail(callback: CallbackQuery):
     if note_idx >= len(user['notes']):
         await callback.answer("Заметка не найдена")
         return
+    await callback.answer()
     
     note = user['notes'][note_idx]
     created = datetime.fromisoformat(note['created']).strftime('%d.%m.%Y %H:%M')
     
     text = f"📄 **Заметка**\n\n{note['text']}\n\n📅 Создано: {created}"
     
-    await callback.message.edit_text(text, reply_markup=get_note_detail_keyboard(note_idx))
+    await safe_edit(callback.message, text, reply_markup=get_note_detail_keyboard(note_idx))
 
 
 @router.callback_query(F.data == "add_note")
 async def add_note_start(callback: CallbackQuery, state: FSMContext):
-    await callback.message.edit_text(
+    await safe_edit(
+        callback.message,
         "📝 Введите текст заметки:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="◀️ Отмена", callback_data="notes_menu")]
@@ -625,34 +1388,33 @@ async def add_note_start(callback: CallbackQuery, state: FSMContext):
 
 @router.message(TaskStates.waiting_note)
 async def add_note_finish(message: Message, state: FSMContext):
-    user = db.get_user(message.from_user.id)
-    
     new_note = {
         'text': message.text,
         'created': datetime.now().isoformat()
     }
     
-    user['notes'].append(new_note)
-    db.save()
+    db.add_note(message.from_user.id, new_note)
     
-    await message.answer(
+    await answer(
+        message,
         "✅ Заметка сохранена!",
         reply_markup=get_notes_keyboard(message.from_user.id)
     )
     await state.clear()
 
 
-@router.callback_query(F.data.startswith("delnote_"))
+@router.callback_query(F.data.startswith("delnote_"), flags={'own_answer': True})
 async def delete_note(callback: CallbackQuery):
     note_idx = int(callback.data.split("_")[1])
     user = db.get_user(callback.from_user.id)
     
     if note_idx < len(user['notes']):
-        del user['notes'][note_idx]
-        db.save()
-        
         await callback.answer("🗑 Заметка удалена")
+        db.delete_note(callback.from_user.id, note_idx)
+        
         await notes_menu(callback)
+    else:
+        await callback.answer("Заметка не найдена")
 
 
 @router.callback_query(F.data == "settings")
@@ -663,54 +1425,156 @@ async def show_settings(callback: CallbackQuery):
     text = "⚙️ **Настройки**\n\n"
     text += f"🔔 Уведомления: {'Вкл' if settings['notifications'] else 'Выкл'}\n"
     text += f"🌍 Часовой пояс: UTC{settings['timezone']:+d}\n"
+    text += f"☀️ Утренняя сводка в {DIGEST_HOUR:02d}:00: {'Вкл' if settings.get('digest') else 'Выкл'}\n"
     
     buttons = [
         [InlineKeyboardButton(
             text=f"🔔 {'Выключить' if settings['notifications'] else 'Включить'} уведомления",
             callback_data="toggle_notifications"
         )],
+        [InlineKeyboardButton(
+            text=f"☀️ {'Выключить' if settings.get('digest') else 'Включить'} утреннюю сводку",
+            callback_data="toggle_digest"
+        )],
         [InlineKeyboardButton(text="🌍 Изменить часовой пояс", callback_data="change_timezone")],
         [InlineKeyboardButton(text="◀️ Назад", callback_data="main_menu")]
     ]
     
-    await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await safe_edit(callback.message, text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
 
 
 @router.callback_query(F.data == "toggle_notifications")
 async def toggle_notifications(callback: CallbackQuery):
     user = db.get_user(callback.from_user.id)
-    user['settings']['notifications'] = not user['settings']['notifications']
-    db.save()
+    db.set_setting(callback.from_user.id, 'notifications', not user['settings']['notifications'])
     
     await show_settings(callback)
     
+@router.callback_query(F.data == "toggle_digest")
+async def toggle_digest(callback: CallbackQuery):
+    user = db.get_user(callback.from_user.id)
+    db.set_setting(callback.from_user.id, 'digest', not user['settings'].get('digest'))
+    
+    await show_settings(callback)
+
+
 @router.callback_query(F.data == "change_timezone")
 async def change_timezone_menu(callback: CallbackQuery):
     text = "🌍 **Выбор часового пояса**\n\nВыберите ваш часовой пояс:"
-    await callback.message.edit_text(text, reply_markup=get_timezone_keyboard())
+    await safe_edit(callback.message, text, reply_markup=get_timezone_keyboard())
 
 
-@router.callback_query(F.data.startswith("tz_"))
+@router.callback_query(F.data.startswith("tz_"), flags={'own_answer': True})
 async def set_timezone(callback: CallbackQuery):
     tz = int(callback.data.split("_")[1])
-    user = db.get_user(callback.from_user.id)
-    user['settings']['timezone'] = tz
-    db.save()
-    
     await callback.answer(f"✅ Часовой пояс установлен: UTC{tz:+d}")
+    db.set_setting(callback.from_user.id, 'timezone', tz)
+    reschedule_reminders(callback.from_user.id)
+    
     await show_settings(callback)
 
 
-async def main():
+async def on_startup():
+    # Статичные клавиатуры собираем заранее, до первого апдейта
+    get_main_keyboard()
+    get_back_keyboard()
+    get_timezone_keyboard()
+    await outbox.start()
+    await db.start()
+    reminders.load(db.pending_reminders())
+    await reminders.start()
+    logging.info("Напоминаний в очереди: %d", len(reminders))
+    await digest.start()
+    await backups.start()
+    if METRICS_PORT:
+        global metrics_runner
+        metrics_runner = await start_metrics_server(metrics, profiler, METRICS_HOST, METRICS_PORT + SHARD_INDEX)
+
+
+async def on_shutdown():
+    # Вызывается и при остановке по SIGINT/SIGTERM — сбрасываем накопленные изменения
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    if profiler.running:
+        profiler.stop()
+    await reminders.close()
+    await digest.close()
+    await backups.close()
+    await outbox.close()
+    await db.close()
+    logging.info("Исходящие: %s", outbox.stats())
+    logging.info("Блокировки пользователей: %s", user_locks.stats())
+    logging.info("Частые нажатия: %s", flood.stats())
+    logging.info("Кэш экранов: %s, пропущено правок: %d", render_cache.stats(), skipped_edits)
+    logging.info("Архивация: %s", db.archive_stats())
+
+
+def setup_dispatcher():
+    # Метрики снаружи блокировок, чтобы время апдейта включало ожидание своей очереди
+    dp.update.outer_middleware(UpdateMetricsMiddleware(metrics))
+    # Апдейты одного пользователя применяются по очереди, разных — параллельно
+    dp.update.outer_middleware(UserLockMiddleware(user_locks))
+    router.message.middleware(HandlerMetricsMiddleware(metrics))
+    # Лишние нажатия отсекаются до обработчика и в его метрики не попадают
+    router.callback_query.middleware(FloodControlMiddleware(flood))
+    router.callback_query.middleware(HandlerMetricsMiddleware(metrics))
     dp.include_router(router)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    
+    metrics.add_collector('db', db.flush_stats)
+    metrics.add_collector('db_cache', db.cache_stats)
+    metrics.add_collector('db_io', db.io_stats)
+    metrics.add_collector('db_size', lambda: {'bytes': db.size_bytes()})
+    metrics.add_collector('archive', db.archive_stats)
+    metrics.add_collector('outbox', outbox.stats)
+    metrics.add_collector('render_cache', lambda: {**render_cache.stats(), 'skipped_edits': skipped_edits})
+    metrics.add_collector('user_locks', user_locks.stats)
+    metrics.add_collector('flood', flood.stats)
+    metrics.add_collector('reminders', reminders.stats)
+    metrics.add_collector('digest', digest.stats)
+    metrics.add_collector('backup', backups.stats)
+    if isinstance(storage, SqliteStorage):
+        metrics.add_collector('fsm', storage.stats)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+
+async def main():
+    started = time.perf_counter()
+    init_app()
+    setup_dispatcher()
+    logging.info("База открыта за %.3f с", time.perf_counter() - started)
+    
+    if BOT_MODE == 'webhook':
+        try:
+            await run_webhook(
+                dp, bot,
+                url=WEBHOOK_URL,
+                path=WEBHOOK_PATH,
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                secret_token=WEBHOOK_SECRET,
+                max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+                drain_timeout=WEBHOOK_DRAIN_TIMEOUT,
+                drop_pending_updates=DROP_PENDING_UPDATES
+            )
+        finally:
+            await bot.session.close()
+    elif BOT_MODE == 'worker':
+        # Апдейты пользователей своего шарда приходят от фронтального процесса
+        try:
+            await serve_updates(
+                dp, bot, WORKER_PATH, '127.0.0.1', WORKER_PORT,
+                secret_token=SHARD_SECRET,
+                max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+                drain_timeout=WEBHOOK_DRAIN_TIMEOUT
+            )
+        finally:
+            await bot.session.close()
+    else:
+        await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+        await dp.start_polling(bot)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
-async def edit_task_menu(callback: CallbackQuery):
-    task_idx = int(callback.data.split("_")[1])
-    
-    text = "✏️ **Изменение задачи**\n\nВыберите, что хотите изменить:"
-    await callback.message.edit_text(text, reply_markup=get_edit_keyboard(task_idx))
\ No newline at end of file
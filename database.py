@@ -0,0 +1,1167 @@
+import asyncio
+import copy
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from archive import TaskArchive, archive_dir
+from search_index import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATEGORIES = ['Работа', 'Личное', 'Учёба', 'Здоровье', 'Покупки']
+NO_CATEGORY = 'Без категории'
+
+# Режимы хранения
+MODE_SYNC = 'sync'                  # полная перезапись файла при каждом изменении
+MODE_WRITE_BEHIND = 'write_behind'  # отложенная пакетная перезапись
+MODE_JOURNAL = 'journal'            # журнал изменений + периодический снимок
+MODES = (MODE_SYNC, MODE_WRITE_BEHIND, MODE_JOURNAL)
+
+
+def new_user() -> Dict:
+    return {
+        'tasks': [],
+        'notes': [],
+        'categories': list(DEFAULT_CATEGORIES),
+        'settings': {
+            'notifications': True,
+            'timezone': 0
+        },
+        'next_task_id': 1,
+        'stats': empty_stats(),
+        'archive': empty_archive()
+    }
+
+
+def migrate_user(user: Dict) -> bool:
+    changed = False
+    # Выдаём стабильные id задачам из старых баз; порядок списка сохраняется,
+    # поэтому user['tasks'] всегда отсортирован по id
+    if 'next_task_id' not in user:
+        for task_id, task in enumerate(user['tasks'], 1):
+            task['id'] = task_id
+        user['next_task_id'] = len(user['tasks']) + 1
+        changed = True
+    if 'archive' not in user:
+        user['archive'] = empty_archive()
+        changed = True
+    if 'stats' not in user:
+        user['stats'] = build_stats(user)
+        changed = True
+    return changed
+
+
+# Статистика пользователя хранится готовыми счётчиками и обновляется каждой
+# операцией за O(1): всего/выполнено, по категориям [всего, выполнено]
+# и по дням в часовом поясе пользователя [создано, выполнено]. Счётчики
+# повторяющихся задач ('recurring') и выполненных повторов ('repeats')
+# появляются, только когда они не нулевые
+def empty_stats() -> Dict:
+    return {'total': 0, 'completed': 0, 'categories': {}, 'days': {}}
+
+
+# Сколько пользователей архивировать за один заход (одна запись базы на пачку)
+ARCHIVE_CHUNK = 500
+
+
+# Сводка архива выполненных задач: число сегментов и задач в них и вклад
+# этих задач в счётчики статистики (сами задачи лежат в TaskArchive)
+def empty_archive() -> Dict:
+    return {'segments': 0, 'count': 0, 'stats': empty_stats()}
+
+
+def local_day(iso: str, tz_offset: int) -> str:
+    moment = datetime.fromisoformat(iso)
+    if moment.tzinfo is None:
+        # Время в базе записано по часам сервера
+        moment = moment.astimezone()
+    return (moment.astimezone(timezone.utc) + timedelta(hours=tz_offset)).date().isoformat()
+
+
+def user_today(user: Dict) -> str:
+    offset = timedelta(hours=user['settings']['timezone'])
+    return (datetime.now(timezone.utc) + offset).date().isoformat()
+
+
+def _bump(counters: Dict, key: str, slot: int, delta: int):
+    pair = counters.setdefault(key, [0, 0])
+    pair[slot] += delta
+    if pair == [0, 0]:
+        del counters[key]
+
+
+def _bump_total(stats: Dict, key: str, delta: int):
+    stats[key] = stats.get(key, 0) + delta
+    if not stats[key]:
+        del stats[key]
+
+
+def _count_task(user: Dict, task: Dict, delta: int):
+    stats = user['stats']
+    tz_offset = user['settings']['timezone']
+    category = task.get('category') or NO_CATEGORY
+
+    stats['total'] += delta
+    _bump(stats['categories'], category, 0, delta)
+    _bump(stats['days'], local_day(task['created'], tz_offset), 0, delta)
+    if task.get('completed'):
+        stats['completed'] += delta
+        _bump(stats['categories'], category, 1, delta)
+        if task.get('completed_at'):
+            _bump(stats['days'], local_day(task['completed_at'], tz_offset), 1, delta)
+        if task.get('repeat_of') is not None:
+            _bump_total(stats, 'repeats', delta)
+    elif task.get('repeat'):
+        _bump_total(stats, 'recurring', delta)
+
+
+def build_stats(user: Dict) -> Dict:
+    # Заархивированные задачи пересчитать нельзя, их вклад берём из сводки архива.
+    # Дни в нём остаются в том часовом поясе, что был при архивации
+    archive = user.get('archive')
+    user['stats'] = copy.deepcopy(archive['stats']) if archive else empty_stats()
+    for task in user['tasks']:
+        _count_task(user, task, 1)
+    return user['stats']
+
+
+def find_task(user: Dict, task_id: int) -> Optional[int]:
+    tasks = user['tasks']
+    pos = bisect_left(tasks, task_id, key=itemgetter('id'))
+    if pos < len(tasks) and tasks[pos]['id'] == task_id:
+        return pos
+    return None
+
+
+def _task_pos(user: Dict, op: Dict) -> int:
+    if 'id' not in op:
+        # Записи журнала, сделанные до появления id задач
+        return op['i']
+    pos = find_task(user, op['id'])
+    if pos is None:
+        raise KeyError(f"Задача {op['id']} не найдена")
+    return pos
+
+
+# Операции над данными. Каждое изменение описывается компактной записью
+# {'op': ..., 'u': user_id, ...}; одна и та же функция применяет её
+# и к живым данным, и при воспроизведении журнала после перезапуска
+def _op_user_new(data: Dict, user: Optional[Dict], op: Dict):
+    if user is None:
+        data[op['u']] = new_user()
+
+
+def _op_task_add(data: Dict, user: Dict, op: Dict):
+    task = op['task']
+    if 'id' not in task:
+        task['id'] = user['next_task_id']
+    user['next_task_id'] = max(user['next_task_id'], task['id'] + 1)
+    user['tasks'].append(task)
+    _count_task(user, task, 1)
+
+
+def _op_task_set(data: Dict, user: Dict, op: Dict):
+    task = user['tasks'][_task_pos(user, op)]
+    _count_task(user, task, -1)
+    task.update(op['fields'])
+    _count_task(user, task, 1)
+
+
+def _op_task_del(data: Dict, user: Dict, op: Dict):
+    pos = _task_pos(user, op)
+    _count_task(user, user['tasks'][pos], -1)
+    del user['tasks'][pos]
+
+
+def _op_task_repeat(data: Dict, user: Dict, op: Dict):
+    # Выполнен повтор: в список добавляется выполненная задача-повтор,
+    # а у самой повторяющейся задачи переносится срок
+    _op_task_set(data, user, op)
+    _op_task_add(data, user, {'task': op['done']})
+
+
+def _op_tasks_clear_done(data: Dict, user: Dict, op: Dict):
+    for task in user['tasks']:
+        if task.get('completed'):
+            _count_task(user, task, -1)
+    user['tasks'] = [t for t in user['tasks'] if not t.get('completed')]
+
+
+def _op_import(data: Dict, user: Dict, op: Dict):
+    # Пачка импортированных задач и заметок одной операцией
+    for task in op['tasks']:
+        _op_task_add(data, user, {'task': task})
+    user['notes'].extend(op['notes'])
+
+
+def _op_tasks_archive(data: Dict, user: Dict, op: Dict):
+    # Задачи уходят в архив вместе со своим вкладом в статистику, поэтому
+    # сами счётчики не меняются
+    ids = set(op['ids'])
+    archive = user.setdefault('archive', empty_archive())
+    counted = {'stats': archive['stats'], 'settings': user['settings']}
+    for task in user['tasks']:
+        if task['id'] in ids:
+            _count_task(counted, task, 1)
+            archive['count'] += 1
+    archive['segments'] = op['seq'] + 1
+    user['tasks'] = [t for t in user['tasks'] if t['id'] not in ids]
+
+
+def _op_cat_add(data: Dict, user: Dict, op: Dict):
+    if op['name'] not in user['categories']:
+        user['categories'].append(op['name'])
+
+
+def _op_cat_del(data: Dict, user: Dict, op: Dict):
+    category = op['name']
+    if category in user['categories']:
+        user['categories'].remove(category)
+    # Убираем категорию у всех задач с этой категорией
+    for task in user['tasks']:
+        if task.get('category') == category:
+            task['category'] = None
+
+    # Их счётчики переходят в «Без категории» — и в живой статистике, и во
+    # вкладе архива, из которого build_stats собирает её заново
+    stats_list = [user['stats']]
+    if user.get('archive'):
+        stats_list.append(user['archive']['stats'])
+    for stats in stats_list:
+        moved = stats['categories'].pop(category, None)
+        if moved:
+            _bump(stats['categories'], NO_CATEGORY, 0, moved[0])
+            _bump(stats['categories'], NO_CATEGORY, 1, moved[1])
+
+
+def _op_note_add(data: Dict, user: Dict, op: Dict):
+    user['notes'].append(op['note'])
+
+
+def _op_note_del(data: Dict, user: Dict, op: Dict):
+    del user['notes'][op['i']]
+
+
+def _op_setting(data: Dict, user: Dict, op: Dict):
+    user['settings'][op['key']] = op['value']
+    if op['key'] == 'timezone':
+        # Дневные счётчики считаются в часовом поясе пользователя
+        build_stats(user)
+
+
+def _op_stats_rebuild(data: Dict, user: Dict, op: Dict):
+    build_stats(user)
+
+
+def _op_user_restore(data: Dict, user: Optional[Dict], op: Dict):
+    # Пользователь целиком заменяется копией из резервной копии
+    restored = op['user']
+    migrate_user(restored)
+    data[op['u']] = restored
+
+
+OPS = {
+    'user_new': _op_user_new,
+    'task_add': _op_task_add,
+    'task_set': _op_task_set,
+    'task_del': _op_task_del,
+    'task_repeat': _op_task_repeat,
+    'tasks_clear_done': _op_tasks_clear_done,
+    'tasks_archive': _op_tasks_archive,
+    'import': _op_import,
+    'cat_add': _op_cat_add,
+    'cat_del': _op_cat_del,
+    'note_add': _op_note_add,
+    'note_del': _op_note_del,
+    'setting': _op_setting,
+    'stats_rebuild': _op_stats_rebuild,
+    'user_restore': _op_user_restore,
+}
+
+
+def apply_op(data: Dict, op: Dict):
+    OPS[op['op']](data, data.get(op['u']), op)
+
+
+# Индексы задач пользователя: id → задача, упорядоченный список id активных
+# и категория → упорядоченный список id активных задач этой категории.
+# Не сохраняются, строятся при первом обращении и обновляются каждой операцией
+class TaskIndex:
+    def __init__(self, tasks: List[Dict]):
+        self.rebuild(tasks)
+
+    def rebuild(self, tasks: List[Dict]):
+        self.by_id = {t['id']: t for t in tasks}
+        self.active: List[int] = []
+        self.by_category: Dict[Optional[str], List[int]] = {}
+        self.cat_of: Dict[int, Optional[str]] = {}
+        # Выполненные задачи списка: категория каждой и число по категориям
+        self.done_cat: Dict[int, Optional[str]] = {}
+        self.done_by_category: Dict[Optional[str], int] = {}
+        for task in tasks:
+            self._place(task)
+
+    @staticmethod
+    def _discard(ids: List[int], task_id: int):
+        pos = bisect_left(ids, task_id)
+        if pos < len(ids) and ids[pos] == task_id:
+            del ids[pos]
+
+    def _activate(self, task: Dict):
+        category = task.get('category')
+        insort(self.active, task['id'])
+        insort(self.by_category.setdefault(category, []), task['id'])
+        self.cat_of[task['id']] = category
+
+    def _place(self, task: Dict):
+        if not task.get('completed'):
+            self._activate(task)
+            return
+        category = task.get('category')
+        self.done_cat[task['id']] = category
+        self.done_by_category[category] = self.done_by_category.get(category, 0) + 1
+
+    def _remove(self, task_id: int):
+        self._deactivate(task_id)
+        if task_id not in self.done_cat:
+            return
+        category = self.done_cat.pop(task_id)
+        self.done_by_category[category] -= 1
+        if not self.done_by_category[category]:
+            del self.done_by_category[category]
+
+    def _deactivate(self, task_id: int):
+        if task_id not in self.cat_of:
+            return
+        category = self.cat_of.pop(task_id)
+        self._discard(self.active, task_id)
+        ids = self.by_category[category]
+        self._discard(ids, task_id)
+        if not ids:
+            del self.by_category[category]
+
+    def apply(self, op: Dict, user: Dict):
+        kind = op['op']
+        if kind == 'task_add':
+            task = op['task']
+            self.by_id[task['id']] = task
+            self._place(task)
+        elif kind == 'import':
+            for task in op['tasks']:
+                self.apply({'op': 'task_add', 'task': task}, user)
+        elif kind == 'task_repeat':
+            self.apply({'op': 'task_set', 'id': op['id'], 'fields': op['fields']}, user)
+            self.apply({'op': 'task_add', 'task': op['done']}, user)
+        elif kind == 'user_restore' or kind in ('task_set', 'task_del') and op.get('id') is None:
+            self.rebuild(user['tasks'])
+        elif kind == 'task_set':
+            self._remove(op['id'])
+            self._place(self.by_id[op['id']])
+        elif kind == 'task_del':
+            self.by_id.pop(op['id'], None)
+            self._remove(op['id'])
+        elif kind in ('tasks_clear_done', 'tasks_archive'):
+            # Активные задачи не меняются, убираем выполненные из by_id
+            self.by_id = {t['id']: t for t in user['tasks']}
+            for task_id in [i for i in self.done_cat if i not in self.by_id]:
+                self._remove(task_id)
+        elif kind == 'cat_del':
+            moved = self.by_category.pop(op['name'], None)
+            if moved:
+                for task_id in moved:
+                    self.cat_of[task_id] = None
+                self.by_category[None] = sorted(self.by_category.get(None, []) + moved)
+            done = self.done_by_category.pop(op['name'], 0)
+            if done:
+                for task_id, category in self.done_cat.items():
+                    if category == op['name']:
+                        self.done_cat[task_id] = None
+                self.done_by_category[None] = self.done_by_category.get(None, 0) + done
+
+
+# Класс для работы с базой данных
+class Database:
+    def __init__(self, path: Path, mode: str = MODE_SYNC,
+                 flush_interval: float = 1.0, flush_max_changes: int = 100,
+                 compact_interval: float = 300.0, compact_records: int = 10000,
+                 journal_fsync: bool = False, archive_after: float = 0.0,
+                 archive_interval: float = 3600.0):
+        if mode not in MODES:
+            raise ValueError(f"Неизвестный режим хранения: {mode}")
+
+        self.path = path
+        self.mode = mode
+        self.journal_path = path.with_name(path.name + '.journal')
+        self._journal_old_path = path.with_name(path.name + '.journal.old')
+        self._seq = 0
+        self._snapshot_dirty = False
+        self.data = self._load()
+
+        # Ограничение резидентного набора пользователей (LRU). Работает только
+        # там, где пользователя можно подгрузить по отдельности (_load_user);
+        # 0 — без ограничения
+        self.cache_users = 0
+        self.cache_items = 0
+        self._resident_items = 0
+        self._user_items: Dict[str, int] = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_evictions = 0
+
+        self._indexes: Dict[str, TaskIndex] = {}
+        # Поисковые индексы строятся при первом поиске пользователя
+        self._search_indexes: Dict[str, SearchIndex] = {}
+
+        # Версия данных пользователя для кэшей отрисовки: берётся из общего
+        # счётчика при каждом изменении и при подгрузке, поэтому после
+        # вытеснения и повторной загрузки не совпадёт с прежней
+        self._versions: Dict[str, int] = {}
+        self._version_counter = itertools.count(1)
+
+        # Отложенная запись: изменения копятся и сбрасываются фоновой задачей
+        # не реже чем раз в flush_interval секунд (это и есть окно потери данных)
+        # или сразу после flush_max_changes изменений
+        self.flush_interval = flush_interval
+        self.flush_max_changes = flush_max_changes
+
+        self._pending = 0
+        self._dirty_event: Optional[asyncio.Event] = None
+        self._full_event: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+        self._flush_count = 0
+        self._flushed_changes = 0
+        self._flush_time_total = 0.0
+        self._flush_time_last = 0.0
+        self._flush_time_max = 0.0
+
+        # Запись на диск: перезаписи файла базы, байты и время, а также
+        # сохранение отдельных операций (_persist)
+        self._writes = 0
+        self._write_bytes = 0
+        self._write_time_total = 0.0
+        self._journal_bytes = 0
+        self._persist_count = 0
+        self._persist_time_total = 0.0
+
+        # Журнал: каждая операция дописывается одной строкой, а фоновый
+        # компактор раз в compact_interval секунд или после compact_records
+        # записей сворачивает журнал в новый снимок
+        self.compact_interval = compact_interval
+        self.compact_records = compact_records
+        self.journal_fsync = journal_fsync
+        self._journal = None
+        self._journal_records = 0
+        self._compact_event: Optional[asyncio.Event] = None
+        self._compactor: Optional[asyncio.Task] = None
+        self._compact_count = 0
+
+        # Архивация: выполненные больше archive_after секунд назад задачи
+        # раз в archive_interval секунд переносятся в сжатый архив на диске;
+        # 0 — не архивировать
+        self.archive = TaskArchive(archive_dir(path))
+        self.archive_after = archive_after
+        self.archive_interval = archive_interval
+        self._archiver: Optional[asyncio.Task] = None
+        self._archive_passes = 0
+        self._archived_tasks = 0
+
+        # Пакет изменений (импорт): запись файла откладывается до конца пакета
+        self._batch_depth = 0
+        self._batch_saves = 0
+
+        # Получатели утренней сводки по часовым поясам. Строится при первом
+        # обращении и дальше обновляется изменениями настроек
+        self._digest_index: Optional[Dict[int, Set[str]]] = None
+        self._digest_tz: Dict[str, int] = {}
+
+        # Резервная копия: пока она пишется, пользователь, которого ещё не
+        # успели сохранить, перед первым изменением копируется как был
+        # (копирование при записи), поэтому копия соответствует моменту начала
+        self._backup_pending: Optional[Set[str]] = None
+        self._backup_copies: Dict[str, str] = {}
+        self._backup_lock = threading.Lock()
+        self._backup_copied = 0
+
+        if self.mode == MODE_JOURNAL:
+            self._replay_journal()
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _load(self) -> Dict:
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._seq = data.pop('_seq', 0)
+            for user in data.values():
+                if migrate_user(user):
+                    self._snapshot_dirty = True
+            return data
+        return {}
+
+    def _replay_journal(self):
+        snapshot_seq = self._seq
+        for path in (self._journal_old_path, self.journal_path):
+            if not path.exists():
+                continue
+            good_offset = 0
+            replayed = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    # Недописанная последняя строка остаётся от аварийной остановки
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        break
+                    good_offset += len(line)
+                    if op['s'] <= snapshot_seq:
+                        continue
+                    if op['op'] != 'user_new' and op['u'] not in self.data:
+                        # Снимок может подгружать пользователей по одному
+                        user = self._load_user(op['u'])
+                        if user is not None:
+                            self.data[op['u']] = user
+                    apply_op(self.data, op)
+                    self._seq = op['s']
+                    replayed += 1
+            if good_offset != path.stat().st_size:
+                logger.warning("Журнал %s обрезан до последней целой записи", path)
+                os.truncate(path, good_offset)
+            self._journal_records += replayed
+            logger.info("Из журнала %s воспроизведено записей: %d", path, replayed)
+
+    def _dump(self) -> str:
+        if self.mode == MODE_JOURNAL:
+            return json.dumps({'_seq': self._seq, **self.data}, ensure_ascii=False)
+        return json.dumps(self.data, ensure_ascii=False, indent=2)
+
+    def _write(self, payload: str, fsync: bool = False):
+        # Пишем во временный файл и атомарно подменяем основной,
+        # чтобы сбой посреди записи не оставил обрезанную базу
+        started = time.perf_counter()
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, self.path)
+        self._writes += 1
+        self._write_bytes += size
+        self._write_time_total += time.perf_counter() - started
+
+    def _save(self):
+        self._write(self._dump())
+
+    def _load_user(self, user_id_str: str) -> Optional[Dict]:
+        # JSON-база целиком в памяти: если пользователя нет в data, его нет вовсе
+        return None
+
+    def _evict_user(self, user_id_str: str, user: Dict):
+        pass
+
+    @property
+    def _bounded(self) -> bool:
+        return bool(self.cache_users or self.cache_items)
+
+    def _ensure_user(self, user_id_str: str, create: bool = True) -> bool:
+        # False — пользователя нет, а создавать его не просили
+        if user_id_str in self.data:
+            if self._bounded:
+                self.data.move_to_end(user_id_str)
+                self._cache_hits += 1
+            return True
+
+        user = self._load_user(user_id_str)
+        if user is None:
+            if not create:
+                return False
+            self._commit({'op': 'user_new', 'u': user_id_str})
+        else:
+            self.data[user_id_str] = user
+            self._versions[user_id_str] = next(self._version_counter)
+        if self._bounded:
+            self._cache_misses += 1
+            self._track_size(user_id_str)
+            self._evict_cold(keep=user_id_str)
+        return True
+
+    def _track_size(self, user_id_str: str):
+        # Размер пользователя приблизительно оцениваем числом задач и заметок
+        user = self.data[user_id_str]
+        size = len(user['tasks']) + len(user['notes']) + 1
+        self._resident_items += size - self._user_items.get(user_id_str, 0)
+        self._user_items[user_id_str] = size
+
+    def _evict_cold(self, keep: str):
+        while len(self.data) > 1 and (
+            (self.cache_users and len(self.data) > self.cache_users)
+            or (self.cache_items and self._resident_items > self.cache_items)
+        ):
+            user_id_str = next(iter(self.data))
+            if user_id_str == keep:
+                break
+            self._unload(user_id_str)
+
+    def _unload(self, user_id_str: str):
+        user = self.data.pop(user_id_str)
+        self._resident_items -= self._user_items.pop(user_id_str, 0)
+        self._indexes.pop(user_id_str, None)
+        self._search_indexes.pop(user_id_str, None)
+        self._versions.pop(user_id_str, None)
+        self._evict_user(user_id_str, user)
+        self._cache_evictions += 1
+
+    def _commit(self, op: Dict):
+        if op['op'] != 'user_new':
+            self._ensure_user(op['u'])
+        if self._backup_pending is not None:
+            self._backup_preserve(op['u'])
+        apply_op(self.data, op)
+        self._versions[op['u']] = next(self._version_counter)
+        index = self._indexes.get(op['u'])
+        if index is not None:
+            index.apply(op, self.data[op['u']])
+        search_index = self._search_indexes.get(op['u'])
+        if search_index is not None:
+            search_index.apply(op, self.data[op['u']])
+        if self._digest_index is not None and (
+            op['op'] == 'user_restore' or op['op'] == 'setting' and op['key'] in ('digest', 'timezone')
+        ):
+            self._index_digest(op['u'], self.data[op['u']]['settings'])
+        started = time.perf_counter()
+        self._persist(op)
+        self._persist_count += 1
+        self._persist_time_total += time.perf_counter() - started
+        if self._bounded and op['op'] != 'user_new':
+            self._track_size(op['u'])
+
+    def _persist(self, op: Dict):
+        if self.mode != MODE_JOURNAL:
+            self.save()
+            return
+
+        self._seq += 1
+        op['s'] = self._seq
+        line = json.dumps(op, ensure_ascii=False, separators=(',', ':')) + '\n'
+        self._journal.write(line)
+        self._journal_bytes += len(line.encode('utf-8'))
+        self._journal.flush()
+        if self.journal_fsync:
+            os.fsync(self._journal.fileno())
+        self._journal_records += 1
+        if self._compact_event is not None and self._journal_records >= self.compact_records:
+            self._compact_event.set()
+
+    def get_user(self, user_id: int) -> Dict:
+        user_id_str = str(user_id)
+        self._ensure_user(user_id_str)
+        return self.data[user_id_str]
+
+    def find_user(self, user_id: int) -> Optional[Dict]:
+        # Как get_user, но отсутствующего пользователя не создаёт
+        user_id_str = str(user_id)
+        if not self._ensure_user(user_id_str, create=False):
+            return None
+        return self.data[user_id_str]
+
+    # Запросы
+    def version(self, user_id: int) -> int:
+        user_id_str = str(user_id)
+        self._ensure_user(user_id_str)
+        version = self._versions.get(user_id_str)
+        if version is None:
+            # Пользователь из загруженного целиком файла, ещё не менявшийся
+            version = self._versions[user_id_str] = next(self._version_counter)
+        return version
+
+    def task_index(self, user_id: int) -> TaskIndex:
+        user_id_str = str(user_id)
+        self._ensure_user(user_id_str)
+        index = self._indexes.get(user_id_str)
+        if index is None:
+            index = self._indexes[user_id_str] = TaskIndex(self.data[user_id_str]['tasks'])
+        return index
+
+    def search_index(self, user_id: int) -> SearchIndex:
+        user_id_str = str(user_id)
+        self._ensure_user(user_id_str)
+        index = self._search_indexes.get(user_id_str)
+        if index is None:
+            index = self._search_indexes[user_id_str] = SearchIndex(self.data[user_id_str])
+        return index
+
+    def get_active_task(self, user_id: int, task_id: int) -> Optional[Dict]:
+        task = self.task_index(user_id).by_id.get(task_id)
+        if task is None or task.get('completed'):
+            return None
+        return task
+
+    def active_tasks(self, user_id: int, start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+        index = self.task_index(user_id)
+        return [index.by_id[task_id] for task_id in index.active[start:stop]]
+
+    def active_count(self, user_id: int) -> int:
+        return len(self.task_index(user_id).active)
+
+    def done_count(self, user_id: int) -> int:
+        # Выполненные задачи в списке, без архива
+        index = self.task_index(user_id)
+        return len(index.by_id) - len(index.active)
+
+    def category_count(self, user_id: int, category: Optional[str]) -> int:
+        return len(self.task_index(user_id).by_category.get(category, ()))
+
+    def category_tasks(self, user_id: int, category: Optional[str],
+                       start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+        # Активные задачи категории
+        index = self.task_index(user_id)
+        return [index.by_id[task_id] for task_id in index.by_category.get(category, [])[start:stop]]
+
+    def category_counts(self, user_id: int) -> Dict[str, int]:
+        # Число активных задач по категориям
+        index = self.task_index(user_id)
+        return {cat: len(ids) for cat, ids in index.by_category.items() if cat}
+
+    def category_done_count(self, user_id: int, category: Optional[str]) -> int:
+        # Выполненные задачи категории в списке, без архива
+        return self.task_index(user_id).done_by_category.get(category, 0)
+
+    def completed_count(self, user_id: int, category: Optional[str] = None) -> int:
+        # Все выполненные, включая архив — для статистики
+        stats = self.get_user(user_id)['stats']
+        if category is None:
+            return stats['completed']
+        return stats['categories'].get(category, (0, 0))[1]
+
+    def task_stats(self, user_id: int) -> Dict:
+        user = self.get_user(user_id)
+        stats = user['stats']
+        day_created, day_completed = stats['days'].get(user_today(user), (0, 0))
+        return {
+            'total': stats['total'],
+            'completed': stats['completed'],
+            'day_created': day_created,
+            'day_completed': day_completed,
+            'recurring': stats.get('recurring', 0),
+            'repeats': stats.get('repeats', 0),
+            'categories': {
+                cat: {'total': total, 'completed': completed}
+                for cat, (total, completed) in stats['categories'].items()
+            }
+        }
+
+    def pending_reminders(self) -> Iterator[Tuple[str, int, str]]:
+        # Невыполненные задачи с назначенным напоминанием: (пользователь, id, remind_at)
+        for user_id_str, user in self.data.items():
+            for task in user['tasks']:
+                if task.get('remind_at') and not task.get('completed'):
+                    yield user_id_str, task['id'], task['remind_at']
+
+    def _digest_settings(self) -> Iterator[Tuple[str, Dict]]:
+        # Настройки всех пользователей, у которых может быть включена сводка
+        for user_id_str, user in self.data.items():
+            yield user_id_str, user['settings']
+
+    def _index_digest(self, user_id_str: str, settings: Dict):
+        old = self._digest_tz.pop(user_id_str, None)
+        if old is not None:
+            self._digest_index[old].discard(user_id_str)
+        if settings.get('digest'):
+            tz = settings['timezone']
+            self._digest_tz[user_id_str] = tz
+            self._digest_index.setdefault(tz, set()).add(user_id_str)
+
+    def digest_users(self, tz_offset: int) -> List[str]:
+        # Пользователи с включённой утренней сводкой в часовом поясе tz_offset
+        if self._digest_index is None:
+            self._digest_index = {}
+            for user_id_str, settings in self._digest_settings():
+                self._index_digest(user_id_str, settings)
+        return sorted(self._digest_index.get(tz_offset, ()))
+
+    # Резервные копии
+    def backup_snapshot(self) -> Iterator[Tuple[str, str]]:
+        # Вызывается в цикле событий: фиксирует список пользователей и включает
+        # копирование при записи. Возвращённые пары (id, JSON пользователя)
+        # можно читать в потоке; по окончании нужно вызвать end_backup()
+        users = self._backup_users()
+        with self._backup_lock:
+            self._backup_pending = set(users)
+            self._backup_copies = {}
+        return self._backup_iter(users)
+
+    def _backup_users(self) -> List[str]:
+        return list(self.data)
+
+    def _backup_dump(self, user_id_str: str) -> str:
+        return json.dumps(self.data[user_id_str], ensure_ascii=False, separators=(',', ':'))
+
+    def _backup_iter(self, users: List[str]) -> Iterator[Tuple[str, str]]:
+        for user_id_str in users:
+            with self._backup_lock:
+                record = self._backup_copies.pop(user_id_str, None)
+                if record is None:
+                    record = self._backup_dump(user_id_str)
+                self._backup_pending.discard(user_id_str)
+            yield user_id_str, record
+
+    def _backup_preserve(self, user_id_str: str):
+        with self._backup_lock:
+            if user_id_str in self._backup_pending and user_id_str not in self._backup_copies:
+                self._backup_copies[user_id_str] = self._backup_dump(user_id_str)
+                self._backup_copied += 1
+
+    def end_backup(self):
+        with self._backup_lock:
+            self._backup_pending = None
+            self._backup_copies = {}
+
+    def restore_user(self, user_id: int, user: Dict):
+        self._commit({'op': 'user_restore', 'u': str(user_id), 'user': user})
+
+    def backup_stats(self) -> Dict:
+        return {'copied_on_write': self._backup_copied}
+
+    def archived_count(self, user_id: int) -> int:
+        return self.get_user(user_id).get('archive', empty_archive())['count']
+
+    def archived_tasks(self, user_id: int, start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+        # Заархивированные задачи, последние первыми; читаются только нужные сегменты
+        archive = self.get_user(user_id).get('archive', empty_archive())
+        stop = archive['count'] if stop is None else stop
+        return self.archive.page(str(user_id), archive['segments'], start, stop)
+
+    def iter_archived_tasks(self, user_id: int) -> Iterator[Dict]:
+        archive = self.get_user(user_id).get('archive', empty_archive())
+        return self.archive.iter_newest(str(user_id), archive['segments'])
+
+    def archive_candidates(self, cutoff: str) -> Iterator[str]:
+        # Пользователи, у которых могут быть задачи для архивации
+        for user_id_str, user in list(self.data.items()):
+            if user['stats']['completed'] > user.get('archive', empty_archive())['stats']['completed']:
+                yield user_id_str
+
+    def verify_stats(self, user_id: int, fix: bool = True) -> bool:
+        # Пересчитываем счётчики по самим задачам; False — если они разошлись
+        user = self.get_user(user_id)
+        expected = build_stats({'tasks': user['tasks'], 'settings': user['settings'],
+                                'archive': user.get('archive')})
+        if expected == user['stats']:
+            return True
+        logger.warning("Статистика пользователя %s разошлась с задачами", user_id)
+        if fix:
+            self._commit({'op': 'stats_rebuild', 'u': str(user_id)})
+        return False
+
+    # Изменение данных
+    def add_task(self, user_id: int, task: Dict):
+        self._commit({'op': 'task_add', 'u': str(user_id), 'task': task})
+
+    def update_task(self, user_id: int, task_id: int, **fields: Any):
+        self._commit({'op': 'task_set', 'u': str(user_id), 'id': task_id, 'fields': fields})
+
+    def delete_task(self, user_id: int, task_id: int):
+        self._commit({'op': 'task_del', 'u': str(user_id), 'id': task_id})
+
+    def repeat_task(self, user_id: int, task_id: int, done: Dict, **fields: Any):
+        self._commit({'op': 'task_repeat', 'u': str(user_id), 'id': task_id, 'done': done, 'fields': fields})
+
+    def clear_completed(self, user_id: int):
+        self._commit({'op': 'tasks_clear_done', 'u': str(user_id)})
+
+    def import_records(self, user_id: int, tasks: List[Dict], notes: List[Dict]):
+        # Задачи получают id по порядку, как при обычном добавлении
+        self._commit({'op': 'import', 'u': str(user_id), 'tasks': tasks, 'notes': notes})
+
+    @contextmanager
+    def batch(self):
+        # Много операций подряд: вместо перезаписи файла после каждой — одна
+        # запись в конце. Изменения других пользователей за это время тоже
+        # попадают на диск в конце пакета
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._batch_saves:
+                self._batch_saves = 0
+                self.save()
+
+    def add_category(self, user_id: int, name: str):
+        self._commit({'op': 'cat_add', 'u': str(user_id), 'name': name})
+
+    def delete_category(self, user_id: int, name: str):
+        self._commit({'op': 'cat_del', 'u': str(user_id), 'name': name})
+
+    def add_note(self, user_id: int, note: Dict):
+        self._commit({'op': 'note_add', 'u': str(user_id), 'note': note})
+
+    def delete_note(self, user_id: int, note_idx: int):
+        self._commit({'op': 'note_del', 'u': str(user_id), 'i': note_idx})
+
+    def set_setting(self, user_id: int, key: str, value: Any):
+        self._commit({'op': 'setting', 'u': str(user_id), 'key': key, 'value': value})
+
+    def save(self):
+        if self._batch_depth:
+            self._batch_saves += 1
+            return
+
+        if self.mode == MODE_JOURNAL:
+            # Изменение мимо журнала попадёт на диск со следующим снимком
+            self._snapshot_dirty = True
+            if self._compact_event is not None:
+                self._compact_event.set()
+            else:
+                self._save()
+            return
+
+        if self._flusher is None:
+            self._save()
+            return
+
+        self._pending += 1
+        self._dirty_event.set()
+        if self._pending >= self.flush_max_changes:
+            self._full_event.set()
+
+    async def archive_users(self, user_ids: List[str], cutoff: str) -> int:
+        # Сегменты всех пользователей пачки пишутся одним заходом в поток, а
+        # операции фиксируются одним пакетом: в режимах sync и write_behind
+        # это одна запись базы на пачку, а не на пользователя
+        segments = []
+        for user_id_str in user_ids:
+            user = self.get_user(int(user_id_str))
+            # Время выполнения записано по часам сервера, как и cutoff
+            old = [t for t in user['tasks']
+                   if t.get('completed') and (t.get('completed_at') or t['created']) < cutoff]
+            if old:
+                segments.append((user_id_str, user.get('archive', empty_archive())['segments'], old))
+        if not segments:
+            return 0
+        await asyncio.to_thread(self.archive.write_segments, segments, self.journal_fsync)
+        # Пока сегменты писались, задачи могли удалить: в архиве они останутся,
+        # а из базы уходят только те, что ещё на месте
+        with self.batch():
+            for user_id_str, seq, old in segments:
+                self._commit({'op': 'tasks_archive', 'u': user_id_str, 'ids': [t['id'] for t in old], 'seq': seq})
+        return sum(len(old) for _, _, old in segments)
+
+    async def archive_completed(self) -> int:
+        cutoff = (datetime.now() - timedelta(seconds=self.archive_after)).isoformat()
+        started = time.perf_counter()
+        archived = 0
+        candidates = list(self.archive_candidates(cutoff))
+        for start in range(0, len(candidates), ARCHIVE_CHUNK):
+            archived += await self.archive_users(candidates[start:start + ARCHIVE_CHUNK], cutoff)
+            # Между пачками даём циклу событий обработать апдейты
+            await asyncio.sleep(0)
+        self._archive_passes += 1
+        self._archived_tasks += archived
+        if archived:
+            logger.info("В архив перенесено задач: %d за %.3f с", archived, time.perf_counter() - started)
+        return archived
+
+    async def _archive_loop(self):
+        while True:
+            try:
+                await self.archive_completed()
+            except Exception:
+                logger.exception("Ошибка архивации выполненных задач")
+            await asyncio.sleep(self.archive_interval)
+
+    async def _stop_archiver(self):
+        if self._archiver is not None:
+            self._archiver.cancel()
+            try:
+                await self._archiver
+            except asyncio.CancelledError:
+                pass
+            self._archiver = None
+
+    async def start(self):
+        if self.archive_after > 0 and self._archiver is None:
+            self._archiver = asyncio.create_task(self._archive_loop())
+        if self.mode == MODE_WRITE_BEHIND and self._flusher is None:
+            self._dirty_event = asyncio.Event()
+            self._full_event = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._flusher = asyncio.create_task(self._flush_loop())
+        elif self.mode == MODE_JOURNAL and self._compactor is None:
+            self._compact_event = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._compactor = asyncio.create_task(self._compact_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await self._dirty_event.wait()
+            try:
+                await asyncio.wait_for(self._full_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Ошибка фоновой записи базы данных")
+
+    async def flush(self):
+        if self.mode == MODE_JOURNAL:
+            await self.compact()
+            return
+
+        if self._flush_lock is None:
+            self._save()
+            return
+
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            started = time.perf_counter()
+            # Сериализуем в цикле событий, чтобы снимок был согласованным,
+            # а саму запись на диск уводим в поток
+            payload = self._dump()
+            changes = self._pending
+            self._pending = 0
+            self._dirty_event.clear()
+            self._full_event.clear()
+            await asyncio.to_thread(self._write, payload)
+
+            elapsed = time.perf_counter() - started
+            self._flush_count += 1
+            self._flushed_changes += changes
+            self._flush_time_total += elapsed
+            self._flush_time_last = elapsed
+            self._flush_time_max = max(self._flush_time_max, elapsed)
+
+    async def _compact_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._compact_event.wait(), self.compact_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.compact()
+            except Exception:
+                logger.exception("Ошибка сжатия журнала базы данных")
+
+    def _rotate_journal(self):
+        self._journal.close()
+        if self._journal_old_path.exists():
+            # Прошлое сжатие не завершилось — дописываем текущий журнал к старому
+            with open(self._journal_old_path, 'ab') as old, open(self.journal_path, 'rb') as cur:
+                old.write(cur.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self._journal_old_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    async def compact(self):
+        if self._flush_lock is None:
+            if self._journal_records or self._snapshot_dirty:
+                self._rotate_journal()
+                self._write(self._dump(), fsync=True)
+                os.remove(self._journal_old_path)
+                self._journal_records = 0
+                self._snapshot_dirty = False
+            return
+
+        async with self._flush_lock:
+            if self._compact_event is not None:
+                self._compact_event.clear()
+            if not self._journal_records and not self._snapshot_dirty:
+                return
+            started = time.perf_counter()
+            # Записи после ротации попадут в новый журнал; снимок в цикле событий
+            # согласован с уже ротированным, поэтому старый журнал можно удалить
+            self._rotate_journal()
+            records = self._journal_records
+            self._journal_records = 0
+            self._snapshot_dirty = False
+            payload = self._dump()
+            await asyncio.to_thread(self._write, payload, True)
+            os.remove(self._journal_old_path)
+
+            elapsed = time.perf_counter() - started
+            self._compact_count += 1
+            logger.info("Журнал свёрнут в снимок: %d записей за %.3f с", records, elapsed)
+
+    async def close(self):
+        # Финальный сброс при остановке (в т.ч. по SIGTERM)
+        await self._stop_archiver()
+        background = self._flusher or self._compactor
+        if background is not None:
+            # Берём блокировку, чтобы не прервать запись, идущую прямо сейчас
+            async with self._flush_lock:
+                background.cancel()
+            try:
+                await background
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+            self._compactor = None
+            await self.flush()
+            logger.info("База данных сохранена: %s", self.flush_stats())
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def cache_stats(self) -> Dict:
+        lookups = self._cache_hits + self._cache_misses
+        return {
+            'resident_users': len(self.data),
+            'resident_items': self._resident_items,
+            'hits': self._cache_hits,
+            'misses': self._cache_misses,
+            'evictions': self._cache_evictions,
+            'hit_ratio': self._cache_hits / lookups if lookups else 0.0,
+        }
+
+    def flush_stats(self) -> Dict:
+        flushes = self._flush_count
+        return {
+            'mode': self.mode,
+            'flushes': flushes,
+            'flushed_changes': self._flushed_changes,
+            'pending_changes': self._pending,
+            'coalescing_ratio': self._flushed_changes / flushes if flushes else 0.0,
+            'flush_latency_last': self._flush_time_last,
+            'flush_latency_avg': self._flush_time_total / flushes if flushes else 0.0,
+            'flush_latency_max': self._flush_time_max,
+            'journal_records': self._journal_records,
+            'compactions': self._compact_count,
+        }
+
+    def io_stats(self) -> Dict:
+        return {
+            'writes': self._writes,
+            'write_bytes': self._write_bytes,
+            'write_seconds': self._write_time_total,
+            'journal_bytes': self._journal_bytes,
+            'persists': self._persist_count,
+            'persist_seconds': self._persist_time_total,
+        }
+
+    def size_bytes(self) -> int:
+        # Занимаемое на диске место: снимок и журналы
+        paths = (self.path, self.journal_path, self._journal_old_path)
+        return sum(path.stat().st_size for path in paths if path.exists())
+
+    def archive_stats(self) -> Dict:
+        return {
+            'passes': self._archive_passes,
+            'archived': self._archived_tasks,
+        }
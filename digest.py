@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Общий шаблон утренней сводки: подставляются только дата, число задач и строки
+DIGEST_TEMPLATE = "☀️ Доброе утро! Задачи на {date} ({count}):\n\n{tasks}"
+DIGEST_LINE = "▪️ {time}{title}"
+
+# Часовые пояса, которые можно выбрать в настройках
+TIMEZONES = range(-12, 13)
+
+
+def digest_offsets(utc_hour: int, local_hour: int) -> List[int]:
+    # Часовые пояса, в которых сейчас local_hour
+    return [tz for tz in TIMEZONES if (utc_hour + tz) % 24 == local_hour]
+
+
+def format_digest(tasks: List[Dict], today: str, limit: int = 20) -> Optional[str]:
+    # None — если на сегодня задач нет и отправлять нечего
+    if not tasks:
+        return None
+    # Сначала задачи со временем, по времени
+    tasks = sorted(tasks, key=lambda t: (t.get('time') is None, t.get('time') or ''))
+    lines = [
+        DIGEST_LINE.format(time=f"{task['time']} " if task.get('time') else "", title=task['title'])
+        for task in tasks[:limit]
+    ]
+    if len(tasks) > limit:
+        lines.append(f"…и ещё {len(tasks) - limit}")
+    return DIGEST_TEMPLATE.format(
+        date=datetime.fromisoformat(today).strftime('%d.%m'),
+        count=len(tasks),
+        tasks="\n".join(lines)
+    )
+
+
+# Утренняя сводка: фоновая задача просыпается в начале каждого часа по UTC,
+# берёт получателей только из тех часовых поясов, где сейчас hour часов,
+# собирает их сводки и отдаёт отправителю пачками по batch_size. Следующая
+# пачка собирается, когда предыдущая отправлена, поэтому очередь исходящих
+# не разрастается, а работа за час пропорциональна числу получателей
+class DigestJob:
+    def __init__(self, select: Callable[[int], List[str]],
+                 render: Callable[[str], Optional[str]],
+                 send: Callable[[List[Tuple[int, str]]], Awaitable[None]],
+                 hour: int = 8, batch_size: int = 100):
+        self.select = select
+        self.render = render
+        self.send = send
+        self.hour = hour
+        self.batch_size = batch_size
+        self._runner: Optional[asyncio.Task] = None
+
+        self._runs = 0
+        self._recipients = 0
+        self._sent = 0
+        self._last_time = 0.0
+
+    async def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def _run(self):
+        last_hour: Optional[datetime] = None
+        while True:
+            now = datetime.now(timezone.utc)
+            next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            # Таймер может проснуться на несколько миллисекунд раньше начала часа —
+            # тогда следующим снова вышел бы тот же час и сводка ушла бы дважды
+            if last_hour is not None and next_hour <= last_hour:
+                next_hour = last_hour + timedelta(hours=1)
+            await asyncio.sleep((next_hour - now).total_seconds())
+            last_hour = next_hour
+            try:
+                await self.run_hour(next_hour.hour)
+            except Exception:
+                logger.exception("Ошибка рассылки утренней сводки")
+
+    async def run_hour(self, utc_hour: int) -> int:
+        started = time.perf_counter()
+        recipients = sent = 0
+        batch: List[Tuple[int, str]] = []
+        for tz in digest_offsets(utc_hour, self.hour):
+            for user_id_str in self.select(tz):
+                recipients += 1
+                text = self.render(user_id_str)
+                if text is None:
+                    continue
+                batch.append((int(user_id_str), text))
+                if len(batch) >= self.batch_size:
+                    await self.send(batch)
+                    sent += len(batch)
+                    batch = []
+        if batch:
+            await self.send(batch)
+            sent += len(batch)
+
+        self._runs += 1
+        self._recipients += recipients
+        self._sent += sent
+        self._last_time = time.perf_counter() - started
+        if recipients:
+            logger.info("Утренняя сводка (%02d:00 UTC): получателей %d, отправлено %d за %.3f с",
+                        utc_hour, recipients, sent, self._last_time)
+        return sent
+
+    async def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    def stats(self) -> Dict:
+        return {
+            'runs': self._runs,
+            'recipients': self._recipients,
+            'sent': self._sent,
+            'last_run_seconds': self._last_time,
+        }
@@ -0,0 +1,128 @@
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+ALLOWED = 0
+DUPLICATE = 1
+THROTTLED = 2
+
+
+# Защита от частых нажатий. Повтор той же кнопки тем же пользователем в течение
+# duplicate_window секунд после предыдущего нажатия (окно отсчитывается и от
+# конца его обработки) отбрасывается. Остальные нажатия ограничены корзиной
+# токенов: до burst подряд, дальше rate в секунду. Записи неактивных
+# пользователей вычищаются раз в sweep_interval секунд
+class FloodControl:
+    def __init__(self, rate: float = 2.0, burst: int = 5, duplicate_window: float = 1.0,
+                 sweep_interval: float = 60.0):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.sweep_interval = sweep_interval
+        # пользователь -> [токенов, когда посчитано]
+        self._buckets: Dict[int, List[float]] = {}
+        # (пользователь, callback_data) -> время последнего нажатия
+        self._recent: Dict[Tuple[int, str], float] = {}
+        self._last_sweep = time.monotonic()
+
+        self._passed = 0
+        self._dropped = 0
+        self._throttled = 0
+
+    def check(self, user_id: int, data: str) -> int:
+        now = time.monotonic()
+        if now - self._last_sweep >= self.sweep_interval:
+            self._sweep(now)
+
+        key = (user_id, data)
+        last = self._recent.get(key)
+        if last is not None and now - last < self.duplicate_window:
+            self._dropped += 1
+            return DUPLICATE
+
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [float(self.burst), now]
+        else:
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self._throttled += 1
+            return THROTTLED
+        bucket[0] -= 1
+
+        self._recent[key] = now
+        self._passed += 1
+        return ALLOWED
+
+    def done(self, user_id: int, data: str):
+        self._recent[(user_id, data)] = time.monotonic()
+
+    def _sweep(self, now: float):
+        self._last_sweep = now
+        self._recent = {
+            key: last for key, last in self._recent.items() if now - last < self.duplicate_window
+        }
+        self._buckets = {
+            user_id: bucket for user_id, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+        }
+
+    def stats(self) -> Dict:
+        return {
+            'passed': self._passed,
+            'dropped': self._dropped,
+            'throttled': self._throttled,
+            'users': len(self._buckets),
+        }
+
+
+# Внутренний middleware нажатий. Лишние нажатия получают пустой ответ (или
+# throttled_text) без вызова обработчика. Пропущенные отвечаются сразу, чтобы
+# у пользователя остановился индикатор загрузки; обработчики с флагом
+# own_answer отвечают сами — со своим текстом
+class FloodControlMiddleware(BaseMiddleware):
+    def __init__(self, flood: FloodControl, throttled_text: str = "⏳ Не так быстро"):
+        self.flood = flood
+        self.throttled_text = throttled_text
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if not isinstance(event, CallbackQuery) or user is None:
+            return await handler(event, data)
+
+        callback_data = event.data or ''
+        verdict = self.flood.check(user.id, callback_data)
+        if verdict == DUPLICATE:
+            await _answer(event)
+            return None
+        if verdict == THROTTLED:
+            await _answer(event, self.throttled_text)
+            return None
+
+        if not get_flag(data, 'own_answer'):
+            await _answer(event)
+        try:
+            return await handler(event, data)
+        finally:
+            self.flood.done(user.id, callback_data)
+
+
+async def _answer(callback: CallbackQuery, text: Optional[str] = None):
+    # Запрос мог устареть (например, пролежал в очереди за время перезапуска)
+    try:
+        await callback.answer(text)
+    except TelegramBadRequest as e:
+        logger.debug("Не удалось ответить на нажатие: %s", e)
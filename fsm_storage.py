@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional, Set
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fsm_expires ON fsm (expires);
+"""
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'expires')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict] = None, expires: float = 0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.expires = expires
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+# Хранилище состояний FSM в SQLite. Чтения обслуживаются из кэша в памяти,
+# а изменения копятся и записываются одной транзакцией раз в flush_interval
+# секунд (или после flush_max_changes изменений). Диалог, который не трогали
+# дольше ttl секунд, считается брошенным и сбрасывается.
+# Кэш рассчитан на то, что пользователя обслуживает один процесс
+class SqliteStorage(BaseStorage):
+    def __init__(self, path: Path, ttl: float = 86400.0, flush_interval: float = 0.5,
+                 flush_max_changes: int = 500, cache_size: int = 10000):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flush_max_changes = flush_max_changes
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+        self._cache: 'OrderedDict[str, _Record]' = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._full_event: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._flush_count = 0
+        self._flushed_changes = 0
+        self._expired = 0
+
+    def _record(self, key_str: str) -> _Record:
+        now = time.time()
+        record = self._cache.get(key_str)
+        if record is not None:
+            self._cache.move_to_end(key_str)
+            self._cache_hits += 1
+        else:
+            self._cache_misses += 1
+            row = self.conn.execute(
+                "SELECT state, data, expires FROM fsm WHERE key = ?", (key_str,)
+            ).fetchone()
+            record = _Record(row[0], json.loads(row[1]) if row[1] else None, row[2]) if row else _Record()
+            self._cache[key_str] = record
+            self._trim()
+
+        if not record.empty and record.expires < now:
+            # Брошенный диалог: начинаем с чистого листа
+            record.state = None
+            record.data = {}
+            self._dirty.add(key_str)
+            self._expired += 1
+        return record
+
+    def _touch(self, key_str: str, record: _Record):
+        record.expires = time.time() + self.ttl
+        self._dirty.add(key_str)
+        self._ensure_flusher()
+        if self._full_event is not None and len(self._dirty) >= self.flush_max_changes:
+            self._full_event.set()
+
+    def _trim(self):
+        # Вытесняем самые старые записи, кроме ещё не записанных на диск
+        excess = len(self._cache) - self.cache_size
+        if excess <= 0:
+            return
+        if len(self._dirty) >= self.flush_max_changes:
+            self.flush()
+            return
+        victims = []
+        for key_str in self._cache:
+            if len(victims) >= excess:
+                break
+            if key_str not in self._dirty:
+                victims.append(key_str)
+        for key_str in victims:
+            del self._cache[key_str]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key_str = self.key_builder.build(key)
+        record = self._record(key_str)
+        record.state = state.state if isinstance(state, State) else state
+        self._touch(key_str, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._record(self.key_builder.build(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        key_str = self.key_builder.build(key)
+        record = self._record(key_str)
+        record.data = data.copy()
+        self._touch(key_str, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._record(self.key_builder.build(key)).data.copy()
+
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._full_event = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full_event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Не удалось записать состояния FSM")
+
+    def flush(self):
+        now = time.time()
+        if self._dirty:
+            upserts = []
+            deletes = []
+            for key_str in self._dirty:
+                record = self._cache[key_str]
+                if record.empty:
+                    deletes.append((key_str,))
+                else:
+                    upserts.append((key_str, record.state, json.dumps(record.data, ensure_ascii=False),
+                                    record.expires))
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO fsm (key, state, data, expires) VALUES (?, ?, ?, ?)", upserts
+            )
+            self.conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+            self.conn.execute("COMMIT")
+            self._flush_count += 1
+            self._flushed_changes += len(self._dirty)
+            self._dirty.clear()
+            self._trim()
+
+        # Брошенные диалоги, которых нет в кэше, удаляем прямо из таблицы
+        if now - self._last_purge >= min(self.ttl, 600):
+            self._last_purge = now
+            self.conn.execute("DELETE FROM fsm WHERE expires < ?", (now,))
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        self.flush()
+        self.conn.close()
+
+    def stats(self) -> Dict:
+        lookups = self._cache_hits + self._cache_misses
+        return {
+            'cached': len(self._cache),
+            'dirty': len(self._dirty),
+            'hits': self._cache_hits,
+            'misses': self._cache_misses,
+            'hit_ratio': self._cache_hits / lookups if lookups else 0.0,
+            'flushes': self._flush_count,
+            'flushed_changes': self._flushed_changes,
+            'expired': self._expired,
+        }
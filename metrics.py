@@ -0,0 +1,240 @@
+import logging
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # Корзина le — все значения <= le; последняя — +Inf
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+# Метрики процесса. Счётчики и гистограммы обновляются из middleware в цикле
+# событий без блокировок; остальное (база, очередь исходящих, кэши) собирается
+# в момент запроса из их stats()
+class Metrics:
+    def __init__(self, slow_threshold: float = 0.5, user_size: Optional[Callable[[int], int]] = None):
+        self.slow_threshold = slow_threshold
+        self.user_size = user_size
+        self.in_flight = 0
+        self.updates: Dict[str, Histogram] = {}
+        self.update_errors: Counter = Counter()
+        self.handlers: Dict[str, Histogram] = {}
+        self.handler_errors: Counter = Counter()
+        self.slow_updates = 0
+        self._collectors: List[Tuple[str, Callable[[], Dict]]] = []
+
+    def add_collector(self, prefix: str, collect: Callable[[], Dict]):
+        # collect() возвращает плоский словарь; числовые значения становятся метриками prefix_ключ
+        self._collectors.append((prefix, collect))
+
+    def observe_handler(self, name: str, elapsed: float, user_id: Optional[int]):
+        histogram = self.handlers.get(name)
+        if histogram is None:
+            histogram = self.handlers[name] = Histogram()
+        histogram.observe(elapsed)
+        if elapsed >= self.slow_threshold:
+            self.slow_updates += 1
+            size = None
+            if user_id is not None and self.user_size is not None:
+                try:
+                    size = self.user_size(user_id)
+                except Exception:
+                    logger.exception("Не удалось оценить размер пользователя %s", user_id)
+            logger.warning("Медленный апдейт: %s, %.0f мс, пользователь %s, задач и заметок: %s",
+                           name, elapsed * 1000, user_id, size)
+
+    def render(self) -> str:
+        lines = [
+            '# TYPE planner_updates_in_flight gauge',
+            f'planner_updates_in_flight {self.in_flight}',
+            '# TYPE planner_slow_updates_total counter',
+            f'planner_slow_updates_total {self.slow_updates}',
+        ]
+        self._render_histograms(lines, 'planner_update_seconds', 'type', self.updates)
+        self._render_counter(lines, 'planner_update_errors_total', 'type', self.update_errors)
+        self._render_histograms(lines, 'planner_handler_seconds', 'handler', self.handlers)
+        self._render_counter(lines, 'planner_handler_errors_total', 'handler', self.handler_errors)
+
+        for prefix, collect in self._collectors:
+            try:
+                values = collect()
+            except Exception:
+                logger.exception("Не удалось собрать метрики %s", prefix)
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if isinstance(value, (int, float)):
+                    lines.append(f'planner_{prefix}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histograms(lines: List[str], name: str, label: str, histograms: Dict[str, Histogram]):
+        lines.append(f'# TYPE {name} histogram')
+        for value, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels({label: value, "le": bound})} {cumulative}')
+            lines.append(f'{name}_bucket{_labels({label: value, "le": "+Inf"})} {histogram.count}')
+            lines.append(f'{name}_sum{_labels({label: value})} {histogram.sum}')
+            lines.append(f'{name}_count{_labels({label: value})} {histogram.count}')
+
+    @staticmethod
+    def _render_counter(lines: List[str], name: str, label: str, counter: Counter):
+        lines.append(f'# TYPE {name} counter')
+        for value, count in sorted(counter.items()):
+            lines.append(f'{name}{_labels({label: value})} {count}')
+
+
+# Внешний middleware апдейтов: сколько апдейтов в обработке и сколько длится
+# апдейт целиком, включая ожидание блокировки пользователя
+class UpdateMetricsMiddleware(BaseMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        kind = event.event_type if isinstance(event, Update) else type(event).__name__
+        metrics = self.metrics
+        metrics.in_flight += 1
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.update_errors[kind] += 1
+            raise
+        finally:
+            metrics.in_flight -= 1
+            histogram = metrics.updates.get(kind)
+            if histogram is None:
+                histogram = metrics.updates[kind] = Histogram()
+            histogram.observe(time.perf_counter() - started)
+
+
+# Внутренний middleware роутера: здесь уже известно, какой обработчик выбран
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = getattr(getattr(handler_object, 'callback', None), '__name__', 'unknown')
+        user = data.get('event_from_user')
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.metrics.handler_errors[name] += 1
+            raise
+        finally:
+            self.metrics.observe_handler(name, time.perf_counter() - started, user.id if user else None)
+
+
+# Выборочный профилировщик: отдельный поток раз в interval секунд снимает стек
+# потока цикла событий. Результат — свёрнутые стеки (формат flamegraph.pl и
+# speedscope), «модуль:функция;...» и число попаданий
+class SamplingProfiler:
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._samples: Counter = Counter()
+        self.interval = 0.01
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float = 0.01):
+        if self.running:
+            return
+        self.interval = interval
+        self._samples = Counter()
+        self._stop.clear()
+        target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, args=(target,), name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def _run(self, target: int):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{frame.f_globals.get('__name__', '?')}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self._samples[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return '\n'.join(f'{stack} {count}' for stack, count in self._samples.most_common()) + '\n'
+
+
+async def start_metrics_server(metrics: Metrics, profiler: SamplingProfiler,
+                               host: str, port: int) -> web.AppRunner:
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def handle_profile_start(request: web.Request) -> web.Response:
+        interval_ms = float(request.query.get('interval_ms', '10'))
+        profiler.start(max(interval_ms, 1.0) / 1000)
+        return web.Response(text=f"profiling every {profiler.interval * 1000:.0f} ms\n")
+
+    async def handle_profile_stop(request: web.Request) -> web.Response:
+        if not profiler.running:
+            return web.Response(text="profiler is not running\n", status=409)
+        return web.Response(text=profiler.stop())
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_post('/profile/start', handle_profile_start)
+    app.router.add_post('/profile/stop', handle_profile_stop)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики на http://%s:%s/metrics", host, port)
+    return runner
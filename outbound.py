@@ -0,0 +1,250 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import EditMessageText, SendMessage, TelegramMethod
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: чем меньше число, тем раньше уходит сообщение
+PRIORITY_INTERACTIVE = 0   # ответы на действия пользователя
+PRIORITY_BULK = 10         # напоминания, рассылки, сводки
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        # Забираем токен сразу, даже если его ещё нет (баланс уходит в минус),
+        # и возвращаем, сколько ждать до его появления. Так очередность
+        # отправки в пределах одного ведра сохраняется
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def pause(self, now: float, seconds: float):
+        # Ответ 429: ближайший токен появится не раньше чем через seconds
+        self.reserve(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.blocked_until = now + seconds
+
+    def idle(self, now: float) -> bool:
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class _Outgoing:
+    __slots__ = ('method', 'chat_id', 'priority', 'future', 'enqueued', 'ready_at', 'attempt')
+
+    def __init__(self, method: TelegramMethod, chat_id: Any, priority: int, future: asyncio.Future):
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future = future
+        self.enqueued = time.monotonic()
+        # Момент, на который уже забронирован токен чата; None — ещё не бронировали
+        self.ready_at: Optional[float] = None
+        self.attempt = 0
+
+
+def _consume(future: asyncio.Future):
+    # Массовые отправки никто не ждёт: ошибка уже в логе, не даём asyncio
+    # ругаться на неполученное исключение
+    if not future.cancelled():
+        future.exception()
+
+
+# Очередь исходящих запросов к Telegram. Воркеры разбирают её по приоритету и
+# соблюдают общий лимит (global_rate запросов в секунду) и лимит на чат
+# (chat_rate, с запасом chat_burst). Сообщение в «занятый» чат не блокирует воркер, а откладывается
+# до своего времени. На 429 отвечаем паузой на retry_after, на сетевые ошибки
+# и 5xx — повтором с экспоненциальной задержкой
+class OutboundQueue:
+    def __init__(self, bot, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 workers: int = 4, max_retries: int = 5, backoff: float = 1.0):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        # Короткая серия ответов в один чат (несколько нажатий подряд) уходит без задержки
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._counter = itertools.count()
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._deferred = 0
+
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._throttled = 0
+        self._chat_waits = 0
+        self._global_wait_total = 0.0
+        self._latencies: deque = deque(maxlen=1000)
+        self._latency_max = 0.0
+
+    def _ensure_started(self):
+        if self._tasks and not all(task.done() for task in self._tasks):
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def start(self):
+        self._ensure_started()
+
+    def submit(self, method: TelegramMethod, priority: int = PRIORITY_INTERACTIVE) -> asyncio.Future:
+        # Воркеры запускаются с первым запросом, если start() ещё не вызывали
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume)
+        self._put(_Outgoing(method, getattr(method, 'chat_id', None), priority, future))
+        return future
+
+    def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_INTERACTIVE,
+                     **kwargs: Any) -> asyncio.Future:
+        return self.submit(SendMessage(chat_id=chat_id, text=text, **kwargs), priority)
+
+    def edit_message_text(self, chat_id: int, message_id: int, text: str,
+                          priority: int = PRIORITY_INTERACTIVE, **kwargs: Any) -> asyncio.Future:
+        return self.submit(
+            EditMessageText(chat_id=chat_id, message_id=message_id, text=text, **kwargs), priority
+        )
+
+    def _put(self, item: _Outgoing):
+        self._queue.put_nowait((item.priority, next(self._counter), item))
+
+    def _defer(self, item: _Outgoing, delay: float):
+        self._deferred += 1
+
+        def requeue():
+            self._deferred -= 1
+            self._put(item)
+
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    def _chat_bucket(self, chat_id: Any, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                # Забываем чаты, у которых ведро давно заполнено
+                self._chats = {c: b for c, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            _, _, item = await self._queue.get()
+            try:
+                await self._process(item)
+            except Exception:
+                logger.exception("Ошибка в очереди исходящих сообщений")
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, item: _Outgoing):
+        if item.future.done():
+            return
+        now = time.monotonic()
+
+        if item.chat_id is not None and item.ready_at is None:
+            delay = self._chat_bucket(item.chat_id, now).reserve(now)
+            item.ready_at = now + delay
+            if delay > 0:
+                self._chat_waits += 1
+                self._defer(item, delay)
+                return
+        elif item.chat_id is not None:
+            # Токен был забронирован до ответа 429 в этот чат
+            blocked_until = self._chat_bucket(item.chat_id, now).blocked_until
+            if blocked_until > now:
+                self._defer(item, blocked_until - now)
+                return
+
+        delay = self.global_bucket.reserve(now)
+        if delay > 0:
+            self._global_wait_total += delay
+            await asyncio.sleep(delay)
+
+        try:
+            result = await self.bot(item.method)
+        except TelegramRetryAfter as e:
+            self._throttled += 1
+            logger.warning("Telegram просит подождать %s с (чат %s)", e.retry_after, item.chat_id)
+            now = time.monotonic()
+            if item.chat_id is not None:
+                self._chat_bucket(item.chat_id, now).pause(now, e.retry_after)
+            self._retry(item, e, e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._retry(item, e, self.backoff * 2 ** item.attempt)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            latency = time.monotonic() - item.enqueued
+            self._latencies.append(latency)
+            self._latency_max = max(self._latency_max, latency)
+            self._sent += 1
+            if not item.future.done():
+                item.future.set_result(result)
+
+    def _retry(self, item: _Outgoing, error: Exception, delay: float):
+        item.attempt += 1
+        if item.attempt > self.max_retries:
+            self._fail(item, error)
+            return
+        self._retries += 1
+        # retry_after уже учтён в ведре чата, бронировать токен не нужно
+        item.ready_at = time.monotonic() + delay
+        self._defer(item, delay)
+
+    def _fail(self, item: _Outgoing, error: Exception):
+        self._failed += 1
+        logger.warning("Не удалось отправить %s в чат %s: %s",
+                       type(item.method).__name__, item.chat_id, error)
+        if not item.future.done():
+            item.future.set_exception(error)
+
+    async def join(self):
+        # Дождаться, пока очередь и отложенные сообщения опустеют
+        while self._queue is not None and (self._deferred or not self._queue.empty()):
+            await self._queue.join()
+            if self._deferred:
+                await asyncio.sleep(0.05)
+
+    async def close(self, timeout: float = 5.0):
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь исходящих не опустела за %s с: %s", timeout, self.stats())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict:
+        latencies = sorted(self._latencies)
+        return {
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+            'deferred': self._deferred,
+            'sent': self._sent,
+            'failed': self._failed,
+            'retries': self._retries,
+            'throttled': self._throttled,
+            'chat_waits': self._chat_waits,
+            'global_wait_total': self._global_wait_total,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            'latency_max': self._latency_max,
+            'chats': len(self._chats),
+        }
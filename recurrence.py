@@ -0,0 +1,149 @@
+import calendar
+import re
+from datetime import date, timedelta
+from typing import Dict, Optional
+
+# Правило повтора хранится в задаче как {'every': вид, ...}:
+#   day      — каждый день
+#   weekdays — по будням
+#   week     — по дням недели 'days' (0 — понедельник)
+#   month    — каждый месяц 'day' числа (в коротких месяцах — в последний день)
+#   n_days   — каждые 'n' дней начиная с 'start'
+# Задача с правилом хранит только срок ближайшего повтора 'due' (дата в часовом
+# поясе пользователя); следующий срок вычисляется, когда этот повтор выполнен
+KINDS = ('day', 'weekdays', 'week', 'month', 'n_days')
+
+WEEKDAYS = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+# Дни недели узнаём по первым двум буквам: «пн» и «понедельник», «чт» и «четверг»
+_WEEKDAY_PREFIXES = {
+    'пн': 0, 'по': 0, 'вт': 1, 'ср': 2, 'чт': 3, 'че': 3, 'пт': 4, 'пя': 4,
+    'сб': 5, 'су': 5, 'вс': 6, 'во': 6
+}
+
+_N_DAYS = re.compile(r'кажды[ей]\s+(\d+)')
+_MONTH_DAY = re.compile(r'(\d+)\s*(?:-?го\s+)?числа')
+
+
+def _month_day(year: int, month: int, day: int) -> date:
+    return date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def _shift_month(year: int, month: int, delta: int):
+    month += delta
+    return year + (month - 1) // 12, (month - 1) % 12 + 1
+
+
+def next_or_same(rule: Dict, day: date) -> date:
+    # Первый повтор не раньше day
+    kind = rule['every']
+    if kind == 'day':
+        return day
+    if kind == 'weekdays':
+        return day + timedelta(days=7 - day.weekday()) if day.weekday() >= 5 else day
+    if kind == 'week':
+        return min(day + timedelta(days=(weekday - day.weekday()) % 7) for weekday in rule['days'])
+    if kind == 'month':
+        candidate = _month_day(day.year, day.month, rule['day'])
+        if candidate < day:
+            candidate = _month_day(*_shift_month(day.year, day.month, 1), rule['day'])
+        return candidate
+    start = date.fromisoformat(rule['start'])
+    if day <= start:
+        return start
+    return start + timedelta(days=-(-(day - start).days // rule['n']) * rule['n'])
+
+
+def prev_or_same(rule: Dict, day: date) -> Optional[date]:
+    # Последний повтор не позже day; None — если повторов ещё не было
+    kind = rule['every']
+    if kind == 'day':
+        return day
+    if kind == 'weekdays':
+        return day - timedelta(days=day.weekday() - 4) if day.weekday() >= 5 else day
+    if kind == 'week':
+        return max(day - timedelta(days=(day.weekday() - weekday) % 7) for weekday in rule['days'])
+    if kind == 'month':
+        candidate = _month_day(day.year, day.month, rule['day'])
+        if candidate > day:
+            candidate = _month_day(*_shift_month(day.year, day.month, -1), rule['day'])
+        return candidate
+    start = date.fromisoformat(rule['start'])
+    if day < start:
+        return None
+    return start + timedelta(days=(day - start).days // rule['n'] * rule['n'])
+
+
+def next_due(rule: Dict, due: str) -> str:
+    # Срок повтора, следующего за due
+    return next_or_same(rule, date.fromisoformat(due) + timedelta(days=1)).isoformat()
+
+
+def current_due(rule: Dict, due: str, today: str) -> str:
+    # Срок невыполненного повтора на сегодня. Если пропущенный повтор уже
+    # сменился следующим, берём последний наступивший: пропуски не копятся
+    latest = prev_or_same(rule, date.fromisoformat(today))
+    if latest is None:
+        return due
+    return max(due, latest.isoformat())
+
+
+def first_due(rule: Dict, today: str) -> str:
+    return next_or_same(rule, date.fromisoformat(today)).isoformat()
+
+
+def valid_rule(rule) -> bool:
+    if not isinstance(rule, dict) or rule.get('every') not in KINDS:
+        return False
+    kind = rule['every']
+    try:
+        if kind == 'week':
+            return bool(rule['days']) and all(isinstance(d, int) and 0 <= d < 7 for d in rule['days'])
+        if kind == 'month':
+            return isinstance(rule['day'], int) and 1 <= rule['day'] <= 31
+        if kind == 'n_days':
+            date.fromisoformat(rule['start'])
+            return isinstance(rule['n'], int) and rule['n'] >= 1
+    except (KeyError, TypeError, ValueError):
+        return False
+    return True
+
+
+def parse_rule(text: str, today: str) -> Optional[Dict]:
+    # Правило из текста пользователя: «пн ср пт», «каждые 3 дня», «15 числа»,
+    # «каждый день», «по будням». None — если текст не похож на правило
+    text = (text or '').strip().lower()
+    if text in ('каждый день', 'ежедневно'):
+        return {'every': 'day'}
+    if text in ('по будням', 'будни'):
+        return {'every': 'weekdays'}
+
+    match = _N_DAYS.search(text)
+    if match:
+        n = int(match.group(1))
+        if not 1 <= n <= 365:
+            return None
+        return {'every': 'n_days', 'n': n, 'start': today} if n > 1 else {'every': 'day'}
+
+    match = _MONTH_DAY.search(text)
+    if match:
+        day = int(match.group(1))
+        return {'every': 'month', 'day': day} if 1 <= day <= 31 else None
+
+    # Предлоги: «по средам», «во вторник и пятницу»
+    words = [word for word in re.findall(r'\w+', text) if word not in ('по', 'во', 'в', 'и')]
+    if words and all(word[:2] in _WEEKDAY_PREFIXES for word in words):
+        return {'every': 'week', 'days': sorted({_WEEKDAY_PREFIXES[word[:2]] for word in words})}
+    return None
+
+
+def describe(rule: Dict) -> str:
+    kind = rule['every']
+    if kind == 'day':
+        return "каждый день"
+    if kind == 'weekdays':
+        return "по будням"
+    if kind == 'week':
+        return "по дням: " + ", ".join(WEEKDAYS[d] for d in rule['days'])
+    if kind == 'month':
+        return f"каждый месяц {rule['day']}-го числа"
+    return f"каждые {rule['n']} дн."
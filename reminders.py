@@ -0,0 +1,167 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from database import user_today
+from recurrence import current_due, next_due
+
+logger = logging.getLogger(__name__)
+
+# Элемент кучи: [время срабатывания (UTC, timestamp), порядковый номер,
+# пользователь, id задачи, remind_at задачи, действует ли ещё]
+TS, SEQ, USER, TASK, REMIND_AT, ALIVE = range(6)
+
+
+def parse_time(text: str) -> Optional[str]:
+    # Время задачи в формате ЧЧ:ММ; None, если строка не похожа на время
+    try:
+        return datetime.strptime(text.strip(), '%H:%M').strftime('%H:%M')
+    except ValueError:
+        return None
+
+
+def next_fire_time(time_str: str, tz_offset: int, now: Optional[datetime] = None) -> datetime:
+    # Ближайший момент, когда у пользователя на часах будет time_str
+    now = now or datetime.now(timezone.utc)
+    offset = timedelta(hours=tz_offset)
+    local_now = now + offset
+    hour, minute = map(int, time_str.split(':'))
+    local = local_now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if local <= local_now:
+        local += timedelta(days=1)
+    return local - offset
+
+
+def fire_time_on(day: str, time_str: str, tz_offset: int) -> datetime:
+    # Момент (UTC), когда у пользователя на часах будет time_str в день day
+    hour, minute = map(int, time_str.split(':'))
+    local = datetime.fromisoformat(day).replace(hour=hour, minute=minute, tzinfo=timezone.utc)
+    return local - timedelta(hours=tz_offset)
+
+
+def task_remind_at(task: Dict, user: Dict) -> str:
+    # Ближайшее напоминание задачи со временем. У повторяющейся — в день
+    # невыполненного повтора, а если этот момент прошёл — в день следующего
+    tz = user['settings']['timezone']
+    if not task.get('repeat'):
+        return next_fire_time(task['time'], tz).isoformat()
+    due = current_due(task['repeat'], task['due'], user_today(user))
+    moment = fire_time_on(due, task['time'], tz)
+    if moment <= datetime.now(timezone.utc):
+        moment = fire_time_on(next_due(task['repeat'], due), task['time'], tz)
+    return moment.isoformat()
+
+
+# Планировщик напоминаний: все ожидающие напоминания лежат в одной min-куче по
+# времени срабатывания, а фоновая задача спит до ближайшего из них.
+# Отмена помечает элемент недействительным (он выбрасывается при извлечении),
+# поэтому вставка и отмена стоят O(log n)
+class ReminderScheduler:
+    def __init__(self, fire: Callable[[str, int, str], Awaitable[None]]):
+        self.fire = fire
+        self._heap: List[list] = []
+        self._entries: Dict[Tuple[str, int], list] = {}
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._fired = 0
+        self._cancelled = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self, reminders: Iterable[Tuple[str, int, str]]):
+        # Восстановление после перезапуска: собираем кучу за O(n)
+        for user_id_str, task_id, remind_at in reminders:
+            key = (user_id_str, task_id)
+            old = self._entries.get(key)
+            if old is not None:
+                old[ALIVE] = False
+            entry = [datetime.fromisoformat(remind_at).timestamp(), next(self._counter),
+                     user_id_str, task_id, remind_at, True]
+            self._entries[key] = entry
+            self._heap.append(entry)
+        self._heap = [entry for entry in self._heap if entry[ALIVE]]
+        heapq.heapify(self._heap)
+        self._notify()
+
+    def schedule(self, user_id: int, task_id: int, remind_at: str):
+        key = (str(user_id), task_id)
+        self._discard(key)
+        entry = [datetime.fromisoformat(remind_at).timestamp(), next(self._counter),
+                 key[0], task_id, remind_at, True]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        # Будим цикл, только если новое напоминание стало ближайшим
+        if self._heap[0] is entry:
+            self._notify()
+
+    def cancel(self, user_id: int, task_id: int):
+        self._discard((str(user_id), task_id))
+
+    def _discard(self, key: Tuple[str, int]):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        entry[ALIVE] = False
+        self._cancelled += 1
+        # Когда отменённых набирается больше половины кучи, пересобираем её
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [e for e in self._heap if e[ALIVE]]
+            heapq.heapify(self._heap)
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._runner = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            while self._heap and not self._heap[0][ALIVE]:
+                heapq.heappop(self._heap)
+
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][TS] - datetime.now(timezone.utc).timestamp()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            entry = heapq.heappop(self._heap)
+            if not entry[ALIVE]:
+                continue
+            del self._entries[(entry[USER], entry[TASK])]
+            self._fired += 1
+            try:
+                await self.fire(entry[USER], entry[TASK], entry[REMIND_AT])
+            except Exception:
+                logger.exception("Не удалось отправить напоминание %s/%s", entry[USER], entry[TASK])
+
+    async def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+    def stats(self) -> Dict:
+        return {
+            'pending': len(self._entries),
+            'heap_size': len(self._heap),
+            'fired': self._fired,
+            'cancelled': self._cancelled,
+        }
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+# Кэш отрисованных экранов пользователя. Запись действительна, пока не изменилась
+# версия данных пользователя (её повышает каждая операция в Database)
+class RenderCache:
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Tuple[int, Hashable], Tuple[int, Any]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, user_id: int, key: Hashable, version: int, render: Callable[[], Any]) -> Any:
+        cache_key = (user_id, key)
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = render()
+        self._entries[cache_key] = (version, value)
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
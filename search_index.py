@@ -0,0 +1,119 @@
+import re
+from bisect import bisect_left, insort
+from operator import itemgetter
+from typing import Dict, List, Set, Tuple
+
+# Документ индекса: ('t', id задачи) или ('n', порядковый номер заметки)
+DocKey = Tuple[str, int]
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    # lower() корректно работает с кириллицей; «ё» и «е» считаем одной буквой
+    return _WORD.findall((text or '').lower().replace('ё', 'е'))
+
+
+# Инвертированный индекс по названиям активных задач и текстам заметок одного
+# пользователя. Слова хранятся ещё и отсортированным списком, поэтому поиск по
+# префиксу — это бинарный поиск диапазона, а не перебор всех задач и заметок.
+# Заметки адресуются по позиции в списке, а позиции сдвигаются при удалении,
+# поэтому у каждой заметки в индексе свой постоянный номер
+class SearchIndex:
+    def __init__(self, user: Dict):
+        self.rebuild(user)
+
+    def rebuild(self, user: Dict):
+        self.postings: Dict[str, Set[DocKey]] = {}
+        self.words: List[str] = []
+        self.docs: Dict[DocKey, Set[str]] = {}
+        self.note_keys: List[DocKey] = []
+        self._note_counter = 0
+        for task in user['tasks']:
+            if not task.get('completed'):
+                self._add(('t', task['id']), task['title'])
+        for note in user['notes']:
+            self._add_note(note)
+
+    def _add(self, key: DocKey, text: str):
+        words = set(tokenize(text))
+        self.docs[key] = words
+        for word in words:
+            keys = self.postings.get(word)
+            if keys is None:
+                keys = self.postings[word] = set()
+                insort(self.words, word)
+            keys.add(key)
+
+    def _remove(self, key: DocKey):
+        for word in self.docs.pop(key, ()):
+            keys = self.postings[word]
+            keys.discard(key)
+            if not keys:
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+
+    def _add_note(self, note: Dict):
+        key = ('n', self._note_counter)
+        self._note_counter += 1
+        self.note_keys.append(key)
+        self._add(key, note['text'])
+
+    def apply(self, op: Dict, user: Dict):
+        kind = op['op']
+        if kind == 'task_add':
+            task = op['task']
+            if not task.get('completed'):
+                self._add(('t', task['id']), task['title'])
+        elif kind == 'user_restore' or kind in ('task_set', 'task_del') and op.get('id') is None:
+            self.rebuild(user)
+        elif kind == 'task_set':
+            if 'title' not in op['fields'] and 'completed' not in op['fields']:
+                return
+            key = ('t', op['id'])
+            self._remove(key)
+            # Задачи упорядочены по id
+            tasks = user['tasks']
+            pos = bisect_left(tasks, op['id'], key=itemgetter('id'))
+            task = tasks[pos] if pos < len(tasks) and tasks[pos]['id'] == op['id'] else None
+            if task is not None and not task.get('completed'):
+                self._add(key, task['title'])
+        elif kind == 'task_del':
+            self._remove(('t', op['id']))
+        elif kind == 'note_add':
+            self._add_note(op['note'])
+        elif kind == 'import':
+            for task in op['tasks']:
+                if not task.get('completed'):
+                    self._add(('t', task['id']), task['title'])
+            for note in op['notes']:
+                self._add_note(note)
+        elif kind == 'note_del':
+            self._remove(self.note_keys.pop(op['i']))
+
+    def _matching(self, prefix: str) -> Set[DocKey]:
+        # Все документы со словами, начинающимися с prefix
+        found: Set[DocKey] = set()
+        pos = bisect_left(self.words, prefix)
+        while pos < len(self.words) and self.words[pos].startswith(prefix):
+            found |= self.postings[self.words[pos]]
+            pos += 1
+        return found
+
+    def search(self, query: str) -> Tuple[List[int], List[int]]:
+        # Документ подходит, если в нём есть слово на каждый из префиксов
+        # запроса. Возвращает id задач и позиции заметок, новые первыми
+        prefixes = sorted(set(tokenize(query)), key=len, reverse=True)
+        if not prefixes:
+            return [], []
+        found = self._matching(prefixes[0])
+        for prefix in prefixes[1:]:
+            if not found:
+                break
+            found &= self._matching(prefix)
+
+        task_ids = sorted((key[1] for key in found if key[0] == 't'), reverse=True)
+        # Номера заметок растут вместе с позицией, так что позицию находим бинарным поиском
+        note_positions = [bisect_left(self.note_keys, key)
+                          for key in sorted((key for key in found if key[0] == 'n'), reverse=True)]
+        return task_ids, note_positions
@@ -0,0 +1,336 @@
+import argparse
+import asyncio
+import logging
+import os
+import secrets
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiohttp import ClientError, ClientSession, web
+from dotenv import load_dotenv
+
+from archive import archive_dir
+from database import Database, MODE_JOURNAL, MODE_SYNC
+from webhook import wait_for_stop
+
+logger = logging.getLogger(__name__)
+
+WORKER_PATH = '/update'
+
+
+def shard_of(user_id: int, count: int) -> int:
+    # Стабильный хеш: номер шарда не зависит от PYTHONHASHSEED и процесса
+    return zlib.crc32(str(user_id).encode()) % count
+
+
+def shard_path(path: Path, index: int) -> Path:
+    # planner_db.json -> planner_db.shard0.json
+    return path.with_name(f"{path.stem}.shard{index}{path.suffix}")
+
+
+def update_user_id(update: Dict) -> Optional[int]:
+    # Пользователь, от которого пришёл апдейт (сообщение, нажатие кнопки и т.п.)
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        for field in ('from', 'user'):
+            if isinstance(value.get(field), dict):
+                return value[field]['id']
+        chat = value.get('chat') or value.get('message', {}).get('chat')
+        if isinstance(chat, dict):
+            return chat['id']
+    return None
+
+
+# Фронтальный процесс: получает апдейты от Telegram и раздаёт их воркерам по
+# номеру шарда пользователя. У каждого шарда своя очередь и один отправитель,
+# поэтому апдейты пользователя доходят до воркера в исходном порядке. Очередь
+# ограничена queue_size апдейтами: если воркер не успевает (или лежит), новые
+# апдейты его шарда не принимаются, и Telegram повторит их позже
+class ShardRouter:
+    def __init__(self, count: int, base_port: int, secret_token: str, queue_size: int = 10000):
+        self.count = count
+        self.urls = [f"http://127.0.0.1:{base_port + i}{WORKER_PATH}" for i in range(count)]
+        self.secret_token = secret_token
+        self.queue_size = queue_size
+        self._queues: List[asyncio.Queue] = []
+        self._senders: List[asyncio.Task] = []
+        self._session: Optional[ClientSession] = None
+        self._routed = [0] * count
+        self._rejected = [0] * count
+
+    async def start(self):
+        self._session = ClientSession(headers={'X-Telegram-Bot-Api-Secret-Token': self.secret_token})
+        self._queues = [asyncio.Queue(self.queue_size) for _ in range(self.count)]
+        self._senders = [asyncio.create_task(self._send_loop(i)) for i in range(self.count)]
+
+    def route(self, update: Dict) -> bool:
+        # False — очередь шарда заполнена, апдейт не принят
+        user_id = update_user_id(update)
+        index = shard_of(user_id, self.count) if user_id is not None else 0
+        try:
+            self._queues[index].put_nowait(update)
+        except asyncio.QueueFull:
+            self._rejected[index] += 1
+            return False
+        self._routed[index] += 1
+        return True
+
+    async def _send_loop(self, index: int):
+        queue = self._queues[index]
+        while True:
+            update = await queue.get()
+            delay = 0.1
+            while True:
+                try:
+                    async with self._session.post(self.urls[index], json=update) as response:
+                        if response.status == 200:
+                            break
+                        logger.warning("Воркер %d ответил %d", index, response.status)
+                except ClientError as e:
+                    # Воркер ещё запускается или перезапускается — повторяем
+                    logger.debug("Воркер %d недоступен: %s", index, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+            queue.task_done()
+
+    async def close(self, timeout: float = 10.0):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не все апдейты переданы воркерам за %s с", timeout)
+        for task in self._senders:
+            task.cancel()
+        await asyncio.gather(*self._senders, return_exceptions=True)
+        await self._session.close()
+
+    def stats(self) -> Dict:
+        return {
+            'routed': list(self._routed),
+            'rejected': list(self._rejected),
+            'queued': [q.qsize() for q in self._queues],
+        }
+
+
+# Воркеры — обычные процессы bot.py в режиме worker, каждый со своим шардом.
+# Упавший воркер перезапускается; если он падает сразу после запуска, паузы
+# между попытками растут до 30 с. Апдейты его шарда тем временем ждут в очереди
+class WorkerPool:
+    def __init__(self, count: int, base_port: int, secret_token: str):
+        self.count = count
+        self.base_port = base_port
+        self.secret_token = secret_token
+        self._processes: List[Optional[asyncio.subprocess.Process]] = [None] * count
+        self._supervisors: List[asyncio.Task] = []
+        self._stop: Optional[asyncio.Event] = None
+        self._restarts = [0] * count
+
+    async def start(self):
+        self._stop = asyncio.Event()
+        self._supervisors = [asyncio.create_task(self._supervise(i)) for i in range(self.count)]
+
+    async def _spawn(self, index: int) -> asyncio.subprocess.Process:
+        env = dict(
+            os.environ,
+            BOT_MODE='worker',
+            SHARD_INDEX=str(index),
+            SHARD_COUNT=str(self.count),
+            WORKER_PORT=str(self.base_port + index),
+            SHARD_SECRET=self.secret_token
+        )
+        # Отдельная группа процессов: Ctrl+C получает только фронт и сам
+        # останавливает воркеров, когда передаст им всё полученное
+        return await asyncio.create_subprocess_exec(
+            sys.executable, str(Path(__file__).with_name('bot.py')), env=env, start_new_session=True
+        )
+
+    async def _supervise(self, index: int):
+        delay = 1.0
+        while not self._stop.is_set():
+            started = time.monotonic()
+            process = self._processes[index] = await self._spawn(index)
+            if self._stop.is_set():
+                process.terminate()
+            returncode = await process.wait()
+            if self._stop.is_set():
+                return
+            # Проработал минуту — падение не связано с запуском, паузу сбрасываем
+            if time.monotonic() - started > 60:
+                delay = 1.0
+            logger.error("Воркер %d завершился с кодом %s, перезапуск через %.0f с", index, returncode, delay)
+            self._restarts[index] += 1
+            try:
+                await asyncio.wait_for(self._stop.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, 30.0)
+
+    async def close(self):
+        # Каждый супервизор дожидается остановки своего воркера
+        self._stop.set()
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.terminate()
+        await asyncio.gather(*self._supervisors)
+
+    def stats(self) -> Dict:
+        return {'restarts': list(self._restarts)}
+
+
+async def poll_updates(bot: Bot, router: ShardRouter, drop_pending_updates: bool):
+    await bot.delete_webhook(drop_pending_updates=drop_pending_updates)
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=25)
+        except Exception:
+            logger.exception("Ошибка получения апдейтов")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            if not router.route(update.model_dump(mode='json', by_alias=True, exclude_none=True)):
+                # Очередь шарда заполнена: этот и следующие апдейты запросим снова
+                await asyncio.sleep(1)
+                break
+            offset = update.update_id + 1
+
+
+async def serve_webhook(bot: Bot, router: ShardRouter, url: str, path: str,
+                        host: str, port: int, secret_token: Optional[str], drop_pending_updates: bool):
+    async def handle(request: web.Request) -> web.Response:
+        if secret_token and not secrets.compare_digest(
+            request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret_token
+        ):
+            return web.Response(body="Unauthorized", status=401)
+        if not router.route(await request.json()):
+            # Telegram повторит доставку позже
+            return web.Response(body="Shard queue is full", status=503)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    await bot.set_webhook(url + path, secret_token=secret_token, drop_pending_updates=drop_pending_updates)
+    try:
+        await wait_for_stop()
+    finally:
+        await runner.cleanup()
+
+
+async def run_front(count: int, base_port: int):
+    load_dotenv()
+    bot = Bot(token=os.getenv('BOT_TOKEN'))
+    drop_pending_updates = os.getenv('DROP_PENDING_UPDATES', '1') == '1'
+
+    secret_token = secrets.token_urlsafe(32)
+    workers = WorkerPool(count, base_port, secret_token)
+    await workers.start()
+
+    router = ShardRouter(count, base_port, secret_token, int(os.getenv('SHARD_QUEUE_SIZE', '10000')))
+    await router.start()
+
+    try:
+        if os.getenv('BOT_MODE', 'polling') == 'webhook':
+            await serve_webhook(
+                bot, router,
+                url=os.getenv('WEBHOOK_URL', ''),
+                path=os.getenv('WEBHOOK_PATH', '/webhook'),
+                host=os.getenv('WEBHOOK_HOST', '0.0.0.0'),
+                port=int(os.getenv('WEBHOOK_PORT', '8080')),
+                secret_token=os.getenv('WEBHOOK_SECRET') or None,
+                drop_pending_updates=drop_pending_updates
+            )
+        else:
+            poller = asyncio.create_task(poll_updates(bot, router, drop_pending_updates))
+            try:
+                await wait_for_stop()
+            finally:
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+    finally:
+        # Сначала отдаём воркерам всё полученное, затем останавливаем их
+        await router.close()
+        logger.info("Маршрутизация апдейтов: %s, воркеры: %s", router.stats(), workers.stats())
+        await workers.close()
+        await bot.session.close()
+
+
+def reshard(path: Path, count: int, old_count: int = 1) -> List[int]:
+    # Перераспределить пользователей planner_db.json (или old_count шардов)
+    # на count шардов. Бот на время переноса должен быть остановлен
+    sources = [path] if old_count <= 1 else [shard_path(path, i) for i in range(old_count)]
+    users: Dict = {}
+    homes: Dict[str, Path] = {}
+    for source_path in sources:
+        if not source_path.exists():
+            continue
+        journal = source_path.with_name(source_path.name + '.journal')
+        source = Database(source_path, mode=MODE_JOURNAL if journal.exists() else MODE_SYNC)
+        asyncio.run(source.close())
+        users.update(source.data)
+        homes.update(dict.fromkeys(source.data, source_path))
+
+    targets = [path] if count <= 1 else [shard_path(path, i) for i in range(count)]
+    parts: List[Dict] = [{} for _ in targets]
+    for user_id_str, user in users.items():
+        index = shard_of(int(user_id_str), len(targets))
+        parts[index][user_id_str] = user
+        # Архив выполненных задач переезжает вместе с пользователем
+        old_dir = archive_dir(homes[user_id_str]) / user_id_str
+        new_dir = archive_dir(targets[index]) / user_id_str
+        if old_dir != new_dir and old_dir.exists():
+            new_dir.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(old_dir, new_dir)
+
+    for target_path, part in zip(targets, parts):
+        # Журнал старого снимка к новому шарду не относится
+        for suffix in ('.journal', '.journal.old'):
+            target_path.with_name(target_path.name + suffix).unlink(missing_ok=True)
+        target = Database(target_path)
+        target.data = part
+        target.save()
+
+    # Источники, которые не стали шардами, убираем в сторону: иначе запуск с
+    # другим числом шардов снова подхватил бы из них устаревших пользователей
+    for source_path in sources:
+        if source_path in targets:
+            continue
+        for suffix in ('', '.journal', '.journal.old'):
+            old_path = source_path.with_name(source_path.name + suffix)
+            if old_path.exists():
+                os.replace(old_path, old_path.with_name(old_path.name + '.resharded'))
+    return [len(part) for part in parts]
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Запуск бота в несколько процессов и перераспределение данных")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="фронтальный процесс и воркеры")
+    run_parser.add_argument('--workers', type=int, default=int(os.getenv('SHARD_WORKERS', '2')))
+    run_parser.add_argument('--base-port', type=int, default=int(os.getenv('SHARD_BASE_PORT', '8100')))
+
+    reshard_parser = commands.add_parser('reshard', help="перераспределить planner_db.json по шардам "
+                                         "(прежние файлы переименовываются в *.resharded)")
+    reshard_parser.add_argument('shards', type=int)
+    reshard_parser.add_argument('--from', dest='old_count', type=int, default=1,
+                                help="сколько шардов было (1 — один planner_db.json)")
+    reshard_parser.add_argument('--path', type=Path, default=Path('planner_db.json'))
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'run':
+        asyncio.run(run_front(args.workers, args.base_port))
+    else:
+        if os.getenv('DB_BACKEND', 'json') != 'json':
+            raise SystemExit("reshard переносит только JSON-базу (DB_BACKEND=json): "
+                             "базы sqlite и snapshot по шардам не раскладываются")
+        sizes = reshard(args.path, args.shards, args.old_count)
+        print(f"Пользователей по шардам: {sizes}")
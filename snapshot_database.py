@@ -0,0 +1,357 @@
+import argparse
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from database import Database, MODE_JOURNAL, MODE_SYNC, migrate_user
+
+logger = logging.getLogger(__name__)
+
+# Формат снимка: заголовок, записи пользователей (компактный JSON) и в конце
+# индекс — записи фиксированной длины, упорядоченные по id пользователя
+MAGIC = b'PLNSNAP1'
+# Сигнатура, номер последней операции журнала, смещение индекса, число пользователей
+HEADER = struct.Struct('<8sQQQ')
+# id пользователя, смещение и длина записи, флаги, самое раннее время выполнения
+# ещё не заархивированной задачи (0 — таких нет)
+ENTRY = struct.Struct('<qQIBd')
+
+FLAG_REMINDERS = 1  # есть невыполненные задачи с напоминанием
+FLAG_DIGEST = 2     # включена утренняя сводка
+
+
+def _oldest_done(user: Dict) -> float:
+    # Время выполнения записано по часам сервера, как и cutoff архивации
+    times = [t.get('completed_at') or t['created'] for t in user['tasks'] if t.get('completed')]
+    return datetime.fromisoformat(min(times)).timestamp() if times else 0.0
+
+
+def _on_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _encode(user: Dict) -> Tuple[bytes, int, float]:
+    record = json.dumps(user, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return record, _flags(user), _oldest_done(user)
+
+
+def _flags(user: Dict) -> int:
+    flags = 0
+    if any(t.get('remind_at') and not t.get('completed') for t in user['tasks']):
+        flags |= FLAG_REMINDERS
+    if user['settings'].get('digest'):
+        flags |= FLAG_DIGEST
+    return flags
+
+
+# Открытый на чтение снимок. Файл отображается в память, при открытии читается
+# только заголовок, а запись пользователя находится бинарным поиском по индексу
+class SnapshotFile:
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.seq, self._index_offset, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} — не снимок базы")
+
+    def _entry(self, pos: int) -> Tuple[int, int, int, int, float]:
+        return ENTRY.unpack_from(self._map, self._index_offset + pos * ENTRY.size)
+
+    def _find(self, user_id: int) -> Optional[Tuple[int, int, int, int, float]]:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if entry[0] == user_id:
+                return entry
+            if entry[0] < user_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def record(self, user_id_str: str) -> Optional[bytes]:
+        entry = self._find(int(user_id_str))
+        if entry is None:
+            return None
+        _, offset, length, _, _ = entry
+        return self._map[offset:offset + length]
+
+    def entries(self) -> Iterator[Tuple[int, int, int, int, float]]:
+        index = memoryview(self._map)[self._index_offset:self._index_offset + self.count * ENTRY.size]
+        try:
+            yield from ENTRY.iter_unpack(index)
+        finally:
+            index.release()
+
+    def raw(self, offset: int, length: int) -> bytes:
+        return self._map[offset:offset + length]
+
+
+# JSON-база с бинарным снимком: при запуске читается только заголовок,
+# пользователь разбирается из отображённого в память файла при первом
+# обращении. Режимы записи — write_behind и journal: в sync каждое изменение
+# переписывало бы весь снимок. При перезаписи снимка заново кодируются только
+# изменённые пользователи, остальные копируются из старого файла без разбора.
+# В памяти держатся не более cache_users недавно активных пользователей:
+# вытесняемый изменённый пользователь кодируется и ждёт следующей записи
+# снимка, подгружается он тоже оттуда. Каждый снимок пишется в новый файл
+# path.N, а не поверх отображённого в память старого (в Windows такой файл не
+# заменить): текущий — с наибольшим N, прежние удаляются, когда их отпустят
+class SnapshotDatabase(Database):
+    def __init__(self, path: Path, mode: str = MODE_JOURNAL, cache_users: int = 0, cache_items: int = 0,
+                 **kwargs):
+        if mode == MODE_SYNC:
+            raise ValueError("Снимок не поддерживает режим sync: используйте write_behind или journal")
+        # Изменённые после последней записи подгруженные пользователи
+        self._changed: Set[str] = set()
+        # Вытесненные изменённые пользователи, ещё не попавшие в снимок, и
+        # пользователи снимка, который пишется сейчас: (запись, флаги, oldest)
+        self._evicted: Dict[str, Tuple[bytes, int, float]] = {}
+        self._writing: Dict[str, Tuple[bytes, int, float]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Номер текущего файла снимка и прежние файлы, которые ещё не удалось удалить
+        self._generation = 0
+        self._stale: List[Path] = []
+        super().__init__(path, mode=mode, **kwargs)
+        self.cache_users = cache_users
+        self.cache_items = cache_items
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await super().start()
+
+    def _generations(self) -> List[Tuple[int, Path]]:
+        # Файлы снимка по возрастанию номера; path без номера — снимок прежнего формата
+        prefix = self.path.name + '.'
+        found = [(0, self.path)] if self.path.exists() else []
+        if self.path.parent.exists():
+            for path in self.path.parent.iterdir():
+                if path.name.startswith(prefix) and path.name[len(prefix):].isdigit():
+                    found.append((int(path.name[len(prefix):]), path))
+        return sorted(found)
+
+    def _remove_stale(self):
+        # Удалить не получится, пока старое отображение ещё открыто (Windows) —
+        # тогда попробуем после следующей записи
+        for path in self._stale[:]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            self._stale.remove(path)
+
+    def _load(self) -> Dict:
+        self.snapshot: Optional[SnapshotFile] = None
+        generations = self._generations()
+        if generations:
+            self._generation, path = generations[-1]
+            self.snapshot = SnapshotFile(path)
+            self._seq = self.snapshot.seq
+            logger.info("Снимок %s: пользователей %d", path, self.snapshot.count)
+            self._stale = [path for _, path in generations[:-1]]
+            self._remove_stale()
+        return OrderedDict()
+
+    def _replay_journal(self):
+        super()._replay_journal()
+        # Воспроизведённых изменений в снимке ещё нет
+        self._changed.update(self.data)
+
+    def _stored(self, user_id_str: str) -> Optional[bytes]:
+        # Последняя сохранённая запись пользователя. Слои проверяются от новых к
+        # старым, а при переносе записи новый слой заполняется раньше, чем
+        # очищается старый, поэтому читать можно и из потока копии
+        for layer in (self._evicted, self._writing):
+            entry = layer.get(user_id_str)
+            if entry is not None:
+                return entry[0]
+        return self.snapshot.record(user_id_str) if self.snapshot is not None else None
+
+    def _stored_entries(self) -> Iterator[Tuple[str, int, float]]:
+        # Неподгруженные пользователи: (id, флаги, oldest)
+        seen = set(self.data)
+        for layer in (self._evicted, self._writing):
+            for user_id_str, (_, flags, oldest) in list(layer.items()):
+                if user_id_str not in seen:
+                    seen.add(user_id_str)
+                    yield user_id_str, flags, oldest
+        if self.snapshot is not None:
+            for user_id, _, _, flags, oldest in self.snapshot.entries():
+                if str(user_id) not in seen:
+                    yield str(user_id), flags, oldest
+
+    def _load_user(self, user_id_str: str) -> Optional[Dict]:
+        raw = self._stored(user_id_str)
+        if raw is None:
+            return None
+        user = json.loads(raw)
+        if migrate_user(user):
+            self._snapshot_dirty = True
+            self._changed.add(user_id_str)
+        return user
+
+    def _evict_user(self, user_id_str: str, user: Dict):
+        # Неизменённый пользователь уже лежит в одном из слоёв
+        if user_id_str in self._changed:
+            self._changed.discard(user_id_str)
+            self._evicted[user_id_str] = _encode(user)
+
+    def _persist(self, op: Dict):
+        self._changed.add(op['u'])
+        super()._persist(op)
+
+    def _dump(self) -> Tuple[List[bytes], Dict[str, Tuple[bytes, int, float]]]:
+        # Сериализуем в цикле событий. Всё, чего нет в старом снимке, остаётся
+        # в слое _writing до подмены снимка
+        written = {user_id_str: _encode(self.data[user_id_str]) for user_id_str in self._changed}
+        for layer in (self._evicted, self._writing):
+            for user_id_str, entry in layer.items():
+                written.setdefault(user_id_str, entry)
+        sources = {int(user_id_str): entry for user_id_str, entry in written.items()}
+        if self.snapshot is not None:
+            for user_id, offset, length, flags, oldest in self.snapshot.entries():
+                if user_id not in sources:
+                    sources[user_id] = (self.snapshot.raw(offset, length), flags, oldest)
+
+        chunks = [b'']
+        index = []
+        position = HEADER.size
+        for user_id in sorted(sources):
+            record, flags, oldest = sources[user_id]
+            chunks.append(record)
+            index.append(ENTRY.pack(user_id, position, len(record), flags, oldest))
+            position += len(record)
+        chunks[0] = HEADER.pack(MAGIC, self._seq, position, len(index))
+        chunks.extend(index)
+
+        self._writing = written
+        self._evicted = {}
+        self._changed = set()
+        return chunks, written
+
+    def _write(self, payload: Tuple[List[bytes], Dict[str, Tuple[bytes, int, float]]], fsync: bool = False):
+        started = time.perf_counter()
+        chunks, written = payload
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.writelines(chunks)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+            size = f.tell()
+        # Файл с новым номером: старый остаётся нетронутым, пока его читают
+        self._generation += 1
+        path = self.path.with_name(f'{self.path.name}.{self._generation}')
+        os.replace(tmp_path, path)
+        # Новый снимок подменяет старый в цикле событий: запись может идти в
+        # потоке, пока цикл подгружает пользователя. Старое отображение
+        # закроется само, когда его перестанут читать
+        snapshot = SnapshotFile(path)
+        if self._loop is None or _on_loop():
+            self._swap(snapshot, written)
+        else:
+            self._loop.call_soon_threadsafe(self._swap, snapshot, written)
+        self._writes += 1
+        self._write_bytes += size
+        self._write_time_total += time.perf_counter() - started
+
+    def _swap(self, snapshot: SnapshotFile, written: Dict[str, Tuple[bytes, int, float]]):
+        if self.snapshot is not None:
+            self._stale.append(self.snapshot.path)
+        self.snapshot = snapshot
+        # Если запись не удалась, слой останется и попадёт в следующий снимок
+        if self._writing is written:
+            self._writing = {}
+        self._remove_stale()
+
+    def pending_reminders(self) -> Iterator[Tuple[str, int, str]]:
+        yield from super().pending_reminders()
+        # Неподгруженных пользователей разбираем, только если у них есть
+        # напоминания, и в память не подгружаем
+        for user_id_str, flags, _ in self._stored_entries():
+            if not flags & FLAG_REMINDERS:
+                continue
+            for task in json.loads(self._stored(user_id_str))['tasks']:
+                if task.get('remind_at') and not task.get('completed'):
+                    yield user_id_str, task['id'], task['remind_at']
+
+    def _digest_settings(self) -> Iterator[Tuple[str, Dict]]:
+        yield from super()._digest_settings()
+        for user_id_str, flags, _ in self._stored_entries():
+            if flags & FLAG_DIGEST:
+                yield user_id_str, json.loads(self._stored(user_id_str))['settings']
+
+    def _backup_users(self) -> List[str]:
+        return list(self.data) + [user_id_str for user_id_str, _, _ in self._stored_entries()]
+
+    def _backup_dump(self, user_id_str: str) -> str:
+        # Пользователь без копии при записи не менялся с начала копии, поэтому
+        # любая его сохранённая запись соответствует её началу
+        user = self.data.get(user_id_str)
+        if user is not None:
+            return json.dumps(user, ensure_ascii=False, separators=(',', ':'))
+        return self._stored(user_id_str).decode('utf-8')
+
+    def archive_candidates(self, cutoff: str) -> Iterator[str]:
+        yield from super().archive_candidates(cutoff)
+        threshold = datetime.fromisoformat(cutoff).timestamp()
+        for user_id_str, _, oldest in self._stored_entries():
+            if oldest and oldest < threshold:
+                yield user_id_str
+
+    async def archive_users(self, user_ids: List[str], cutoff: str) -> int:
+        # Кандидаты с диска подгружаются только на время архивации
+        cold = [user_id_str for user_id_str in user_ids if user_id_str not in self.data]
+        archived = await super().archive_users(user_ids, cutoff)
+        for user_id_str in cold:
+            if user_id_str in self.data:
+                self._unload(user_id_str)
+        return archived
+
+    def cache_stats(self) -> Dict:
+        return {**super().cache_stats(), 'evicted_unsaved': len(self._evicted)}
+
+    def size_bytes(self) -> int:
+        size = super().size_bytes()
+        if self.snapshot is not None and self.snapshot.path != self.path:
+            size += self.snapshot.path.stat().st_size
+        return size
+
+
+def migrate_json(json_path: Path, snapshot_path: Path) -> int:
+    # Однократный перевод planner_db.json (вместе с журналом) в бинарный снимок
+    journal_path = json_path.with_name(json_path.name + '.journal')
+    source = Database(json_path, mode=MODE_JOURNAL if journal_path.exists() else MODE_SYNC)
+    asyncio.run(source.close())
+
+    db = SnapshotDatabase(snapshot_path)
+    db.data.update(source.data)
+    db._changed.update(source.data)
+    db._save()
+    asyncio.run(db.close())
+    return len(source.data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Перевод planner_db.json в бинарный снимок")
+    parser.add_argument('json_path', type=Path, nargs='?', default=Path('planner_db.json'))
+    parser.add_argument('snapshot_path', type=Path, nargs='?', default=Path('planner_db.snap'))
+    args = parser.parse_args()
+    count = migrate_json(args.json_path, args.snapshot_path)
+    print(f"Перенесено пользователей: {count}")
@@ -0,0 +1,526 @@
+import argparse
+import asyncio
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from database import (
+    Database, MODE_JOURNAL, MODE_SYNC, NO_CATEGORY, build_stats, empty_archive, find_task, migrate_user,
+    new_user, user_today
+)
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    settings TEXT NOT NULL,
+    next_task_id INTEGER,
+    stats TEXT,
+    archive TEXT
+);
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (user_id, name)
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    task_id INTEGER,
+    title TEXT,
+    created TEXT NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    completed_at TEXT,
+    time TEXT,
+    category TEXT,
+    remind_at TEXT,
+    extra TEXT
+);
+-- Списки, фильтр по категории и статистика читаются запросами по этим индексам
+CREATE INDEX IF NOT EXISTS tasks_user_completed ON tasks (user_id, completed);
+CREATE INDEX IF NOT EXISTS tasks_user_category ON tasks (user_id, category);
+CREATE INDEX IF NOT EXISTS tasks_user_created ON tasks (user_id, created);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    text TEXT,
+    created TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS notes_user ON notes (user_id);
+"""
+
+# Колонки, добавленные после первой версии схемы
+UPGRADES = (
+    ('users', 'next_task_id', 'INTEGER'),
+    ('tasks', 'task_id', 'INTEGER'),
+    ('users', 'stats', 'TEXT'),
+    ('tasks', 'remind_at', 'TEXT'),
+    ('users', 'archive', 'TEXT'),
+)
+
+INDEXES = """
+CREATE UNIQUE INDEX IF NOT EXISTS tasks_user_task ON tasks (user_id, task_id);
+CREATE INDEX IF NOT EXISTS tasks_remind ON tasks (remind_at) WHERE remind_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS users_digest ON users (json_extract(settings, '$.timezone'))
+    WHERE json_extract(settings, '$.digest') = 1;
+"""
+
+TASK_COLUMNS = ('id', 'title', 'created', 'completed', 'completed_at', 'time', 'category', 'remind_at')
+NOTE_COLUMNS = ('text', 'created')
+
+
+def _extra(record: Dict, columns) -> Optional[str]:
+    # Поля, для которых нет отдельной колонки, хранятся одним JSON
+    extra = {k: v for k, v in record.items() if k not in columns}
+    return json.dumps(extra, ensure_ascii=False) if extra else None
+
+
+def _task_row(task: Dict) -> tuple:
+    return (
+        task.get('id'), task.get('title'), task['created'], 1 if task.get('completed') else 0,
+        task.get('completed_at'), task.get('time'), task.get('category'), task.get('remind_at'),
+        _extra(task, TASK_COLUMNS)
+    )
+
+
+def _task_from_row(row) -> Dict:
+    task = {
+        'id': row['task_id'],
+        'title': row['title'],
+        'created': row['created'],
+        'completed': bool(row['completed']),
+        'time': row['time'],
+        'category': row['category']
+    }
+    if row['completed_at'] is not None:
+        task['completed_at'] = row['completed_at']
+    if row['remind_at'] is not None:
+        task['remind_at'] = row['remind_at']
+    if row['extra']:
+        task.update(json.loads(row['extra']))
+    return task
+
+
+def _day_bounds(day: str, tz_offset: int) -> Tuple[str, str]:
+    # Границы дня пользователя по часам сервера: так записаны created и completed_at
+    start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc) - timedelta(hours=tz_offset)
+    end = start + timedelta(days=1)
+    return (start.astimezone().replace(tzinfo=None).isoformat(),
+            end.astimezone().replace(tzinfo=None).isoformat())
+
+
+def _note_from_row(row) -> Dict:
+    note = {'text': row['text'], 'created': row['created']}
+    if row['extra']:
+        note.update(json.loads(row['extra']))
+    return note
+
+
+# База данных в SQLite: по строке на пользователя, задачу, заметку и категорию.
+# Документы пользователей собираются из строк при первом обращении, а каждая
+# операция записывает только затронутые строки
+def _read_user(conn: sqlite3.Connection, row) -> Tuple[Dict, List[int], List[int]]:
+    # Документ пользователя из строки users и его задач, заметок и категорий,
+    # а также id строк задач и заметок в порядке списков документа
+    user_id_str = row['user_id']
+    user = {
+        'tasks': [],
+        'notes': [],
+        'categories': [r['name'] for r in conn.execute(
+            "SELECT name FROM categories WHERE user_id = ? ORDER BY id", (user_id_str,)
+        )],
+        'settings': json.loads(row['settings']),
+        'archive': json.loads(row['archive']) if row['archive'] is not None else empty_archive()
+    }
+    if row['next_task_id'] is not None:
+        user['next_task_id'] = row['next_task_id']
+    if row['stats'] is not None:
+        user['stats'] = json.loads(row['stats'])
+    task_ids = []
+    for r in conn.execute("SELECT * FROM tasks WHERE user_id = ? ORDER BY id", (user_id_str,)):
+        user['tasks'].append(_task_from_row(r))
+        task_ids.append(r['id'])
+    note_ids = []
+    for r in conn.execute("SELECT * FROM notes WHERE user_id = ? ORDER BY id", (user_id_str,)):
+        user['notes'].append(_note_from_row(r))
+        note_ids.append(r['id'])
+    return user, task_ids, note_ids
+
+
+class SqliteDatabase(Database):
+    def __init__(self, path: Path, cache_users: int = 0, cache_items: int = 0,
+                 archive_after: float = 0.0, archive_interval: float = 3600.0):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._upgrade_schema()
+
+        # id строк заметок в том же порядке, что и список в документе
+        self._note_ids: Dict[str, List[int]] = {}
+        super().__init__(path, archive_after=archive_after, archive_interval=archive_interval)
+
+        # Документы подгружаются по одному, поэтому держим в памяти только
+        # недавно активных пользователей
+        self.cache_users = cache_users
+        self.cache_items = cache_items
+
+    def _upgrade_schema(self):
+        for table, column, column_type in UPGRADES:
+            columns = {r['name'] for r in self.conn.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        self.conn.executescript(INDEXES)
+
+    def _load(self) -> Dict:
+        return OrderedDict()
+
+    def _save(self):
+        pass
+
+    def _load_user(self, user_id_str: str) -> Optional[Dict]:
+        row = self.conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id_str,)).fetchone()
+        if row is None:
+            return None
+
+        user, row_ids, note_ids = _read_user(self.conn, row)
+        if 'next_task_id' not in user:
+            # Пользователь из базы до появления id задач
+            for task in user['tasks']:
+                del task['id']
+            migrate_user(user)
+            self.conn.executemany(
+                "UPDATE tasks SET task_id = ? WHERE id = ?",
+                [(task['id'], row_id) for task, row_id in zip(user['tasks'], row_ids)]
+            )
+            self._update_user_row(user_id_str, user)
+        if 'stats' not in user:
+            build_stats(user)
+            self._update_user_row(user_id_str, user)
+
+        self._note_ids[user_id_str] = note_ids
+        return user
+
+    def _evict_user(self, user_id_str: str, user: Dict):
+        # Все изменения уже в базе, достаточно забыть документ
+        self._note_ids.pop(user_id_str, None)
+
+    def _insert_user(self, user_id_str: str, user: Dict):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, settings, next_task_id, stats, archive) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id_str, json.dumps(user['settings'], ensure_ascii=False), user['next_task_id'],
+             json.dumps(user['stats'], ensure_ascii=False), json.dumps(user['archive'], ensure_ascii=False))
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO categories (user_id, name) VALUES (?, ?)",
+            [(user_id_str, name) for name in user['categories']]
+        )
+
+    def _insert_task(self, user_id_str: str, task: Dict):
+        self.conn.execute(
+            "INSERT INTO tasks (user_id, task_id, title, created, completed, completed_at, time, category, "
+            "remind_at, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id_str, *_task_row(task))
+        )
+
+    def _update_user_row(self, user_id_str: str, user: Dict):
+        # Настройки, счётчик id, статистика и сводка архива лежат в одной строке пользователя
+        self.conn.execute(
+            "UPDATE users SET settings = ?, next_task_id = ?, stats = ?, archive = ? WHERE user_id = ?",
+            (json.dumps(user['settings'], ensure_ascii=False), user.get('next_task_id'),
+             json.dumps(user['stats'], ensure_ascii=False) if 'stats' in user else None,
+             json.dumps(user['archive'], ensure_ascii=False), user_id_str)
+        )
+
+    def _insert_note(self, user_id_str: str, note: Dict) -> int:
+        cur = self.conn.execute(
+            "INSERT INTO notes (user_id, text, created, extra) VALUES (?, ?, ?, ?)",
+            (user_id_str, note.get('text'), note['created'], _extra(note, NOTE_COLUMNS))
+        )
+        return cur.lastrowid
+
+    def _persist(self, op: Dict):
+        # Все строки одной операции пишутся одной транзакцией: сбой между
+        # строками задач и строкой пользователя не рассогласует таблицы
+        self.conn.execute("BEGIN")
+        try:
+            self._write_op(op)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def _write_op(self, op: Dict):
+        u = op['u']
+        kind = op['op']
+        user = self.data[u]
+
+        if kind == 'user_new':
+            self._insert_user(u, user)
+            self._note_ids[u] = []
+        elif kind == 'task_add':
+            self._insert_task(u, op['task'])
+            self._update_user_row(u, user)
+        elif kind == 'task_set':
+            task = user['tasks'][find_task(user, op['id'])]
+            self.conn.execute(
+                "UPDATE tasks SET task_id = ?, title = ?, created = ?, completed = ?, completed_at = ?, "
+                "time = ?, category = ?, remind_at = ?, extra = ? WHERE user_id = ? AND task_id = ?",
+                (*_task_row(task), u, op['id'])
+            )
+            self._update_user_row(u, user)
+        elif kind == 'task_repeat':
+            task = user['tasks'][find_task(user, op['id'])]
+            self.conn.execute(
+                "UPDATE tasks SET task_id = ?, title = ?, created = ?, completed = ?, completed_at = ?, "
+                "time = ?, category = ?, remind_at = ?, extra = ? WHERE user_id = ? AND task_id = ?",
+                (*_task_row(task), u, op['id'])
+            )
+            self._insert_task(u, op['done'])
+            self._update_user_row(u, user)
+        elif kind == 'task_del':
+            self.conn.execute("DELETE FROM tasks WHERE user_id = ? AND task_id = ?", (u, op['id']))
+            self._update_user_row(u, user)
+        elif kind == 'tasks_clear_done':
+            self.conn.execute("DELETE FROM tasks WHERE user_id = ? AND completed = 1", (u,))
+            self._update_user_row(u, user)
+        elif kind == 'import':
+            self.conn.executemany(
+                "INSERT INTO tasks (user_id, task_id, title, created, completed, completed_at, time, category, "
+                "remind_at, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(u, *_task_row(task)) for task in op['tasks']]
+            )
+            self._note_ids[u].extend(self._insert_note(u, note) for note in op['notes'])
+            self._update_user_row(u, user)
+        elif kind == 'tasks_archive':
+            placeholders = ', '.join('?' * len(op['ids']))
+            self.conn.execute(
+                f"DELETE FROM tasks WHERE user_id = ? AND task_id IN ({placeholders})", (u, *op['ids'])
+            )
+            self._update_user_row(u, user)
+        elif kind == 'cat_add':
+            self.conn.execute("INSERT OR IGNORE INTO categories (user_id, name) VALUES (?, ?)", (u, op['name']))
+        elif kind == 'cat_del':
+            self.conn.execute("DELETE FROM categories WHERE user_id = ? AND name = ?", (u, op['name']))
+            self.conn.execute("UPDATE tasks SET category = NULL WHERE user_id = ? AND category = ?", (u, op['name']))
+            self._update_user_row(u, user)
+        elif kind == 'note_add':
+            self._note_ids[u].append(self._insert_note(u, op['note']))
+        elif kind == 'note_del':
+            self.conn.execute("DELETE FROM notes WHERE id = ?", (self._note_ids[u].pop(op['i']),))
+        elif kind in ('setting', 'stats_rebuild'):
+            self._update_user_row(u, user)
+        elif kind == 'user_restore':
+            for table in ('tasks', 'notes', 'categories'):
+                self.conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (u,))
+            self._insert_user(u, user)
+            for task in user['tasks']:
+                self._insert_task(u, task)
+            self._note_ids[u] = [self._insert_note(u, note) for note in user['notes']]
+        else:
+            raise ValueError(f"Неизвестная операция: {kind}")
+
+    def pending_reminders(self):
+        # Пользователей в памяти может не быть, поэтому читаем прямо из таблицы
+        for r in self.conn.execute(
+            "SELECT user_id, task_id, remind_at FROM tasks WHERE remind_at IS NOT NULL AND completed = 0"
+        ):
+            yield r['user_id'], r['task_id'], r['remind_at']
+
+    def archive_candidates(self, cutoff: str):
+        # Выбираем прямо из таблиц, не подгружая всех пользователей: выполненные
+        # задачи каждого ищутся по индексу (user_id, completed)
+        for r in self.conn.execute(
+            "SELECT user_id FROM users WHERE EXISTS (SELECT 1 FROM tasks WHERE tasks.user_id = users.user_id "
+            "AND completed = 1 AND COALESCE(completed_at, created) < ?)",
+            (cutoff,)
+        ):
+            yield r['user_id']
+
+    # Запросы обработчиков читают таблицы по индексам, а не списки документа.
+    # Каждая операция записывается в _persist сразу, поэтому таблицы совпадают
+    # с документами в памяти. Порядок — по id задачи, как в TaskIndex
+    def get_active_task(self, user_id: int, task_id: int) -> Optional[Dict]:
+        row = self.conn.execute(
+            "SELECT * FROM tasks WHERE user_id = ? AND task_id = ? AND completed = 0", (str(user_id), task_id)
+        ).fetchone()
+        return _task_from_row(row) if row is not None else None
+
+    def active_tasks(self, user_id: int, start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+        return [_task_from_row(r) for r in self.conn.execute(
+            "SELECT * FROM tasks WHERE user_id = ? AND completed = 0 ORDER BY task_id LIMIT ? OFFSET ?",
+            (str(user_id), -1 if stop is None else max(stop - start, 0), start)
+        )]
+
+    def active_count(self, user_id: int) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND completed = 0", (str(user_id),)
+        ).fetchone()[0]
+
+    def done_count(self, user_id: int) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND completed = 1", (str(user_id),)
+        ).fetchone()[0]
+
+    def category_count(self, user_id: int, category: Optional[str]) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND category IS ? AND completed = 0",
+            (str(user_id), category)
+        ).fetchone()[0]
+
+    def category_done_count(self, user_id: int, category: Optional[str]) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND category IS ? AND completed = 1",
+            (str(user_id), category)
+        ).fetchone()[0]
+
+    def category_tasks(self, user_id: int, category: Optional[str],
+                       start: int = 0, stop: Optional[int] = None) -> List[Dict]:
+        return [_task_from_row(r) for r in self.conn.execute(
+            "SELECT * FROM tasks WHERE user_id = ? AND category IS ? AND completed = 0 "
+            "ORDER BY task_id LIMIT ? OFFSET ?",
+            (str(user_id), category, -1 if stop is None else max(stop - start, 0), start)
+        )]
+
+    def category_counts(self, user_id: int) -> Dict[str, int]:
+        return {r['category']: r['count'] for r in self.conn.execute(
+            "SELECT category, COUNT(*) AS count FROM tasks "
+            "WHERE user_id = ? AND category IS NOT NULL AND completed = 0 GROUP BY category",
+            (str(user_id),)
+        )}
+
+    def task_stats(self, user_id: int) -> Dict:
+        # Задачи в списке считаются запросами, вклад архива берётся из его сводки
+        user_id_str = str(user_id)
+        row = self.conn.execute(
+            "SELECT settings, stats, archive FROM users WHERE user_id = ?", (user_id_str,)
+        ).fetchone()
+        if row is None:
+            return {'total': 0, 'completed': 0, 'day_created': 0, 'day_completed': 0,
+                    'recurring': 0, 'repeats': 0, 'categories': {}}
+        settings = json.loads(row['settings'])
+        stats = json.loads(row['stats']) if row['stats'] is not None else {}
+        archived = (json.loads(row['archive']) if row['archive'] is not None else empty_archive())['stats']
+
+        categories = {cat: [total, completed] for cat, (total, completed) in archived['categories'].items()}
+        for r in self.conn.execute(
+            "SELECT category, COUNT(*) AS total, SUM(completed) AS completed FROM tasks "
+            "WHERE user_id = ? GROUP BY category ORDER BY MIN(task_id)",
+            (user_id_str,)
+        ):
+            pair = categories.setdefault(r['category'] or NO_CATEGORY, [0, 0])
+            pair[0] += r['total']
+            pair[1] += r['completed']
+
+        today = user_today({'settings': settings})
+        day_start, day_end = _day_bounds(today, settings['timezone'])
+        day_created, day_completed = archived['days'].get(today, (0, 0))
+        day_created += self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND created >= ? AND created < ?",
+            (user_id_str, day_start, day_end)
+        ).fetchone()[0]
+        day_completed += self.conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE user_id = ? AND completed = 1 "
+            "AND completed_at >= ? AND completed_at < ?",
+            (user_id_str, day_start, day_end)
+        ).fetchone()[0]
+        return {
+            'total': sum(total for total, _ in categories.values()),
+            'completed': sum(completed for _, completed in categories.values()),
+            'day_created': day_created,
+            'day_completed': day_completed,
+            'recurring': stats.get('recurring', 0),
+            'repeats': stats.get('repeats', 0),
+            'categories': {
+                cat: {'total': total, 'completed': completed} for cat, (total, completed) in categories.items()
+            }
+        }
+
+    def digest_users(self, tz_offset: int):
+        # Частичный индекс по часовому поясу содержит только получателей сводки
+        return [r['user_id'] for r in self.conn.execute(
+            "SELECT user_id FROM users WHERE json_extract(settings, '$.digest') = 1 "
+            "AND json_extract(settings, '$.timezone') = ? ORDER BY user_id",
+            (tz_offset,)
+        )]
+
+    def backup_snapshot(self) -> Iterator[Tuple[str, str]]:
+        # Копирование при записи не нужно: отдельное соединение в потоке копии
+        # читает в одной транзакции, а в режиме WAL она видит базу на момент
+        # первого запроса и не мешает записи
+        return self._backup_rows()
+
+    def _backup_rows(self) -> Iterator[Tuple[str, str]]:
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN")
+            for row in conn.execute("SELECT * FROM users ORDER BY user_id"):
+                user, _, _ = _read_user(conn, row)
+                yield row['user_id'], json.dumps(user, ensure_ascii=False, separators=(',', ':'))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def save(self):
+        # Все изменения уже записаны построчно в _persist
+        pass
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        await self._stop_archiver()
+        self.conn.close()
+
+    def flush_stats(self) -> Dict:
+        return {'mode': 'sqlite', **self.cache_stats()}
+
+    def size_bytes(self) -> int:
+        paths = (self.path, self.path.with_name(self.path.name + '-wal'))
+        return sum(path.stat().st_size for path in paths if path.exists())
+
+
+def migrate_json(json_path: Path, sqlite_path: Path) -> int:
+    # Однократный перенос planner_db.json в SQLite
+    db = SqliteDatabase(sqlite_path)
+    if db.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None:
+        db.conn.close()
+        raise SystemExit(f"В {sqlite_path} уже есть данные: перенос делается только в пустую базу")
+
+    # Незавершённые записи журнала тоже переносим
+    journal_path = json_path.with_name(json_path.name + '.journal')
+    source = Database(json_path, mode=MODE_JOURNAL if journal_path.exists() else MODE_SYNC)
+    asyncio.run(source.close())
+    data = source.data
+
+    db.conn.execute("BEGIN")
+    for user_id_str, user in data.items():
+        template = new_user()
+        template.update(user)
+        db._insert_user(user_id_str, template)
+        for task in template['tasks']:
+            db._insert_task(user_id_str, task)
+        for note in template['notes']:
+            db._insert_note(user_id_str, note)
+    db.conn.execute("COMMIT")
+    db.conn.close()
+    return len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Перенос planner_db.json в SQLite")
+    parser.add_argument('json_path', type=Path, nargs='?', default=Path('planner_db.json'))
+    parser.add_argument('sqlite_path', type=Path, nargs='?', default=Path('planner_db.sqlite3'))
+    args = parser.parse_args()
+    count = migrate_json(args.json_path, args.sqlite_path)
+    print(f"Перенесено пользователей: {count}")
@@ -0,0 +1,48 @@
+import asyncio
+from pathlib import Path
+
+from database import MODE_WRITE_BEHIND
+from snapshot_database import SnapshotDatabase
+
+
+def make_task(title):
+    return {'title': title, 'created': '2026-01-01T09:00:00', 'completed': False,
+            'time': None, 'category': None}
+
+
+def write(path: Path, titles):
+    async def run():
+        db = SnapshotDatabase(path, mode=MODE_WRITE_BEHIND)
+        await db.start()
+        for user_id, title in enumerate(titles, 1):
+            db.add_task(user_id, make_task(title))
+        await db.close()
+    asyncio.run(run())
+
+
+def test_snapshot_generations(tmp_path: Path):
+    path = tmp_path / 'db.snap'
+    # Каждая запись — новый файл, поверх открытого снимка ничего не пишется
+    write(path, ['первая'])
+    assert [p.name for p in tmp_path.iterdir()] == ['db.snap.1']
+    write(path, ['вторая', 'третья'])
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['db.snap.2']
+
+    db = SnapshotDatabase(path, mode=MODE_WRITE_BEHIND)
+    assert [t['title'] for t in db.get_user(1)['tasks']] == ['первая', 'вторая']
+    assert [t['title'] for t in db.get_user(2)['tasks']] == ['третья']
+    assert db.size_bytes() == (tmp_path / 'db.snap.2').stat().st_size
+    asyncio.run(db.close())
+
+
+def test_legacy_snapshot(tmp_path: Path):
+    # Снимок без номера из прежних версий читается и заменяется нумерованным
+    path = tmp_path / 'db.snap'
+    write(path, ['старая'])
+    (tmp_path / 'db.snap.1').rename(path)
+
+    write(path, ['новая'])
+    assert [p.name for p in tmp_path.iterdir()] == ['db.snap.1']
+    db = SnapshotDatabase(path, mode=MODE_WRITE_BEHIND)
+    assert [t['title'] for t in db.get_user(1)['tasks']] == ['старая', 'новая']
+    asyncio.run(db.close())
@@ -0,0 +1,139 @@
+import asyncio
+import copy
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from database import Database, MODE_JOURNAL, TaskIndex
+from sqlite_database import SqliteDatabase, migrate_json
+
+
+# Общее время, чтобы базы, заполненные в разное время, совпадали
+NOW = datetime.now().isoformat()
+
+
+def make_task(title, category=None, **fields):
+    return {'title': title, 'created': NOW, 'completed': False,
+            'time': None, 'category': category, **fields}
+
+
+def fill(db):
+    # Одна и та же последовательность операций для любой реализации базы
+    now = NOW
+    db.add_category(1, 'Дом')
+    for i in range(6):
+        db.add_task(1, make_task(f'задача {i}', 'Работа' if i % 2 else None))
+    db.add_task(1, make_task('дом', 'Дом', time='09:00', remind_at='2030-01-01T09:00:00'))
+    db.update_task(1, 1, completed=True, completed_at=now)
+    db.update_task(1, 2, completed=True, completed_at=now)
+    db.update_task(1, 3, title='переименована')
+    db.delete_task(1, 4)
+    db.add_note(1, {'text': 'заметка', 'created': now})
+    db.add_note(1, {'text': 'вторая', 'created': now})
+    db.delete_note(1, 0)
+    db.set_setting(1, 'timezone', 3)
+    db.import_records(1, [make_task('из файла', 'Дом')], [{'text': 'из файла', 'created': now}])
+    db.update_task(1, 7, completed=True, completed_at=now)
+    db.delete_category(1, 'Дом')
+    db.add_task(2, make_task('другой пользователь'))
+
+
+def close(db):
+    asyncio.run(db.close())
+
+
+def test_round_trip(tmp_path: Path):
+    db = SqliteDatabase(tmp_path / 'db.sqlite3')
+    fill(db)
+    expected = {u: copy.deepcopy(db.get_user(u)) for u in (1, 2)}
+    close(db)
+
+    db = SqliteDatabase(tmp_path / 'db.sqlite3')
+    assert {u: db.get_user(u) for u in (1, 2)} == expected
+    close(db)
+
+
+def test_queries_match_json_backend(tmp_path: Path):
+    json_db = Database(tmp_path / 'db.json')
+    sqlite_db = SqliteDatabase(tmp_path / 'db.sqlite3')
+    # Индекс задач строится до операций и дальше только обновляется
+    index = json_db.task_index(1)
+    fill(json_db)
+    fill(sqlite_db)
+
+    assert sqlite_db.get_user(1) == json_db.get_user(1)
+    for db in (json_db, sqlite_db):
+        assert db.get_active_task(1, 1) is None
+        assert db.get_active_task(1, 3)['title'] == 'переименована'
+    assert sqlite_db.active_tasks(1) == json_db.active_tasks(1)
+    assert sqlite_db.active_tasks(1, 1, 3) == json_db.active_tasks(1, 1, 3)
+    assert sqlite_db.active_count(1) == json_db.active_count(1)
+    assert sqlite_db.done_count(1) == json_db.done_count(1) == 3
+    assert sqlite_db.category_counts(1) == json_db.category_counts(1)
+    for category in (None, 'Работа', 'Дом'):
+        assert sqlite_db.category_count(1, category) == json_db.category_count(1, category)
+        assert sqlite_db.category_tasks(1, category) == json_db.category_tasks(1, category)
+        assert sqlite_db.category_done_count(1, category) == json_db.category_done_count(1, category)
+    # Счётчики, обновлённые по операциям, совпадают с построенными заново
+    assert json_db.category_done_count(1, None) == 2
+    rebuilt = TaskIndex(json_db.get_user(1)['tasks'])
+    assert index.done_by_category == rebuilt.done_by_category
+    assert index.done_cat == rebuilt.done_cat
+    assert sqlite_db.task_stats(1) == json_db.task_stats(1)
+    assert sqlite_db.task_stats(3)['total'] == 0
+    close(sqlite_db)
+
+
+def test_queries_use_indexes(tmp_path: Path):
+    db = SqliteDatabase(tmp_path / 'db.sqlite3')
+    fill(db)
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    db.get_active_task(1, 3)
+    db.active_count(1)
+    db.category_tasks(1, 'Работа')
+    db.task_stats(1)
+    list(db.archive_candidates(datetime.now().isoformat()))
+    db.conn.set_trace_callback(None)
+
+    plans = ' '.join(
+        str(tuple(row)) for sql in statements
+        for row in db.conn.execute('EXPLAIN QUERY PLAN ' + sql)
+    )
+    for index in ('tasks_user_task', 'tasks_user_completed', 'tasks_user_category', 'tasks_user_created'):
+        assert index in plans
+    assert 'SCAN tasks' not in plans
+    close(db)
+
+
+def test_migrate_json(tmp_path: Path):
+    json_path = tmp_path / 'planner_db.json'
+    source = Database(json_path, mode=MODE_JOURNAL)
+    fill(source)
+    expected = {u: copy.deepcopy(source.get_user(u)) for u in (1, 2)}
+    # Журнал не свёрнут в снимок: перенос должен его воспроизвести
+    source._journal.close()
+
+    assert migrate_json(json_path, tmp_path / 'db.sqlite3') == 2
+    db = SqliteDatabase(tmp_path / 'db.sqlite3')
+    assert {u: db.get_user(u) for u in (1, 2)} == expected
+    close(db)
+
+    with pytest.raises(SystemExit):
+        migrate_json(json_path, tmp_path / 'db.sqlite3')
+
+
+def test_operation_is_one_transaction(tmp_path: Path, monkeypatch):
+    db = SqliteDatabase(tmp_path / 'db.sqlite3')
+    db.get_user(1)
+
+    def broken_insert(user_id_str, note):
+        raise RuntimeError('сбой записи')
+
+    monkeypatch.setattr(db, '_insert_note', broken_insert)
+    with pytest.raises(RuntimeError):
+        db.import_records(1, [make_task('из файла')], [{'text': 'заметка', 'created': NOW}])
+    assert not db.conn.in_transaction
+    assert db.conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] == 0
+    close(db)
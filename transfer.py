@@ -0,0 +1,187 @@
+import asyncio
+import csv
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from database import Database, NO_CATEGORY
+from recurrence import first_due, valid_rule
+from reminders import ReminderScheduler, parse_time, task_remind_at
+
+FORMATS = ('jsonl', 'csv')
+CSV_FIELDS = ('type', 'text', 'category', 'time', 'created', 'completed', 'completed_at')
+
+# Сколько записей обрабатывать за раз: столько держим в памяти и после
+# стольких отдаём цикл событий апдейтам других пользователей
+CHUNK_SIZE = 500
+
+
+# Выгрузка: задачи, затем архив, затем заметки. Списки копируются ссылками,
+# поэтому изменения во время выгрузки не ломают обход
+def export_records(db: Database, user_id: int) -> Iterator[Dict]:
+    user = db.get_user(user_id)
+    tasks = list(user['tasks'])
+    notes = list(user['notes'])
+    archived = db.iter_archived_tasks(user_id)
+
+    for source in (tasks, archived):
+        for task in source:
+            record = {'type': 'task', 'title': task['title'], 'category': task.get('category'),
+                      'time': task.get('time'), 'created': task['created'],
+                      'completed': bool(task.get('completed'))}
+            if task.get('completed_at'):
+                record['completed_at'] = task['completed_at']
+            # Правило повтора есть только в JSON Lines: в CSV для него нет колонки
+            if task.get('repeat') and not task.get('completed'):
+                record['repeat'] = task['repeat']
+            yield record
+    for note in notes:
+        yield {'type': 'note', 'text': note['text'], 'created': note['created']}
+
+
+def _csv_row(record: Dict) -> Dict:
+    row = dict(record)
+    if record['type'] == 'task':
+        row['text'] = row.pop('title')
+        row['completed'] = 1 if record['completed'] else 0
+    return row
+
+
+async def write_export(records: Iterator[Dict], path: Path, fmt: str) -> int:
+    count = 0
+    # utf-8-sig — чтобы Excel узнал кодировку CSV
+    with open(path, 'w', encoding='utf-8-sig' if fmt == 'csv' else 'utf-8', newline='') as f:
+        writer = None
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+        for record in records:
+            if writer is not None:
+                writer.writerow(_csv_row(record))
+            else:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+            if count % CHUNK_SIZE == 0:
+                await asyncio.sleep(0)
+    return count
+
+
+def _read_records(path: Path, fmt: str) -> Iterator[Optional[Dict]]:
+    # Файл читается построчно; None — строка, которую не удалось разобрать
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                if row.get('type') == 'task':
+                    row['title'] = row.pop('text', None)
+                yield row
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            yield record if isinstance(record, dict) else None
+
+
+def _iso(value, default: str) -> str:
+    try:
+        return datetime.fromisoformat(str(value)).isoformat()
+    except ValueError:
+        return default
+
+
+def _flag(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'да')
+    return bool(value)
+
+
+def _parse_task(record: Dict, now: str, user: Dict) -> Optional[Dict]:
+    title = str(record.get('title') or '').strip()
+    if not title:
+        return None
+    category = str(record.get('category') or '').strip() or None
+    task = {
+        'title': title,
+        'created': _iso(record.get('created'), now),
+        'completed': _flag(record.get('completed')),
+        'time': parse_time(str(record['time'])) if record.get('time') else None,
+        'category': None if category == NO_CATEGORY else category
+    }
+    if task['completed']:
+        task['completed_at'] = _iso(record.get('completed_at'), task['created'])
+    elif valid_rule(record.get('repeat')):
+        # Повторы начинаются заново с ближайшего срока
+        task['repeat'] = record['repeat']
+        task['due'] = first_due(record['repeat'], now[:10])
+    if task['time'] and not task['completed']:
+        # Как у задачи, которой время назначили в боте
+        task['remind_at'] = task_remind_at(task, user)
+    return task
+
+
+def _parse_note(record: Dict, now: str) -> Optional[Dict]:
+    text = str(record.get('text') or '').strip()
+    if not text:
+        return None
+    return {'text': text, 'created': _iso(record.get('created'), now)}
+
+
+# Загрузка: записи разбираются по мере чтения и добавляются пачками по
+# CHUNK_SIZE, каждая пачка сохраняется одной записью базы. Между пачками
+# изменения других пользователей сохраняются как обычно. Напоминания задач
+# со временем ставятся по мере добавления.
+# Возвращает (задач, заметок, пропущено строк)
+async def import_file(db: Database, user_id: int, path: Path, fmt: str,
+                      reminders: Optional[ReminderScheduler] = None) -> Tuple[int, int, int]:
+    now = datetime.now().isoformat()
+    user = db.get_user(user_id)
+    categories = set(user['categories'])
+    tasks: List[Dict] = []
+    notes: List[Dict] = []
+    imported_tasks = imported_notes = skipped = 0
+
+    def flush():
+        with db.batch():
+            for task in tasks:
+                if task['category'] and task['category'] not in categories:
+                    categories.add(task['category'])
+                    db.add_category(user_id, task['category'])
+            db.import_records(user_id, tasks, notes)
+        if reminders is not None:
+            # id задачам назначены при добавлении
+            for task in tasks:
+                if task.get('remind_at'):
+                    reminders.schedule(user_id, task['id'], task['remind_at'])
+
+    for record in _read_records(path, fmt):
+        kind = record.get('type') if record is not None else None
+        if kind == 'task':
+            parsed = _parse_task(record, now, user)
+            target = tasks
+        elif kind == 'note':
+            parsed = _parse_note(record, now)
+            target = notes
+        else:
+            parsed = None
+        if parsed is None:
+            skipped += 1
+            continue
+        target.append(parsed)
+
+        if len(tasks) + len(notes) >= CHUNK_SIZE:
+            flush()
+            imported_tasks += len(tasks)
+            imported_notes += len(notes)
+            tasks, notes = [], []
+            await asyncio.sleep(0)
+
+    if tasks or notes:
+        flush()
+        imported_tasks += len(tasks)
+        imported_notes += len(notes)
+    return imported_tasks, imported_notes, skipped
@@ -0,0 +1,65 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+# Блокировки по пользователям: апдейты одного пользователя обрабатываются
+# строго по очереди, разных — параллельно. Блокировка создаётся при первом
+# апдейте и удаляется, как только её никто не держит и не ждёт, поэтому их
+# число не превышает числа пользователей с апдейтами в обработке
+class UserLocks:
+    def __init__(self):
+        # пользователь -> [блокировка, сколько апдейтов её держат или ждут]
+        self._locks: Dict[int, List] = {}
+        self._acquired = 0
+        self._contended = 0
+        self._max_locks = 0
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+            self._max_locks = max(self._max_locks, len(self._locks))
+        entry[1] += 1
+        if entry[0].locked():
+            self._contended += 1
+        try:
+            async with entry[0]:
+                self._acquired += 1
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def stats(self) -> Dict:
+        return {
+            'locks': len(self._locks),
+            'max_locks': self._max_locks,
+            'acquired': self._acquired,
+            'contended': self._contended,
+        }
+
+
+class UserLockMiddleware(BaseMiddleware):
+    def __init__(self, locks: UserLocks):
+        self.locks = locks
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        async with self.locks.hold(user.id):
+            return await handler(event, data)
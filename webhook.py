@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import signal
+from typing import Any, Callable, Optional, Set
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+# Приём обновлений через вебхук. Telegram сразу получает ответ 200, а апдейт
+# обрабатывается в фоне; одновременно обрабатывается не больше max_in_flight
+# апдейтов — остальные запросы ждут свободного места, и Telegram не шлёт
+# новые, пока не дождётся ответа
+class LimitedRequestHandler(SimpleRequestHandler):
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: Optional[str] = None,
+                 max_in_flight: int = 100, drain_timeout: float = 10.0, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.max_in_flight = max_in_flight
+        self.drain_timeout = drain_timeout
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._in_flight: Set[asyncio.Task] = set()
+        self._accepted = 0
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._feed(bot, update))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+        self._accepted += 1
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _feed(self, bot: Bot, update: dict):
+        try:
+            await self._background_feed_update(bot, update)
+        except Exception:
+            logger.exception("Ошибка при обработке апдейта")
+        finally:
+            self._slots.release()
+
+    async def drain(self, *args: Any):
+        # Новые запросы сервер уже не принимает; дожидаемся начатых апдейтов
+        if not self._in_flight:
+            return
+        logger.info("Ожидаем завершения апдейтов: %d", len(self._in_flight))
+        done, pending = await asyncio.wait(self._in_flight, timeout=self.drain_timeout)
+        if pending:
+            logger.warning("Не дождались апдейтов за %s с: %d", self.drain_timeout, len(pending))
+            for task in pending:
+                task.cancel()
+
+    async def close(self):
+        # Сессию бота закрывает main() после остановки приложения
+        pass
+
+    def stats(self) -> dict:
+        return {
+            'accepted': self._accepted,
+            'in_flight': len(self._in_flight),
+            'max_in_flight': self.max_in_flight,
+        }
+
+
+async def wait_for_stop():
+    # Ждём SIGINT/SIGTERM; на Windows остановка по Ctrl+C придёт как KeyboardInterrupt
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await stop.wait()
+
+
+async def serve_updates(dp: Dispatcher, bot: Bot, path: str, host: str, port: int,
+                        secret_token: Optional[str] = None, max_in_flight: int = 100,
+                        drain_timeout: float = 10.0, on_startup: Optional[Callable] = None):
+    handler = LimitedRequestHandler(
+        dp, bot, secret_token=secret_token, max_in_flight=max_in_flight, drain_timeout=drain_timeout
+    )
+
+    app = web.Application()
+    app.router.add_post(path, handler.handle)
+    if on_startup is not None:
+        app.on_startup.append(on_startup)
+    # Порядок остановки: дождаться апдейтов, затем хуки диспетчера (сброс базы)
+    app.on_shutdown.append(handler.drain)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info("Приём апдейтов на %s:%s%s", host, port, path)
+
+    try:
+        await wait_for_stop()
+    finally:
+        await runner.cleanup()
+        logger.info("Приём апдейтов остановлен: %s", handler.stats())
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, url: str, path: str, host: str, port: int,
+                      secret_token: Optional[str] = None, max_in_flight: int = 100,
+                      drain_timeout: float = 10.0, drop_pending_updates: bool = False):
+    async def on_startup(app: web.Application):
+        # Несколько экземпляров за балансировщиком ставят один и тот же адрес
+        await bot.set_webhook(
+            url + path,
+            secret_token=secret_token,
+            drop_pending_updates=drop_pending_updates,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(max_in_flight, 100)
+        )
+
+    await serve_updates(
+        dp, bot, path, host, port,
+        secret_token=secret_token,
+        max_in_flight=max_in_flight,
+        drain_timeout=drain_timeout,
+        on_startup=on_startup
+    )